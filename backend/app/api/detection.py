@@ -0,0 +1,219 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, request, jsonify, send_file
+from PIL import Image
+from dotenv import dotenv_values
+
+from app.fun.explainability_fun import ImagePayload
+from app.fun.response_format import make_response
+from app.fun.upload_spool import UPLOAD_SPOOL
+from app.fun.previews import PREVIEWS, PREVIEW_MAX_SIDE, PREVIEW_MAX_AGE
+from app.fun.memory_governor import GOVERNOR, MemoryBusy, DETECTION_STAGES
+from app.fun.ingest import ingest_image, capped_size, boxes_to_original
+from app.fun.telemetry import span, bind
+from app.fun.structured_log import get_logger, fields
+
+# Import del modello con gestione errore migliorata
+try:
+    from app.cropping_fun.fasterrcnn_crop import detect_batch
+except ImportError:
+    print("ERRORE CRITICO: Verificare il percorso di app.cropping_fun.fasterrcnn_crop")
+
+config = dotenv_values(".env")
+
+# Configurazione
+DETECTION_WORKERS = int(config.get("DETECTION_WORKERS", 4))
+DETECTION_BATCH_SIZE = int(config.get("DETECTION_BATCH_SIZE", 4))
+# none: solo box | thumb: JPEG inline (max_side) | url: JPEG servito da GET /dbinference/previews/<key>
+PREVIEW_TIERS = ('none', 'thumb', 'url')
+MIN_PREVIEW_SIDE, MAX_PREVIEW_SIDE = 64, 2048
+
+log = get_logger("detection")
+
+detection_bp = Blueprint('detection', __name__)
+# Un solo pool per decode e anteprime, condiviso da tutte le richieste
+executor = ThreadPoolExecutor(max_workers=DETECTION_WORKERS, thread_name_prefix="detection")
+
+
+def decode_upload(file_storage, upload_session=None):
+    """
+    Reads an upload once: the bytes are decoded and, with an upload_session, spooled so
+    /save_dataset can crop from the original. Returns {'image', 'scale', 'data', 'upload_id', 'error'}
+    (see ingest.py for 'scale'); the bytes stay until the previews of the chunk are done.
+    """
+    try:
+        data = file_storage.read()
+        ingested = ingest_image(data)
+        upload_id = UPLOAD_SPOOL.put(upload_session, file_storage.filename, data) if upload_session else None
+        return {'image': ingested['image'], 'scale': ingested['scale'], 'data': data, 'upload_id': upload_id, 'error': None}
+    except Exception as e:
+        log.warning("upload not decoded", extra=fields(filename=file_storage.filename, error=str(e)))
+        return {'image': None, 'scale': None, 'data': None, 'upload_id': None, 'error': str(e)}
+
+def render_preview(data, tier, max_side):
+    """
+    Preview of one upload for the requested tier (None for 'none'). Made from the original
+    bytes (reduced-scale decode), not from the full decoded image, and taken from the
+    preview store when the same photo was already seen.
+    """
+    if tier == 'none':
+        return None
+    with span('preview'):
+        key = PREVIEWS.get_or_create(data, max_side)
+    if tier == 'thumb':
+        # base64 solo se la risposta è JSON, vedi response_format
+        return ImagePayload(PREVIEWS.read(key), data_uri=True)
+    return f"/dbinference/previews/{key}"
+
+def _preview_result(future):
+    try:
+        return future.result()
+    except Exception as e:
+        log.warning("preview failed", extra=fields(error=str(e)))
+        return ""
+
+def header_size(file_storage):
+    """
+    (w, h) the image will have once ingested, from the header only without decoding
+    (capped like ingest_image does); (0, 0) if unreadable.
+    """
+    try:
+        with Image.open(file_storage.stream) as img:
+            size = capped_size(img.size)
+    except Exception:
+        size = (0, 0)
+    file_storage.stream.seek(0)
+    return size
+
+def detect_files(files, upload_session=None, tier='thumb', max_side=PREVIEW_MAX_SIDE,
+                 batch_size=DETECTION_BATCH_SIZE):
+    """
+    Per-file results in input order. Images are decoded on the shared pool and detected
+    `batch_size` at a time with one forward pass; previews of a chunk are encoded on the
+    pool while the detector runs. Only one chunk of decoded images is alive at a time,
+    and only once the memory governor admits it. Raises MemoryBusy if it never does.
+    """
+    results = []
+    for start in range(0, len(files), batch_size):
+        chunk = files[start:start + batch_size]
+        # Il blocco parte quando la sua memoria stimata entra nel limite (vedi memory_governor.py)
+        cost = sum(GOVERNOR.estimate(header_size(f), DETECTION_STAGES) for f in chunk)
+        with GOVERNOR.admit(cost):
+            decoded = list(executor.map(bind(lambda f: decode_upload(f, upload_session)), chunk))
+            valid = [d for d in decoded if d['image'] is not None]
+            previews = [executor.submit(bind(render_preview), d['data'], tier, max_side) for d in valid]
+
+            try:
+                detections = detect_batch([d['image'] for d in valid])
+            except Exception as e:
+                log.error("detection batch failed", extra=fields(start=start, size=len(chunk), error=str(e)))
+                detections = None
+
+            previews = [_preview_result(p) for p in previews]
+            found = iter(zip(valid, detections or [None] * len(valid), previews))
+            for d in decoded:
+                if d['image'] is None:
+                    results.append({'error': True, 'message': d['error']})
+                    continue
+                _, detection, preview = next(found)
+                if detection is None:
+                    results.append({'error': True, 'message': 'Detection failed'})
+                    continue
+                boxes, scores = detection
+                results.append({
+                    # Coordinate dell'originale dritto, anche se rilevate sull'immagine ridotta
+                    'boxes': boxes_to_original(boxes, d['scale']),
+                    'scores': scores,
+                    'count': len(scores),
+                    'preview': preview,
+                    'upload_id': d['upload_id'],
+                    'error': False,
+                })
+            for d in decoded:
+                d['data'] = None
+                if d['image'] is not None:
+                    d['image'].close()
+    return results
+
+def parse_preview_options(form):
+    tier = form.get('preview', 'thumb')
+    if tier not in PREVIEW_TIERS:
+        raise ValueError(f"Invalid preview: {tier}. Expected one of {', '.join(PREVIEW_TIERS)}")
+    max_side = int(form.get('preview_max_side', PREVIEW_MAX_SIDE))
+    return tier, min(max(max_side, MIN_PREVIEW_SIDE), MAX_PREVIEW_SIDE)
+
+
+@detection_bp.route('/dbinference', methods=['POST'])
+def run_inference():
+    """
+    Detection for a batch of images.
+    - images: files
+    - preview: 'none' | 'thumb' (default) | 'url'
+    - preview_max_side: int (default PREVIEW_MAX_SIDE), longest side of the preview
+    - upload_session: spool session returned by a previous batch (see upload_spool.py)
+    """
+    if 'images' not in request.files:
+        return jsonify({"error": "Nessuna chiave 'images' nella richiesta"}), 400
+    try:
+        tier, max_side = parse_preview_options(request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    files = request.files.getlist('images')
+    num_files = len(files)
+    # Stessa sessione per tutti i batch di una cartella: il client rimanda l'id ricevuto
+    upload_session = UPLOAD_SPOOL.open_session(request.form.get('upload_session'))
+
+    global_start = time.time()
+
+    try:
+        results = detect_files(files, upload_session, tier, max_side)
+    except MemoryBusy as e:
+        return jsonify({"error": str(e)}), 503, {'Retry-After': '5'}
+
+    # Costruzione risposta finale
+    final_response = {
+        "bounding_box": [],
+        "scores": [],
+        "bb_count": [],
+        "upload_session": upload_session,
+        "upload_ids": [],
+        "preview": tier,
+    }
+    previews = []
+    for res in results:
+        if res.get("error"):
+            final_response["bounding_box"].append([])
+            final_response["scores"].append([])
+            final_response["bb_count"].append(0)
+            final_response["upload_ids"].append("")
+            previews.append("")
+        else:
+            final_response["bounding_box"].append(res["boxes"])
+            final_response["scores"].append(res["scores"])
+            final_response["bb_count"].append(res["count"])
+            final_response["upload_ids"].append(res["upload_id"] or "")
+            previews.append(res["preview"])
+    if tier == 'thumb':
+        final_response["images"] = previews
+    elif tier == 'url':
+        final_response["preview_urls"] = previews
+
+    global_duration = time.time() - global_start
+    log.info("detection batch done", extra=fields(
+        images=num_files, preview=tier, seconds=round(global_duration, 3),
+        seconds_per_image=round(global_duration / max(num_files, 1), 3)))
+
+    return make_response(final_response)
+
+@detection_bp.route('/dbinference/previews/<key>', methods=['GET'])
+def get_preview(key):
+    """Stored preview by content key: immutable, so browsers and proxies cache it for good."""
+    path = PREVIEWS.path(key)
+    if path is None:
+        return jsonify({'error': 'Preview not found'}), 404
+    response = send_file(os.path.abspath(path), mimetype="image/jpeg", etag=key, max_age=PREVIEW_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,125 @@
+import numpy as np
+from flask import Blueprint, Response, jsonify, request
+
+from app import model_state
+from app.fun.attribution_engine import ENGINE
+from app.fun.attribution_cache import ATTRIBUTION_CACHE
+from app.fun.occlusion_maps import OCCLUSION_MAPS, class_attribution_hwc
+from app.fun.explainability_fun import render_heatmap, raw_heatmap
+from app.fun.response_format import make_response, to_json
+from app.fun.xai_worker import XAI_JOBS
+
+explanations_bp = Blueprint('explanations', __name__)
+
+@explanations_bp.route('/explanations/engine', methods=['GET'])
+def get_engine_report():
+    """Calibration of the attribution engine and time/peak memory of recent explanations."""
+    return jsonify({**ENGINE.report(), 'occlusion_maps': OCCLUSION_MAPS.stats()})
+
+@explanations_bp.route('/explanations/cache', methods=['GET'])
+def get_cache_stats():
+    """Hit rate and memory of the attribution cache (raw maps, float16)."""
+    return jsonify(ATTRIBUTION_CACHE.stats())
+
+def _class_names():
+    _, _, _, CLASS_NAMES = model_state.get_models()
+    return CLASS_NAMES or []
+
+def _class_index(value, CLASS_NAMES):
+    """Accepts the class index or its name."""
+    if value.isdigit():
+        return int(value)
+    return CLASS_NAMES.index(value) if value in CLASS_NAMES else -1
+
+@explanations_bp.route('/explanations/occlusion/<map_id>/class/<class_ref>', methods=['GET'])
+def get_occlusion_class(map_id, class_ref):
+    """
+    Occlusion heatmap of any class, rendered from the stored all-class sweep (no forward pass).
+    ?xai_format=raw returns the quantized map at stride resolution instead of a rendered image.
+    """
+    CLASS_NAMES = _class_names()
+    class_idx = _class_index(class_ref, CLASS_NAMES)
+    entry = OCCLUSION_MAPS.get(map_id)
+    if entry is None:
+        return jsonify({'error': 'Occlusion map not found or expired'}), 404
+    if not 0 <= class_idx < entry['maps'].shape[0]:
+        return jsonify({'error': f"Unknown class: {class_ref}"}), 400
+
+    # Dall'entry già letta: un secondo lookup potrebbe trovarla sfrattata
+    attribution_map = class_attribution_hwc(entry['maps'], class_idx)
+    original_image = entry['image'].astype(np.float32) / 255.0
+    label = CLASS_NAMES[class_idx] if class_idx < len(CLASS_NAMES) else str(class_idx)
+    if request.args.get("xai_format") == "raw":
+        image = raw_heatmap(attribution_map, "positive", entry['stride'])
+    else:
+        image = render_heatmap(attribution_map, original_image, "positive", f"Occlusion ({label})")
+    return make_response({
+        'map_id': map_id,
+        'class_idx': class_idx,
+        'class_name': label,
+        'occlusion': image,
+    })
+
+@explanations_bp.route('/explanations/occlusion/<map_id>/dominance', methods=['GET'])
+def get_occlusion_dominance(map_id):
+    """Per-cell dominant class (-1 where no class relies on the region), at the sweep stride."""
+    dominance = OCCLUSION_MAPS.dominance(map_id)
+    if dominance is None:
+        return jsonify({'error': 'Occlusion map not found or expired'}), 404
+    return jsonify({'map_id': map_id, 'classes': _class_names(), **dominance})
+
+@explanations_bp.route('/explanations/occlusion/<map_id>/hover', methods=['GET'])
+def get_occlusion_hover(map_id):
+    """Attribution of every class at one pixel (?x=&y= in model input coordinates), highest first."""
+    try:
+        x, y = int(request.args['x']), int(request.args['y'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'x and y are required integers'}), 400
+    values = OCCLUSION_MAPS.hover(map_id, x, y)
+    if values is None:
+        return jsonify({'error': 'Occlusion map not found or expired'}), 404
+    CLASS_NAMES = _class_names()
+    return jsonify({
+        'map_id': map_id,
+        'x': x,
+        'y': y,
+        'values': [
+            {'class_idx': idx, 'class_name': CLASS_NAMES[idx] if idx < len(CLASS_NAMES) else str(idx), 'attribution': value}
+            for idx, value in values
+        ],
+    })
+
+@explanations_bp.route('/explanations/jobs/<job_id>', methods=['GET'])
+def get_explanation_job(job_id):
+    """
+    Status and, once done, the explanation fields of a job started by /inference with
+    explain_async=true. ?wait=<seconds> long-polls until the job finishes (max 30s).
+    """
+    try:
+        wait = min(float(request.args.get("wait", 0)), 30.0)
+    except ValueError:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    job = XAI_JOBS.wait(job_id, wait) if wait > 0 else XAI_JOBS.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Explanation job not found or expired'}), 404
+    return make_response(XAI_JOBS.to_dict(job))
+
+@explanations_bp.route('/explanations/jobs/<job_id>/events', methods=['GET'])
+def stream_explanation_job(job_id):
+    """Server-sent events: a 'status' event every few seconds, then one 'result' event with the job."""
+    if XAI_JOBS.get(job_id) is None:
+        return jsonify({'error': 'Explanation job not found or expired'}), 404
+
+    def events():
+        while True:
+            job = XAI_JOBS.wait(job_id, 5.0)
+            if job is None:
+                yield "event: error\ndata: {\"error\": \"expired\"}\n\n"
+                return
+            data = XAI_JOBS.to_dict(job)
+            if job['done'].is_set():
+                yield f"event: result\ndata: {to_json(data)}\n\n"
+                return
+            yield f"event: status\ndata: {to_json({'id': job_id, 'status': data['status']})}\n\n"
+
+    return Response(events(), mimetype="text/event-stream", headers={'Cache-Control': 'no-cache'})
@@ -0,0 +1,75 @@
+import traceback
+from flask import Blueprint, request, jsonify
+
+from app.fun.job_store import get_job_store
+from app.fun.folder_ingest import resolve_dataset_dir, list_folder_images, make_output_dir, VALID_MODES
+from app.api.jobs import VALID_STRATEGIES, VALID_CROP_MODES
+
+folder_inference_bp = Blueprint('folder_inference', __name__)
+
+@folder_inference_bp.route('/folder/inference', methods=['POST'])
+def submit_folder_inference():
+    """
+    Runs detection and/or classification on a folder that is already mounted in the
+    container (no upload). The work is queued as a job: poll /jobs/<job_id>.
+
+    Expected form data:
+    - folder: path relative to DATASET_ROOT
+    - mode: "detect" | "classify" | "both" (default: "both")
+    - model_strategy: str (default: "standard")
+    - crop_mode: str (default: "integrated")
+    - output: "test_results" | "alongside" (default: "test_results")
+    - save_crops: "true"/"false" (default: "false")
+    - min_score: float in [0, 1] used when saving crops (default: 0)
+    """
+    try:
+        folder = request.form.get("folder")
+        if not folder:
+            return jsonify({'error': "Missing 'folder'"}), 400
+
+        mode = request.form.get("mode", "both")
+        if mode not in VALID_MODES:
+            return jsonify({'error': f"Invalid mode: {mode}"}), 400
+
+        output = request.form.get("output", "test_results")
+        if output not in ("test_results", "alongside"):
+            return jsonify({'error': f"Invalid output: {output}"}), 400
+
+        model_strategy = request.form.get("model_strategy", "standard")
+        crop_mode = request.form.get("crop_mode", "integrated")
+        if model_strategy not in VALID_STRATEGIES:
+            return jsonify({'error': f"Invalid model_strategy: {model_strategy}"}), 400
+        if crop_mode not in VALID_CROP_MODES:
+            return jsonify({'error': f"Invalid crop_mode: {crop_mode}"}), 400
+
+        try:
+            min_score = float(request.form.get("min_score", 0.0))
+        except ValueError:
+            return jsonify({'error': f"Invalid min_score: {request.form.get('min_score')}"}), 400
+        if not 0.0 <= min_score <= 1.0:
+            return jsonify({'error': "min_score must be in [0, 1]"}), 400
+
+        try:
+            folder_path = resolve_dataset_dir(folder)
+        except (ValueError, FileNotFoundError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        items = list_folder_images(folder_path)
+        if not items:
+            return jsonify({'error': 'No images found'}), 400
+
+        out_dir = make_output_dir(folder_path, output)
+        params = {
+            'mode': mode,
+            'model_strategy': model_strategy,
+            'crop_mode': crop_mode,
+            'output_dir': out_dir,
+            'save_crops': request.form.get("save_crops", "false").lower() == "true",
+            'min_score': min_score,
+        }
+        job_id = get_job_store().create_job(f"folder:{folder}", params, items)
+        return jsonify({'job_id': job_id, 'total': len(items), 'output_dir': out_dir, 'status': 'queued'}), 202
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
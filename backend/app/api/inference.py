@@ -7,19 +7,28 @@ from flask_cors import CORS
 from PIL import Image
 from dotenv import dotenv_values
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import base64
 
 # --- LOCAL IMPORTS ---
 from app import model_state                                 
 from app.model_fun.preprocess_data import getTransforms     
-from app.fun.tta_logic import perform_inference
+from app.fun.tta_logic import perform_inference, perform_batch_inference
+from app.fun.batch_logic import build_classification_pipeline
+from app.fun.response_fields import parse_fields, filter_result, SINGLE_DEFAULT_FIELDS, BATCH_DEFAULT_FIELDS
 from app.fun.explainability_fun import (
-    generate_explanation,                                              
-    image_to_base64                                                               
+    encode_image,
+    get_xai
 )
+from app.fun.response_format import make_response
+from app.fun.xai_worker import XAI_JOBS, XaiBusy
+from app.fun.memory_governor import GOVERNOR, MemoryBusy, INFERENCE_STAGES
+from app.fun.ingest import ingest_image, check_size, boxes_to_original, ImageTooLarge
+from app.fun.telemetry import span
+from app.fun.structured_log import get_logger
 
 # Initialize Blueprint
+log = get_logger("inference")
+
 inference_bp = Blueprint('inference', __name__)
 
 config = dotenv_values(".env")
@@ -35,27 +44,77 @@ try:
 except ImportError:
     HAS_EXTERNAL_CROP = False
 
+MULTI_STRATEGIES = ["standard", "1vsall"]
+
+def parse_strategies(model_strategy):
+    """'all' or a comma separated list ('standard,1vsall') -> list of strategies, None for a single one."""
+    if model_strategy == "all":
+        return list(MULTI_STRATEGIES)
+    if "," in model_strategy:
+        strategies = [s.strip() for s in model_strategy.split(",") if s.strip()]
+        unknown = [s for s in strategies if s not in MULTI_STRATEGIES]
+        if unknown:
+            raise ValueError(f"Unknown model_strategy: {', '.join(unknown)}")
+        return list(dict.fromkeys(strategies))
+    return None
+
+# Explanations cheap enough for /inference/batch (one forward + backward for the whole batch)
+BATCH_XAI_METHODS = ['none', 'gradcam', 'gradcam++']
+
+XAI_FORMATS = ['image', 'raw']
+
+def parse_xai_options(form):
+    """
+    Per-request budget for adaptive occlusion (occlusion_max_passes, occlusion_time_budget)
+    and xai_format: 'image' (rendered figure, default) or 'raw' (quantized map for client-side rendering).
+    """
+    options = {}
+    xai_format = form.get("xai_format", "image")
+    if xai_format not in XAI_FORMATS:
+        raise ValueError(f"Unknown xai_format: {xai_format}. Valid: {', '.join(XAI_FORMATS)}")
+    options['format'] = xai_format
+    # explain_async=true: answer after classification, explanations computed by the XAI worker
+    options['async'] = form.get("explain_async", "false").lower() == "true"
+    if form.get("occlusion_max_passes"):
+        options['max_passes'] = int(form.get("occlusion_max_passes"))
+    if form.get("occlusion_time_budget"):
+        options['time_budget'] = float(form.get("occlusion_time_budget"))
+    return options
+
 def process_single_image(image_data, model, onevall_models, device, CLASS_NAMES, 
-                         transform_pipeline, model_strategy, crop_mode, explain_method):
+                         transform_pipeline, model_strategy, crop_mode, explain_method, fields=None, xai_options=None):
+    """
+    fields: optional outputs to materialize (see app.fun.response_fields).
+    Encodings and explanations that were not requested are never computed.
+    xai_options['async']: explanations go to the XAI worker, the result carries
+    'explanation_job' instead (see app.fun.xai_worker).
+    """
+    fields = BATCH_DEFAULT_FIELDS if fields is None else fields
+    if 'explanations' not in fields:
+        explain_method = "none"
+    explain_async = explain_method != "none" and bool((xai_options or {}).get('async'))
+    # Inline explanations only when not delegated to the XAI worker
+    inline_method = "none" if explain_async else explain_method
     try:
-        # 1. Load Image
-        if isinstance(image_data, bytes):
-            image = Image.open(io.BytesIO(image_data)).convert('RGB')
-        else:
-            image = Image.open(io.BytesIO(image_data.read())).convert('RGB')
+        # 1. Load Image (pixel cap, EXIF orientation, RGB: see app.fun.ingest)
+        ingested = ingest_image(image_data if isinstance(image_data, bytes) else image_data.read())
+        image = ingested['image']
         
-        tensor_original = transform_pipeline(image).unsqueeze(0).to(device)
+        with span('transform'):
+            tensor_original = transform_pipeline(image).unsqueeze(0).to(device)
         
         # 2. Cropping logic
         image_cropped = None
         tensor_cropped = None
         crop_error = None
+        boxes, scores = [], []
         
         if crop_mode in ['external', 'compare'] and HAS_EXTERNAL_CROP:
             try:
-                image_cropped, _, _ = crop(image.copy())
+                image_cropped, boxes, scores = crop(image)
                 if image_cropped is not None:
-                    tensor_cropped = transform_pipeline(image_cropped).unsqueeze(0).to(device)
+                    with span('transform'):
+                        tensor_cropped = transform_pipeline(image_cropped).unsqueeze(0).to(device)
             except Exception as e:
                 crop_error = f"Cropping failed: {str(e)}"
         
@@ -69,17 +128,7 @@ def process_single_image(image_data, model, onevall_models, device, CLASS_NAMES,
         )
         
         # 5. Explainability Logic
-        # Helper to handle 'both' or specific methods
-        def get_xai(m, t, idx):
-            if idx == -1: return {}
-            xai_results = {}
-            methods = ['occlusion', 'integrated_gradients'] if explain_method == 'both' else [explain_method]
-            for meth in methods:
-                if meth in ['occlusion', 'integrated_gradients']:
-                    xai_results[meth] = generate_explanation(m, t, idx, meth)
-            return xai_results
-
-        primary_xai = get_xai(model, primary_tensor, prim_idx)
+        primary_xai = get_xai(model, primary_tensor, prim_idx, inline_method, xai_options)
 
         # 6. Build Result
         result = {
@@ -88,30 +137,148 @@ def process_single_image(image_data, model, onevall_models, device, CLASS_NAMES,
             'confidence': prim_conf,
             'all_classes_probs': prim_probs,
             'occlusion': primary_xai.get('occlusion'),
+            'occlusion_map_id': primary_xai.get('occlusion_map_id'),
             'integrated_gradients': primary_xai.get('integrated_gradients'),
+            'gradcam': primary_xai.get('gradcam'),
             'error': prim_err or crop_error,
+            'boxes': boxes_to_original(boxes, ingested['scale']),
+            'scores': scores,
         }
 
-        if image_cropped is not None:
-            result['image_cropped'] = image_to_base64(image_cropped)
+        if image_cropped is not None and 'crop_preview' in fields:
+            result['image_cropped'] = encode_image(image_cropped)
+
+        if 'image' in fields:
+            result['image'] = encode_image(image)
         
         # 7. Handle Comparison Mode
         if secondary_tensor is not None:
             sec_idx, sec_conf, sec_probs, _ = perform_inference(
                 model, onevall_models, secondary_tensor, model_strategy, device
             )
-            secondary_xai = get_xai(model, secondary_tensor, sec_idx)
+            secondary_xai = get_xai(model, secondary_tensor, sec_idx, inline_method, xai_options)
             
             result.update({
                 'predicted_class_cropped': CLASS_NAMES[sec_idx] if sec_idx != -1 else "Unknown",
                 'confidence_cropped': sec_conf,
                 'all_classes_probs_cropped': sec_probs,
                 'occlusion_cropped': secondary_xai.get('occlusion'),
+                'occlusion_map_id_cropped': secondary_xai.get('occlusion_map_id'),
                 'integrated_gradients_cropped': secondary_xai.get('integrated_gradients'),
+                'gradcam_cropped': secondary_xai.get('gradcam'),
             })
+
+        # 8. Background explanations on the XAI worker's own model replica
+        if explain_async:
+            views = {'': (primary_tensor, prim_idx)}
+            if secondary_tensor is not None:
+                views['_cropped'] = (secondary_tensor, sec_idx)
+            job_id = XAI_JOBS.submit(views, explain_method, xai_options)
+            result['explanation_job'] = XAI_JOBS.handle(job_id)
         
-        return result
+        return filter_result(result, fields)
         
+    except XaiBusy:
+        # Coda XAI piena: l'endpoint risponde 503 come per MemoryBusy
+        raise
+    except Exception as e:
+        return {'success': False, 'error': str(e), 'traceback': traceback.format_exc()}
+
+def process_multi_strategy(image_data, model, onevall_models, device, CLASS_NAMES,
+                           transform_pipeline, strategies, crop_mode, explain_method, fields=SINGLE_DEFAULT_FIELDS, xai_options=None):
+    """
+    Runs several strategies on one upload: the image is decoded once, detected once,
+    the views picked by crop_mode are built once and stacked into a single batch
+    that every model sees in one forward pass. Returns every strategy x view combination.
+    crop_mode as in process_single_image: 'integrated' (original only, no detection),
+    'external' (cropped, original if nothing was detected) or 'compare' (both).
+    """
+    if 'explanations' not in fields:
+        explain_method = "none"
+    try:
+        raw = image_data if isinstance(image_data, bytes) else image_data.read()
+        ingested = ingest_image(raw)
+        image = ingested['image']
+
+        views = {'original': image}
+        crop_error = None
+        boxes, scores = [], []
+        if crop_mode in ['external', 'compare'] and HAS_EXTERNAL_CROP:
+            try:
+                image_cropped, boxes, scores = crop(image)
+                if boxes:
+                    views['cropped'] = image_cropped
+            except Exception as e:
+                crop_error = f"Cropping failed: {str(e)}"
+        if crop_mode == 'external' and 'cropped' in views:
+            del views['original']
+        # Top-level fields mirror this view; '_cropped' keys only in compare mode
+        primary = 'cropped' if crop_mode == 'external' and 'cropped' in views else 'original'
+
+        view_names = list(views)
+        with span('transform', batch=len(view_names)):
+            batch = torch.stack([transform_pipeline(views[v]) for v in view_names]).to(device)
+
+        combinations = {}
+        explanations = {}
+        for strategy in strategies:
+            rows = perform_batch_inference(model, onevall_models, batch, strategy, device)
+            # Filtered only once the top-level fields have been read from them
+            combinations[strategy] = {
+                view: {
+                    'predicted_class': CLASS_NAMES[idx] if idx != -1 else "Unknown",
+                    'confidence': conf,
+                    'all_classes_probs': probs,
+                    'error': err,
+                }
+                for view, (idx, conf, probs, err) in zip(view_names, rows)
+            }
+            # Explanations always use the 6-class model, for the class this strategy predicted:
+            # strategies agreeing on a view's class share one computation
+            if explain_method != "none":
+                for i, (view, (idx, _, _, _)) in enumerate(zip(view_names, rows)):
+                    if (view, idx) not in explanations:
+                        explanations[(view, idx)] = get_xai(model, batch[i:i + 1], idx, explain_method, xai_options)
+                    combinations[strategy][view].update(explanations[(view, idx)])
+
+        first = combinations[strategies[0]][primary]
+        result = {
+            'success': True,
+            'strategies': strategies,
+            'views': view_names,
+            'combinations': combinations,
+            # Top-level fields mirror the first strategy on the primary view (ApiResponse shape)
+            'predicted_class': first['predicted_class'],
+            'confidence': first['confidence'],
+            'all_classes_probs': first['all_classes_probs'],
+            'occlusion': first.get('occlusion'),
+            'occlusion_map_id': first.get('occlusion_map_id'),
+            'integrated_gradients': first.get('integrated_gradients'),
+            'gradcam': first.get('gradcam'),
+            'error': first['error'] or crop_error,
+            'boxes': boxes_to_original(boxes, ingested['scale']),
+            'scores': scores,
+        }
+        if 'image' in fields:
+            result['image'] = encode_image(image)
+        if crop_mode == 'compare' and 'cropped' in views:
+            cropped = combinations[strategies[0]]['cropped']
+            result.update({
+                'predicted_class_cropped': cropped['predicted_class'],
+                'confidence_cropped': cropped['confidence'],
+                'all_classes_probs_cropped': cropped.get('all_classes_probs'),
+                'occlusion_cropped': cropped.get('occlusion'),
+                'occlusion_map_id_cropped': cropped.get('occlusion_map_id'),
+                'integrated_gradients_cropped': cropped.get('integrated_gradients'),
+                'gradcam_cropped': cropped.get('gradcam'),
+            })
+        if 'cropped' in views and 'crop_preview' in fields:
+            result['image_cropped'] = encode_image(views['cropped'])
+        for per_view in combinations.values():
+            for entry in per_view.values():
+                filter_result(entry, fields)
+        return filter_result(result, fields)
+
     except Exception as e:
         return {'success': False, 'error': str(e), 'traceback': traceback.format_exc()}
 
@@ -125,29 +292,55 @@ def run_inference_endpoint():
     
     try:
         image_file = request.files['image']
-        model_strategy = request.form.get("model_strategy", "standard")
+        model_strategy = request.form.get("model_strategy", "standard")  # also "all" or "standard,1vsall"
         crop_mode = request.form.get("crop_mode", "integrated")
         explain_method = request.form.get("explain_method", "none")
+        try:
+            fields = parse_fields(request.form.get("fields"), SINGLE_DEFAULT_FIELDS)
+            xai_options = parse_xai_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         transform_pipeline = getTransforms(WIDTH, HEIGHT, True, MEAN, STD)
+
+        # Upload letto una volta: la dimensione dall'header decide l'ammissione (memory_governor.py)
+        raw = image_file.read()
+        with Image.open(io.BytesIO(raw)) as header:
+            cost = GOVERNOR.estimate(check_size(header.size), INFERENCE_STAGES)
+        with GOVERNOR.admit(cost):
+            # model_strategy=all (or "standard,1vsall"): every combination in one pass
+            try:
+                strategies = parse_strategies(model_strategy)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if strategies:
+                if xai_options['async'] and explain_method != "none":
+                    # Le spiegazioni di più strategie e viste restano inline: il job XAI ha una sola vista per suffisso
+                    return jsonify({'error': "explain_async is only supported with a single model_strategy"}), 400
+                result = process_multi_strategy(
+                    raw, model, onevall_models, device, CLASS_NAMES,
+                    transform_pipeline, strategies, crop_mode, explain_method, fields, xai_options
+                )
+                if not result['success']:
+                    return jsonify({'error': result['error']}), 500
+                return make_response(result)
         
-        result = process_single_image(
-            image_file, model, onevall_models, device, CLASS_NAMES,
-            transform_pipeline, model_strategy, crop_mode, explain_method
-        )
-        
-        if not result['success']:
-            return jsonify({'error': result['error']}), 500
-            
-        # Add image data for single request
-        image_file.seek(0)
-        original_image = Image.open(io.BytesIO(image_file.read())).convert('RGB')
-        result['image'] = image_to_base64(original_image)
+            result = process_single_image(
+                raw, model, onevall_models, device, CLASS_NAMES,
+                transform_pipeline, model_strategy, crop_mode, explain_method, fields, xai_options
+            )
         
-        return jsonify(result)
+            if not result['success']:
+                return jsonify({'error': result['error']}), 500
         
+            return make_response(result)
+
+    except (ImageTooLarge, Image.DecompressionBombError) as e:
+        return jsonify({'error': str(e)}), 413
+    except (MemoryBusy, XaiBusy) as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
     except Exception as e:
-        traceback.print_exc()
+        log.exception("request failed")
         return jsonify({'error': str(e)}), 500
 
 @inference_bp.route('/inference/batch', methods=['POST'])
@@ -161,6 +354,9 @@ def run_batch_inference_endpoint():
     - crop_mode: str (default: "integrated") 
     - use_smart_crop: str "true"/"false" (default: "false")
     - max_workers: int (default: 4)
+    - fields: comma separated optional outputs (default: "probs,crop_preview,boxes,explanations")
+    - explain_method: "none" | "gradcam" | "gradcam++" (default: "none"), batched with classification
+    - xai_format: "image" | "raw" (default: "image"), see parse_xai_options
     """
     model, onevall_models, device, CLASS_NAMES = model_state.get_models()
     
@@ -173,6 +369,14 @@ def run_batch_inference_endpoint():
         crop_mode = request.form.get("crop_mode", "integrated")
         use_smart_crop = request.form.get("use_smart_crop", "false").lower() == "true"
         max_workers = int(request.form.get("max_workers", 4))
+        explain_method = request.form.get("explain_method", "none")
+        try:
+            fields = parse_fields(request.form.get("fields"), BATCH_DEFAULT_FIELDS)
+            xai_options = parse_xai_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if explain_method not in BATCH_XAI_METHODS:
+            return jsonify({'error': f"explain_method for batches must be one of: {', '.join(BATCH_XAI_METHODS)}"}), 400
         
         # Override crop_mode if use_smart_crop is specified
         if use_smart_crop:
@@ -190,56 +394,44 @@ def run_batch_inference_endpoint():
         results = []
         errors = []
         
-        # Process images in parallel using ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks
-            future_to_idx = {
-                executor.submit(
-                    process_single_image,
-                    img, model, onevall_models, device, CLASS_NAMES,
-                    transform_pipeline, model_strategy, crop_mode, "none"
-                ): idx 
-                for idx, img in enumerate(images)
-            }
-            
-            # Collect results as they complete
-            for future in as_completed(future_to_idx):
-                idx = future_to_idx[future]
-                try:
-                    result = future.result()
-                    if result['success']:
-                        results.append({
-                            'index': idx,
-                            'filename': images[idx].filename,
-                            **result
-                        })
-                    else:
-                        errors.append({
-                            'index': idx,
-                            'filename': images[idx].filename,
-                            'error': result['error']
-                        })
-                except Exception as e:
-                    errors.append({
-                        'index': idx,
-                        'filename': images[idx].filename,
-                        'error': str(e)
-                    })
+        # Decode, detection, transform, classification and encoding run as separate
+        # pipelined stages, so the detector never waits for the cheaper stages
+        pipeline = build_classification_pipeline(
+            model, onevall_models, device, CLASS_NAMES, transform_pipeline,
+            model_strategy, crop_mode, decode_workers=max_workers, fields=fields,
+            explain_method=explain_method, xai_format=xai_options['format']
+        )
+        for outcome in pipeline.run(images):
+            idx = outcome['index']
+            result = outcome['result']
+            if outcome['error'] is None and result['success']:
+                results.append({
+                    'index': idx,
+                    'filename': images[idx].filename,
+                    **result
+                })
+            else:
+                errors.append({
+                    'index': idx,
+                    'filename': images[idx].filename,
+                    'error': outcome['error'] or result['error']
+                })
         
         # Sort results by index to maintain order
         results.sort(key=lambda x: x['index'])
         errors.sort(key=lambda x: x['index'])
         
-        return jsonify({
+        return make_response({
             'total_processed': len(results),
             'total_errors': len(errors),
             'crop_mode_used': crop_mode,
             'results': results,
-            'errors': errors
+            'errors': errors,
+            'pipeline_stats': pipeline.report()
         })
         
     except Exception as e:
-        traceback.print_exc()
+        log.exception("request failed")
         return jsonify({'error': str(e)}), 500
 
 @inference_bp.route('/inference/benchmark', methods=['POST'])
@@ -270,43 +462,30 @@ def run_benchmark_inference():
         
         predictions = []
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_info = {
-                executor.submit(
-                    process_single_image,
-                    img, model, onevall_models, device, CLASS_NAMES,
-                    transform_pipeline, model_strategy, crop_mode, "none"
-                ): {'idx': i, 'label': labels[i] if i < len(labels) else None, 'filename': img.filename}
-                for i, img in enumerate(images)
-            }
-            
-            for future in as_completed(future_to_info):
-                info = future_to_info[future]
-                try:
-                    result = future.result()
-                    predictions.append({
-                        'true_label': info['label'],
-                        'predicted_label': result.get('predicted_class') if result['success'] else None,
-                        'confidence': result.get('confidence', 0),
-                        'success': result['success'],
-                        'error': result.get('error'),
-                        'filename': info['filename']
-                    })
-                except Exception as e:
-                    predictions.append({
-                        'true_label': info['label'],
-                        'predicted_label': None,
-                        'success': False,
-                        'error': str(e),
-                        'filename': info['filename']
-                    })
+        pipeline = build_classification_pipeline(
+            model, onevall_models, device, CLASS_NAMES, transform_pipeline,
+            model_strategy, crop_mode, decode_workers=max_workers, fields=set()
+        )
+        for outcome in pipeline.run(images):
+            i = outcome['index']
+            result = outcome['result']
+            success = outcome['error'] is None and result['success']
+            predictions.append({
+                'true_label': labels[i] if i < len(labels) else None,
+                'predicted_label': result.get('predicted_class') if success else None,
+                'confidence': result.get('confidence', 0) if success else 0,
+                'success': success,
+                'error': outcome['error'] or (result.get('error') if result else None),
+                'filename': images[i].filename
+            })
         
         return jsonify({
             'predictions': predictions,
             'model_strategy': model_strategy,
-            'use_smart_crop': use_smart_crop
+            'use_smart_crop': use_smart_crop,
+            'pipeline_stats': pipeline.report()
         })
         
     except Exception as e:
-        traceback.print_exc()
+        log.exception("request failed")
         return jsonify({'error': str(e)}), 500
\ No newline at end of file
@@ -0,0 +1,88 @@
+import os
+import traceback
+from flask import Blueprint, request, jsonify
+from werkzeug.utils import secure_filename
+
+from app.fun.job_store import get_job_store, JOB_UPLOAD_DIR
+from app.fun.job_worker import get_batch_tuner_stats
+from app.fun.folder_ingest import resolve_dataset_dir, list_folder_images
+
+jobs_bp = Blueprint('jobs', __name__)
+
+VALID_STRATEGIES = {'standard', '1vsall'}
+VALID_CROP_MODES = {'integrated', 'external', 'compare'}
+
+def spool_uploads(files):
+    """Persists uploaded files so that a queued job survives a restart."""
+    batch_dir = os.path.join(JOB_UPLOAD_DIR, os.urandom(8).hex())
+    os.makedirs(batch_dir, exist_ok=True)
+    items = []
+    for i, f in enumerate(files):
+        path = os.path.join(batch_dir, f"{i:06d}_{secure_filename(f.filename or 'image')}")
+        f.save(path)
+        items.append({'filename': f.filename, 'path': path})
+    return items
+
+@jobs_bp.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Submits an asynchronous classification job.
+
+    Expected form data:
+    - images: multiple files, OR
+    - folder: path relative to DATASET_ROOT (read server-side)
+    - model_strategy: str (default: "standard")
+    - crop_mode: str (default: "integrated")
+    """
+    try:
+        model_strategy = request.form.get("model_strategy", "standard")
+        crop_mode = request.form.get("crop_mode", "integrated")
+        if model_strategy not in VALID_STRATEGIES:
+            return jsonify({'error': f"Invalid model_strategy: {model_strategy}"}), 400
+        if crop_mode not in VALID_CROP_MODES:
+            return jsonify({'error': f"Invalid crop_mode: {crop_mode}"}), 400
+
+        folder = request.form.get("folder")
+        if folder:
+            try:
+                items = list_folder_images(resolve_dataset_dir(folder))
+            except (ValueError, FileNotFoundError) as e:
+                return jsonify({'error': str(e)}), 400
+            source = f"folder:{folder}"
+        else:
+            files = request.files.getlist('images')
+            if not files:
+                return jsonify({'error': 'No images or folder provided'}), 400
+            items = spool_uploads(files)
+            source = "upload"
+
+        if not items:
+            return jsonify({'error': 'No images found'}), 400
+
+        params = {'model_strategy': model_strategy, 'crop_mode': crop_mode}
+        job_id = get_job_store().create_job(source, params, items)
+        return jsonify({'job_id': job_id, 'total': len(items), 'status': 'queued'}), 202
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@jobs_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    job = get_job_store().get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job['batch_tuner'] = get_batch_tuner_stats()
+    return jsonify(job)
+
+@jobs_bp.route('/jobs/<job_id>/results', methods=['GET'])
+def get_job_results(job_id):
+    """Pages through per-image results: ?offset=0&limit=100&status=done|failed"""
+    store = get_job_store()
+    if store.get_job(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(1000, max(1, request.args.get('limit', 100, type=int)))
+    status = request.args.get('status')
+    results = store.get_results(job_id, offset, limit, status)
+    return jsonify({'job_id': job_id, 'offset': offset, 'limit': limit, 'results': results})
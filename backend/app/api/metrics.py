@@ -0,0 +1,49 @@
+from flask import Blueprint, Response, jsonify
+
+from app.fun.memory_governor import GOVERNOR
+from app.fun.upload_spool import UPLOAD_SPOOL
+from app.fun.previews import PREVIEWS
+from app.fun.attribution_cache import ATTRIBUTION_CACHE
+from app.fun.dataset_export import _executor as export_executor
+from app.fun.telemetry import METRICS
+from app.fun import structured_log
+from app.api.detection import executor as detection_executor
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# Metriche lette dalle stats() esistenti al momento dello scrape
+CACHES = {'previews': PREVIEWS, 'attribution': ATTRIBUTION_CACHE}
+POOLS = {'detection': detection_executor, 'export': export_executor}
+
+METRICS.collect("orchitech_cache_hits_total", "Cache hits.",
+                lambda: {name: cache.stats()['hits'] for name, cache in CACHES.items()}, "counter", ("cache",))
+METRICS.collect("orchitech_cache_misses_total", "Cache misses.",
+                lambda: {name: cache.stats()['misses'] for name, cache in CACHES.items()}, "counter", ("cache",))
+METRICS.collect("orchitech_pool_queue_depth", "Tasks waiting for a thread in a shared pool.",
+                lambda: {name: pool._work_queue.qsize() for name, pool in POOLS.items()}, "gauge", ("pool",))
+METRICS.collect("orchitech_memory_rss_bytes", "Resident memory of the process.",
+                lambda: GOVERNOR.stats()['rss_bytes'])
+METRICS.collect("orchitech_memory_reserved_bytes", "Memory reserved by admitted work.",
+                lambda: GOVERNOR.stats()['reserved_bytes'])
+METRICS.collect("orchitech_memory_in_flight", "Jobs admitted by the memory governor and still running.",
+                lambda: GOVERNOR.stats()['in_flight'])
+METRICS.collect("orchitech_memory_admissions_total", "Memory governor decisions.",
+                lambda: {k: GOVERNOR.stats()[k] for k in ('admitted', 'waited', 'rejected')}, "counter", ("outcome",))
+METRICS.collect("orchitech_log_dropped_total", "Log records dropped because the log queue was full.",
+                lambda: structured_log.stats()['dropped'], "counter")
+METRICS.collect("orchitech_upload_spool_bytes", "Bytes of uploaded originals kept in the spool.",
+                lambda: UPLOAD_SPOOL.stats()['bytes'])
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Stage latencies, batch sizes, queue depths, cache hits and errors in the Prometheus text format."""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@metrics_bp.route('/metrics/memory', methods=['GET'])
+def get_memory_metrics():
+    """Current / peak RSS, limit and admission counters of the memory governor, plus the disk-backed stores."""
+    return jsonify({
+        **GOVERNOR.stats(),
+        'upload_spool': UPLOAD_SPOOL.stats(),
+        'previews': PREVIEWS.stats(),
+    })
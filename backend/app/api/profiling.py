@@ -0,0 +1,57 @@
+import hmac
+from flask import Blueprint, jsonify, request
+
+from app.fun.profiling import PROFILER, PROFILE_ADMIN_TOKEN
+
+profiling_bp = Blueprint('profiling', __name__)
+
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+
+def _authorized():
+    if PROFILE_ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), PROFILE_ADMIN_TOKEN)
+    return request.remote_addr in LOCAL_ADDRESSES
+
+def _flag(params, name):
+    return str(params.get(name, 'true')).lower() != 'false'
+
+@profiling_bp.route('/admin/profile', methods=['POST'])
+def start_profile():
+    """
+    Profiles live traffic, files under PROFILE_DIR/<session>/.
+    - requests: int, profile the next N requests (one at a time), or
+    - seconds: float, profile everything in a time window
+    - torch: 'true' | 'false' (default true), torch.profiler operator trace
+    - python: 'true' | 'false' (default true), cProfile of the request thread + stack sampling
+    - label: str, appended to the session folder name
+    """
+    if not _authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    params = request.get_json(silent=True) or request.form
+    try:
+        requests = int(params['requests']) if params.get('requests') else None
+        seconds = float(params['seconds']) if params.get('seconds') else None
+        label = ''.join(c for c in str(params.get('label', '')) if c.isalnum() or c in '-_')[:40]
+        session = PROFILER.arm(requests, seconds, _flag(params, 'torch'), _flag(params, 'python'), label)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({k: session[k] for k in ('id', 'dir', 'mode', 'remaining', 'seconds')}), 202
+
+@profiling_bp.route('/admin/profile', methods=['GET'])
+def get_profile_status():
+    if not _authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify(PROFILER.status())
+
+@profiling_bp.route('/admin/profile', methods=['DELETE'])
+def stop_profile():
+    """Ends the running session early; what was captured so far is written."""
+    if not _authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    session_id = PROFILER.disarm()
+    if session_id is None:
+        return jsonify({'error': 'No profiling session running'}), 404
+    return jsonify({'stopped': session_id})
@@ -1,86 +1,72 @@
-import os
 import json
-import io
-import zipfile
-from flask import Blueprint, request, send_file
-from PIL import Image
+from flask import Blueprint, Response, request, stream_with_context
+
+from app.fun.ingest import ingest_image
+from app.fun.dataset_export import export_entries, stream_zip
+from app.fun.upload_spool import UPLOAD_SPOOL
 
 save_bp = Blueprint('save_dataset', __name__)
 
 @save_bp.route('/save_dataset', methods=['POST'])
 def save_dataset():
+    """
+    metadata: [{filename, boxes, upload_id?}]. Images come either as `images_files`
+    uploads or, with `upload_session`, from the originals spooled by /dbinference
+    (upload_id). 410 + the missing filenames if some spooled originals expired:
+    the client then sends those files again.
+    """
+    pinned = False
+    upload_session = None
+
+    def release_session():
+        if pinned:
+            UPLOAD_SPOOL.unpin(upload_session)
+
     try:
         metadata = json.loads(request.form.get('metadata', '[]'))
         
         # Prendiamo i due valori base (es. 256 e 512)
         dim1 = request.form.get('resize_w')
         dim2 = request.form.get('resize_h')
+        target = (int(dim1), int(dim2)) if dim1 and dim2 else (None, None)
         folder_organized = request.form.get('folder_organized') == 'true'
+        upload_session = request.form.get('upload_session')
+        # Gli originali si aprono solo durante lo streaming: la sessione resta fissata
+        # (niente scadenza né sfratto) finché la risposta non è chiusa
+        pinned = bool(upload_session) and UPLOAD_SPOOL.pin(upload_session)
 
         uploaded_files = request.files.getlist('images_files')
         files_dict = {f.filename: f for f in uploaded_files}
 
-        memory_file = io.BytesIO()
-        
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for item in metadata:
-                filename = item['filename']
-                boxes = item['boxes']
-                
-                if filename not in files_dict:
+        items, missing = [], []
+        for item in metadata:
+            filename = item['filename']
+            if filename in files_dict:
+                open_image = lambda f=files_dict[filename]: ingest_image(f.stream)
+            elif item.get('upload_id') and upload_session:
+                path = UPLOAD_SPOOL.path(upload_session, item['upload_id'])
+                if path is None:
+                    missing.append(filename)
                     continue
-                
-                img = Image.open(files_dict[filename].stream).convert("RGB")
-                base_name = os.path.splitext(filename)[0]
-
-                for idx, box in enumerate(boxes):
-                    # 1. Ritaglio (xmin, ymin, xmax, ymax)
-                    crop = img.crop((int(box[0]), int(box[1]), int(box[2]), int(box[3])))
-                    c_w, c_h = crop.size
-
-                    # 2. Scelta intelligente del formato (Smart Resize)
-                    if dim1 and dim2:
-                        d1, d2 = int(dim1), int(dim2)
-                        
-                        # Definiamo i due orientamenti possibili
-                        # Formato A: (Larghezza x Altezza)
-                        # Formato B: (Altezza x Larghezza)
-                        target_a = (max(d1, d2), min(d1, d2)) # Landscape (es. 512x256)
-                        target_b = (min(d1, d2), max(d1, d2)) # Portrait  (es. 256x512)
-
-                        # Scegliamo il target che ha l'orientamento simile al crop
-                        if c_h > c_w:
-                            final_target = target_b # Crop verticale -> Target verticale
-                        else:
-                            final_target = target_a # Crop orizzontale -> Target orizzontale
-                        
-                        # Ridimensionamento mantenendo le proporzioni (Letterboxing)
-                        # Per non perdere informazioni, usiamo thumbnail + sfondo nero
-                        temp_crop = crop.copy()
-                        temp_crop.thumbnail(final_target, Image.Resampling.LANCZOS)
-                        
-                        final_img = Image.new("RGB", final_target, (0, 0, 0))
-                        paste_x = (final_target[0] - temp_crop.size[0]) // 2
-                        paste_y = (final_target[1] - temp_crop.size[1]) // 2
-                        final_img.paste(temp_crop, (paste_x, paste_y))
-                    else:
-                        final_img = crop
-
-                    # 3. Nome e salvataggio
-                    crop_name = f"{base_name}_{idx}.jpg"
-                    path_in_zip = os.path.join(base_name, crop_name) if folder_organized else crop_name
-
-                    buf = io.BytesIO()
-                    final_img.save(buf, format="JPEG", quality=90)
-                    zf.writestr(path_in_zip, buf.getvalue())
+                open_image = lambda p=path: ingest_image(p)
+            else:
+                continue
+            items.append({'filename': filename, 'boxes': item['boxes'], 'open': open_image})
+    except Exception as e:
+        release_session()
+        return {"error": str(e)}, 500
 
-        memory_file.seek(0)
-        return send_file(
-            memory_file,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='dataset.zip'
-        )
+    if missing:
+        release_session()
+        return {"error": "Uploaded originals expired, send the images again", "missing": missing}, 410
 
-    except Exception as e:
-        return {"error": str(e)}, 500
\ No newline at end of file
+    # Lo ZIP viene scritto nella risposta man mano che i ritagli sono pronti:
+    # la memoria resta costante qualunque sia la dimensione del dataset
+    response = Response(
+        stream_with_context(stream_zip(export_entries(items, target, folder_organized))),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=dataset.zip'}
+    )
+    # Chiamato anche se il client si disconnette prima della fine dello ZIP
+    response.call_on_close(release_session)
+    return response
@@ -1,3 +1,4 @@
+import threading
 import torch
 import torchvision
 import torchvision.transforms.functional as F
@@ -5,6 +6,8 @@ from PIL import Image
 from dotenv import dotenv_values
 import numpy as np
 
+from app.fun.telemetry import span, timed
+
 config = dotenv_values(".env")
 DETECTION_MODEL_PATH = config.get("DETECTION_MODEL_PATH", "app/models/detection_models/fasterrcnn_orchid3.pth")
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -24,43 +27,98 @@ def load_cropping_model():
         print(f"ERRORE CARICAMENTO MODELLO: {e}")
         return None
 
-DETECTOR = load_cropping_model()
+_detector = None
+_detector_loaded = False
+_detector_lock = threading.Lock()
+
+def get_detector():
+    """
+    Faster R-CNN, loaded on first use (create_app preloads it). Processes that import
+    this module without detecting, like the XAI workers that re-import app.main under
+    spawn, never load it. None if the weights could not be loaded.
+    """
+    global _detector, _detector_loaded
+    if not _detector_loaded:
+        with _detector_lock:
+            if not _detector_loaded:
+                _detector = load_cropping_model()
+                _detector_loaded = True
+    return _detector
+
+def crop_from_boxes(image: Image.Image, boxes):
+    """
+    Ritaglia l'immagine sulla prima box (la più affidabile) con un padding del 10%.
+    Se non ci sono box ritorna l'immagine originale.
+    """
+    if len(boxes) == 0:
+        return image
+
+    x_min, y_min, x_max, y_max = boxes[0]
 
+    # Aggiungiamo un padding del 10% per non tagliare troppo vicino ai petali
+    padding_w = int((x_max - x_min) * 0.10)
+    padding_h = int((y_max - y_min) * 0.10)
+
+    crop_coords = (
+        max(0, x_min - padding_w),
+        max(0, y_min - padding_h),
+        min(image.width, x_max + padding_w),
+        min(image.height, y_max + padding_h)
+    )
+    return image.crop(crop_coords)
+
+def _predictions_to_lists(predictions):
+    # Sposta i risultati su CPU e converti in tipi standard Python
+    scores = predictions['scores'].cpu().numpy().tolist()
+    boxes = predictions['boxes'].cpu().numpy().astype(int).tolist()
+    return boxes, scores
+
+@timed('detect')
 def crop(image: Image.Image):
     """
     Rileva tutti gli oggetti e ritaglia l'immagine basandosi sul migliore.
     Ritorna: (cropped_image, all_boxes_list, all_scores_list)
     """
-    if DETECTOR is None:
+    detector = get_detector()
+    if detector is None:
         return image, [], []
     
     # Prepara l'immagine per il modello
     img_tensor = F.to_tensor(image).unsqueeze(0).to(device)
 
     with torch.no_grad():
-        predictions = DETECTOR(img_tensor)[0]
+        predictions = detector(img_tensor)[0]
 
-    # Sposta i risultati su CPU e converti in tipi standard Python
-    scores = predictions['scores'].cpu().numpy().tolist()
-    boxes = predictions['boxes'].cpu().numpy().astype(int).tolist()
-    
-    cropped_img = image # Immagine originale come fallback
+    boxes, scores = _predictions_to_lists(predictions)
 
-    if len(boxes) > 0:
-        # Usiamo comunque la prima box (la più affidabile) per il ritaglio fisico
-        x_min, y_min, x_max, y_max = boxes[0]
-        
-        # Aggiungiamo un padding del 10% per non tagliare troppo vicino ai petali
-        padding_w = int((x_max - x_min) * 0.10)
-        padding_h = int((y_max - y_min) * 0.10)
-        
-        crop_coords = (
-            max(0, x_min - padding_w),
-            max(0, y_min - padding_h),
-            min(image.width, x_max + padding_w),
-            min(image.height, y_max + padding_h)
-        )
-        cropped_img = image.crop(crop_coords)
-        
     # RESTITUIAMO TUTTE LE BOX (non solo la prima)
-    return cropped_img, boxes, scores
\ No newline at end of file
+    return crop_from_boxes(image, boxes), boxes, scores
+
+def detect_batch(images):
+    """
+    Solo rilevamento, senza ritaglio: un forward del detector per una lista di immagini.
+    Ritorna una lista di tuple (all_boxes_list, all_scores_list).
+    """
+    detector = get_detector()
+    if detector is None:
+        return [([], []) for _ in images]
+    if not images:
+        return []
+
+    with span('detect', batch=len(images)):
+        img_tensors = [F.to_tensor(image).to(device) for image in images]
+        with torch.no_grad():
+            predictions = detector(img_tensors)
+
+    return [_predictions_to_lists(prediction) for prediction in predictions]
+
+def crop_batch(images):
+    """
+    Versione batch di crop: un solo forward del detector per una lista di immagini
+    (anche di dimensioni diverse, Faster R-CNN accetta una lista di tensori).
+    Ritorna una lista di tuple (cropped_image, all_boxes_list, all_scores_list).
+    """
+    return [
+        (crop_from_boxes(image, boxes), boxes, scores)
+        for image, (boxes, scores) in zip(images, detect_batch(images))
+    ]
@@ -0,0 +1,44 @@
+"""
+Processes a dataset folder in-process, without going through HTTP.
+
+Usage (from the backend folder / container workdir):
+    python -m app.folder_runner <folder relative to DATASET_ROOT> [--mode both] [--save-crops]
+"""
+import argparse
+import json
+
+from app import model_state
+from app.fun.model_loader import load_resources
+from app.model_fun.preprocess_data import getTransforms
+from app.fun.folder_ingest import run_folder, VALID_MODES
+from app.fun.job_worker import WIDTH, HEIGHT, MEAN, STD
+from app.fun.structured_log import setup_logging
+
+def main():
+    parser = argparse.ArgumentParser(description="Server-side folder ingestion")
+    parser.add_argument("folder", help="Folder relative to DATASET_ROOT")
+    parser.add_argument("--mode", choices=sorted(VALID_MODES), default="both")
+    parser.add_argument("--model-strategy", choices=["standard", "1vsall"], default="standard")
+    parser.add_argument("--crop-mode", choices=["integrated", "external", "compare"], default="integrated")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--output", choices=["test_results", "alongside"], default="test_results")
+    parser.add_argument("--save-crops", action="store_true")
+    parser.add_argument("--min-score", type=float, default=0.0)
+    args = parser.parse_args()
+    # Avanzamento di run_folder sul logger strutturato
+    setup_logging()
+
+    model_state.load_and_set_models(load_resources())
+    model, onevall_models, device, CLASS_NAMES = model_state.get_models()
+
+    params = {'mode': args.mode, 'model_strategy': args.model_strategy, 'crop_mode': args.crop_mode}
+    summary = run_folder(
+        args.folder, params, model, onevall_models, device, CLASS_NAMES,
+        getTransforms(WIDTH, HEIGHT, True, MEAN, STD),
+        batch_size=args.batch_size, output=args.output,
+        save_crops=args.save_crops, min_score=args.min_score
+    )
+    print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import torch
+from dotenv import dotenv_values
+
+from app.fun.attribution_engine import ENGINE, PeakMemorySampler
+
+config = dotenv_values(".env")
+
+# Sweep grossolano su tutta l'immagine, poi raffinamento solo nelle zone salienti
+COARSE_WINDOW = int(config.get("OCCLUSION_COARSE_WINDOW", 64))
+COARSE_STRIDE = int(config.get("OCCLUSION_COARSE_STRIDE", 48))
+FINE_WINDOW = int(config.get("OCCLUSION_FINE_WINDOW", 24))
+FINE_STRIDE = int(config.get("OCCLUSION_FINE_STRIDE", 12))
+# Si raffinano le finestre grossolane con |attribuzione| >= REFINE_THRESHOLD * il massimo
+REFINE_THRESHOLD = float(config.get("OCCLUSION_REFINE_THRESHOLD", 0.5))
+OCCLUSION_MAX_PASSES = int(config.get("OCCLUSION_MAX_PASSES", 400))
+OCCLUSION_TIME_BUDGET = float(config.get("OCCLUSION_TIME_BUDGET", 3.0))
+
+Window = Tuple[int, int, int, int]  # (y0, x0, height, width)
+
+
+def grid_windows(height: int, width: int, window: int, stride: int,
+                 region: Optional[Tuple[int, int, int, int]] = None) -> List[Window]:
+    """Sliding windows covering the image (or only `region` = (y0, x0, y1, x1)), edges included."""
+    y_lo, x_lo, y_hi, x_hi = region if region else (0, 0, height, width)
+    ys = list(range(y_lo, max(y_lo, y_hi - window) + 1, stride))
+    xs = list(range(x_lo, max(x_lo, x_hi - window) + 1, stride))
+    # Ultima finestra allineata al bordo, così nessun pixel resta scoperto
+    if ys[-1] + window < y_hi:
+        ys.append(max(y_lo, y_hi - window))
+    if xs[-1] + window < x_hi:
+        xs.append(max(x_lo, x_hi - window))
+    return [(y, x, min(window, height - y), min(window, width - x)) for y in ys for x in xs]
+
+
+def occluded_outputs(model, input_tensor: torch.Tensor, windows: List[Window], batch_size: int,
+                     baseline: float = 0.0, deadline: Optional[float] = None) -> torch.Tensor:
+    """
+    Model outputs (N, num_classes) with each window replaced by `baseline`, evaluated
+    `batch_size` windows per forward pass. Stops early at `deadline` (perf_counter time):
+    the returned tensor then has fewer rows than `windows`.
+    """
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, len(windows), batch_size):
+            if deadline is not None and outputs and time.perf_counter() > deadline:
+                break
+            chunk = windows[start:start + batch_size]
+            batch = input_tensor.repeat(len(chunk), 1, 1, 1)
+            for i, (y, x, h, w) in enumerate(chunk):
+                batch[i, :, y:y + h, x:x + w] = baseline
+            outputs.append(model(batch).detach().cpu())
+    if not outputs:
+        return torch.empty((0, 0))
+    return torch.cat(outputs)
+
+
+def accumulate_map(height: int, width: int, windows: List[Window], values: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Spreads per-window values (N, ...) over the pixels they cover and averages overlaps,
+    like captum's Occlusion. Returns (map (..., H, W), coverage count (H, W)).
+    """
+    extra = tuple(values.shape[1:])
+    total = torch.zeros(extra + (height, width))
+    count = torch.zeros((height, width))
+    for (y, x, h, w), value in zip(windows, values):
+        total[..., y:y + h, x:x + w] += value.reshape(extra + (1, 1)) if extra else value
+        count[y:y + h, x:x + w] += 1
+    return total / count.clamp(min=1), count
+
+
+def select_salient(deltas: torch.Tensor, threshold: float = REFINE_THRESHOLD) -> List[int]:
+    """Indices of the windows whose |delta| is at least `threshold` x the largest one, largest first."""
+    magnitude = deltas.abs()
+    peak = float(magnitude.max()) if magnitude.numel() else 0.0
+    if peak <= 0:
+        return []
+    order = torch.argsort(magnitude, descending=True).tolist()
+    return [i for i in order if magnitude[i] >= threshold * peak]
+
+
+def match_scale(fine: torch.Tensor, coarse: torch.Tensor) -> torch.Tensor:
+    """
+    Brings fine-window deltas to the scale of the coarse window they refine: occluding
+    a smaller window lowers the score less, so raw fine values would read as less
+    salient than untouched coarse background. Multiplicative (keeps zero at zero) when
+    the two means agree in sign, otherwise a shift; either way the means then match.
+    """
+    fine_mean = fine.mean()
+    coarse_mean = coarse.mean()
+    if fine_mean.abs() > 1e-8 and torch.sign(fine_mean) == torch.sign(coarse_mean):
+        return fine * (coarse_mean / fine_mean)
+    return fine + (coarse_mean - fine_mean)
+
+
+def adaptive_occlusion(model, input_tensor: torch.Tensor, target: int, max_passes: int = OCCLUSION_MAX_PASSES,
+                       time_budget: float = OCCLUSION_TIME_BUDGET, baseline: float = 0.0) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """
+    Progressive occlusion for one (1, C, H, W) input:
+    1. coarse sweep with large windows over the whole frame;
+    2. finer sweep only inside the coarse windows with high attribution magnitude
+       (select_salient), most salient first, until the forward-pass or time budget is spent.
+    Returns (attributions shaped like the input, stats). Pixels refined by the fine
+    sweep take the fine value rescaled to their coarse window (match_scale), the rest
+    keep the coarse value.
+    """
+    model.eval()
+    _, channels, height, width = input_tensor.shape
+    batch_size = ENGINE.occlusion_batch_size() if ENGINE.calibrated else 8
+    start = time.perf_counter()
+    deadline = start + time_budget
+
+    with PeakMemorySampler(input_tensor.device) as sampler:
+        with torch.no_grad():
+            base_score = model(input_tensor).detach().cpu()[0, target]
+
+        # 1. Coarse sweep (always completed: it is the fallback for every pixel)
+        coarse_windows = grid_windows(height, width, COARSE_WINDOW, COARSE_STRIDE)
+        coarse_scores = occluded_outputs(model, input_tensor, coarse_windows, batch_size, baseline)[:, target]
+        coarse_delta = base_score - coarse_scores
+        coarse_map, _ = accumulate_map(height, width, coarse_windows, coarse_delta)
+        passes = len(coarse_windows)
+
+        # 2. Refinement inside the salient coarse windows, ordered by saliency
+        to_refine = select_salient(coarse_delta)
+        fine_windows: List[Window] = []
+        seen = set()
+        for idx in to_refine:
+            y, x, h, w = coarse_windows[idx]
+            for win in grid_windows(height, width, FINE_WINDOW, FINE_STRIDE, (y, x, y + h, x + w)):
+                if win not in seen:
+                    seen.add(win)
+                    fine_windows.append(win)
+
+        fine_windows = fine_windows[:max(0, max_passes - passes)]
+        fine_scores = occluded_outputs(model, input_tensor, fine_windows, batch_size, baseline, deadline)
+        evaluated = fine_windows[:fine_scores.shape[0]]
+        passes += len(evaluated)
+
+        final_map = coarse_map
+        if evaluated:
+            fine_map, fine_count = accumulate_map(height, width, evaluated, base_score - fine_scores[:, target])
+            # Ogni finestra raffinata riporta i valori fini alla propria scala; dove più
+            # finestre grossolane si sovrappongono si fa la media
+            total = torch.zeros((height, width))
+            weight = torch.zeros((height, width))
+            for idx in to_refine:
+                y, x, h, w = coarse_windows[idx]
+                covered = fine_count[y:y + h, x:x + w] > 0
+                if not covered.any():
+                    continue
+                fine_cell = fine_map[y:y + h, x:x + w]
+                scaled = match_scale(fine_cell[covered], coarse_map[y:y + h, x:x + w][covered])
+                total[y:y + h, x:x + w][covered] += scaled
+                weight[y:y + h, x:x + w][covered] += 1
+            final_map = torch.where(weight > 0, total / weight.clamp(min=1), coarse_map)
+
+    attributions = final_map.unsqueeze(0).unsqueeze(0).expand(1, channels, height, width).clone()
+    stats = ENGINE.record('occlusion_adaptive', {
+        'seconds': time.perf_counter() - start,
+        'peak_memory_bytes': sampler.peak_delta,
+        'forward_passes': passes,
+        'coarse_passes': len(coarse_windows),
+        'fine_passes': len(evaluated),
+        'fine_planned': len(fine_windows),
+        'budget_exhausted': len(evaluated) < len(seen),
+    })
+    return attributions, stats
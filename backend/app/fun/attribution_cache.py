@@ -0,0 +1,136 @@
+import hashlib
+import threading
+import weakref
+import collections
+from typing import Any, Callable, Dict, Optional, Tuple
+import torch
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+
+# Memoria massima per le attribuzioni in cache (float16)
+XAI_CACHE_MAX_MB = float(config.get("XAI_CACHE_MAX_MB", 256))
+
+# Fingerprint dei pesi calcolato una volta per oggetto modello
+_fingerprints = weakref.WeakKeyDictionary()
+_fingerprint_lock = threading.Lock()
+
+
+def model_fingerprint(model) -> str:
+    """Hash of the model weights: a reloaded or retrained model never hits stale entries."""
+    with _fingerprint_lock:
+        fingerprint = _fingerprints.get(model)
+        if fingerprint is None:
+            digest = hashlib.blake2b(digest_size=12)
+            for name, tensor in model.state_dict().items():
+                digest.update(name.encode())
+                digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+            fingerprint = digest.hexdigest()
+            _fingerprints[model] = fingerprint
+        return fingerprint
+
+def input_digest(input_tensor: torch.Tensor) -> str:
+    """Hash of the preprocessed input: the same upload and view (original / crop) give the same digest."""
+    return hashlib.blake2b(input_tensor.detach().cpu().contiguous().numpy().tobytes(), digest_size=16).hexdigest()
+
+def attribution_key(model, input_tensor: torch.Tensor, method: str, target: Optional[int] = None,
+                    params: Optional[Dict[str, Any]] = None) -> Tuple:
+    """(input digest, target, method, params, model fingerprint); target None for all-class maps."""
+    return (
+        input_digest(input_tensor),
+        target,
+        method,
+        tuple(sorted((params or {}).items())),
+        model_fingerprint(model),
+    )
+
+
+class AttributionCache:
+    """
+    Bounded LRU of raw attribution tensors, kept as float16 and returned as float32.
+    Concurrent requests for the same key wait for the first computation instead of
+    repeating it.
+    """
+
+    def __init__(self, max_bytes: int = int(XAI_CACHE_MAX_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.in_flight: Dict[Tuple, threading.Event] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple, count_miss: bool = False) -> Optional[torch.Tensor]:
+        """
+        Hits are always counted; count_miss=True for callers that compute misses
+        themselves (get_or_compute counts its own, once per computation).
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return value.float()
+
+    def put(self, key: Tuple, value: torch.Tensor):
+        stored = value.detach().cpu().to(torch.float16).contiguous()
+        size = stored.numel() * stored.element_size()
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self._size(self.entries.pop(key))
+            self.entries[key] = stored
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= self._size(evicted)
+                self.evictions += 1
+
+    def get_or_compute(self, key: Tuple, compute: Callable[[], torch.Tensor]) -> torch.Tensor:
+        while True:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            with self.lock:
+                waiting = self.in_flight.get(key)
+                if waiting is None:
+                    self.in_flight[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Un'altra richiesta sta calcolando la stessa attribuzione: si aspetta il suo risultato
+            waiting.wait()
+
+        try:
+            value = compute()
+            self.put(key, value)
+            return value
+        finally:
+            with self.lock:
+                self.in_flight.pop(key).set()
+
+    @staticmethod
+    def _size(value: torch.Tensor) -> int:
+        return value.numel() * value.element_size()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'in_flight': len(self.in_flight),
+            }
+
+
+ATTRIBUTION_CACHE = AttributionCache()
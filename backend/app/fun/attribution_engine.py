@@ -0,0 +1,238 @@
+import os
+import time
+import threading
+import collections
+from typing import Any, Dict, Optional, Tuple
+import torch
+from dotenv import dotenv_values
+from captum.attr import IntegratedGradients
+
+from app.fun.structured_log import get_logger, fields
+
+log = get_logger("xai")
+
+config = dotenv_values(".env")
+
+# Frazione della memoria disponibile che le spiegazioni possono usare
+XAI_MEMORY_FRACTION = float(config.get("XAI_MEMORY_FRACTION", 0.5))
+# Tempo massimo (secondi) concesso a una spiegazione IG per scegliere n_steps
+XAI_TIME_BUDGET = float(config.get("XAI_TIME_BUDGET", 5.0))
+IG_MIN_STEPS = int(config.get("IG_MIN_STEPS", 10))
+IG_MAX_STEPS = int(config.get("IG_MAX_STEPS", 64))
+XAI_MAX_BATCH = int(config.get("XAI_MAX_BATCH", 64))
+
+
+# --- MEMORY PROBES ---
+
+def _read_int(path) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == "max" else int(value)
+    except (OSError, ValueError):
+        return None
+
+def available_memory_bytes(device) -> int:
+    """Free memory for the device: CUDA free memory, or the tighter of cgroup limit and MemAvailable."""
+    if getattr(device, 'type', str(device)) == 'cuda':
+        free, _ = torch.cuda.mem_get_info()
+        return int(free)
+
+    candidates = []
+    # cgroup v2, poi v1 (container Docker)
+    limit, usage = _read_int("/sys/fs/cgroup/memory.max"), _read_int("/sys/fs/cgroup/memory.current")
+    if limit is None:
+        limit, usage = _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes"), _read_int("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if limit is not None and usage is not None and limit < (1 << 60):
+        candidates.append(limit - usage)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    candidates.append(int(line.split()[1]) * 1024)
+                    break
+    except OSError:
+        pass
+    return max(0, min(candidates)) if candidates else 2 * 1024 ** 3
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class PeakMemorySampler:
+    """Measures the peak memory increase of a block: CUDA peak stats, or RSS sampled on a thread."""
+
+    def __init__(self, device, interval: float = 0.005):
+        self.cuda = getattr(device, 'type', str(device)) == 'cuda'
+        self.interval = interval
+        self.peak = 0
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+            self.baseline = torch.cuda.memory_allocated()
+            return self
+        self.baseline = current_rss_bytes()
+        self.peak = self.baseline
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            self.peak = torch.cuda.max_memory_allocated()
+        else:
+            self.stop.set()
+            self.thread.join()
+            self.peak = max(self.peak, current_rss_bytes())
+        return False
+
+    @property
+    def peak_delta(self) -> int:
+        return max(0, self.peak - self.baseline)
+
+
+# --- ENGINE ---
+
+class AttributionEngine:
+    """
+    Picks internal batch sizes for IG steps and occlusion windows from the memory
+    actually available and the measured activation cost of one sample, and the
+    number of IG steps that fits in XAI_TIME_BUDGET.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calibrated = False
+        self.backward_bytes_per_sample = 0
+        self.forward_bytes_per_sample = 0
+        self.step_seconds = 0.0
+        self.forward_seconds = 0.0
+        self.available_bytes = 0
+        self.device = 'cpu'
+        self.history = collections.deque(maxlen=100)
+
+    def calibrate(self, model, input_shape: Tuple[int, ...], device):
+        """Runs one forward(+backward) pass with hooks to measure activation memory and step time."""
+        model.eval()
+        activation_bytes = []
+        largest = [0]
+
+        def hook(_, __, output):
+            if isinstance(output, torch.Tensor):
+                size = output.numel() * output.element_size()
+                activation_bytes.append(size)
+                largest[0] = max(largest[0], size)
+
+        # Warm-up: the first pass pays one-off allocation/kernel selection costs
+        with torch.no_grad():
+            model(torch.zeros((1,) + tuple(input_shape[1:]), device=device))
+
+        handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+        try:
+            sample = torch.zeros((1,) + tuple(input_shape[1:]), device=device, requires_grad=True)
+            start = time.perf_counter()
+            output = model(sample)
+            output[0, 0].backward()
+            self.step_seconds = time.perf_counter() - start
+        finally:
+            for h in handles:
+                h.remove()
+            model.zero_grad(set_to_none=True)
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            model(torch.zeros((1,) + tuple(input_shape[1:]), device=device))
+            self.forward_seconds = time.perf_counter() - start
+
+        # Backward keeps every activation plus its gradient; forward-only needs a few live layers
+        self.backward_bytes_per_sample = 2 * sum(activation_bytes)
+        self.forward_bytes_per_sample = 3 * largest[0]
+        self.device = device
+        self.available_bytes = available_memory_bytes(device)
+        self.calibrated = True
+        log.info("attribution engine calibrated", extra=fields(
+            backward_mb_per_sample=round(self.backward_bytes_per_sample / 1e6, 1),
+            forward_mb_per_sample=round(self.forward_bytes_per_sample / 1e6, 1),
+            step_ms=round(self.step_seconds * 1000, 1),
+            available_mb=round(self.available_bytes / 1e6),
+            ig_batch=self.ig_batch_size(),
+            occlusion_batch=self.occlusion_batch_size(),
+        ))
+
+    def _ensure_calibrated(self, model, input_tensor):
+        if not self.calibrated:
+            with self.lock:
+                if not self.calibrated:
+                    self.calibrate(model, tuple(input_tensor.shape), input_tensor.device)
+
+    def _batch_for(self, bytes_per_sample: int) -> int:
+        if bytes_per_sample <= 0:
+            return 1
+        # La memoria disponibile viene riletta: altre richieste possono averla occupata
+        self.available_bytes = available_memory_bytes(self.device)
+        budget = XAI_MEMORY_FRACTION * self.available_bytes
+        return int(max(1, min(XAI_MAX_BATCH, budget // bytes_per_sample)))
+
+    def ig_batch_size(self) -> int:
+        return self._batch_for(self.backward_bytes_per_sample)
+
+    def occlusion_batch_size(self) -> int:
+        return self._batch_for(self.forward_bytes_per_sample)
+
+    def ig_steps(self, time_budget: float = XAI_TIME_BUDGET) -> int:
+        if self.step_seconds <= 0:
+            return IG_MIN_STEPS
+        # Batching amortizes per-pass overhead; step_seconds is the batch-1 worst case
+        steps = int(time_budget / self.step_seconds)
+        return max(IG_MIN_STEPS, min(IG_MAX_STEPS, steps))
+
+    def record(self, method: str, stats: Dict[str, Any]):
+        stats = {'method': method, **stats}
+        self.history.append(stats)
+        log.debug("attribution", extra=fields(**stats))
+        return stats
+
+    def integrated_gradients(self, model, input_tensor, target, n_steps: Optional[int] = None,
+                             time_budget: float = XAI_TIME_BUDGET):
+        """Returns (attributions, stats)."""
+        self._ensure_calibrated(model, input_tensor)
+        n_steps = n_steps or self.ig_steps(time_budget)
+        batch = min(self.ig_batch_size(), n_steps)
+        start = time.perf_counter()
+        with PeakMemorySampler(input_tensor.device) as sampler:
+            attributions = IntegratedGradients(model).attribute(
+                input_tensor, target=target, n_steps=n_steps, internal_batch_size=batch
+            )
+        stats = self.record('integrated_gradients', {
+            'seconds': time.perf_counter() - start,
+            'peak_memory_bytes': sampler.peak_delta,
+            'n_steps': n_steps,
+            'internal_batch_size': batch,
+        })
+        return attributions, stats
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            'calibrated': self.calibrated,
+            'available_bytes': self.available_bytes,
+            'backward_bytes_per_sample': self.backward_bytes_per_sample,
+            'forward_bytes_per_sample': self.forward_bytes_per_sample,
+            'step_seconds': self.step_seconds,
+            'ig_batch_size': self.ig_batch_size() if self.calibrated else None,
+            'occlusion_batch_size': self.occlusion_batch_size() if self.calibrated else None,
+            'ig_steps': self.ig_steps() if self.calibrated else None,
+            'recent': list(self.history)[-10:],
+        }
+
+
+ENGINE = AttributionEngine()
@@ -0,0 +1,232 @@
+from typing import List, Dict, Any
+import torch
+from PIL import Image
+from dotenv import dotenv_values
+
+from app.fun.tta_logic import perform_batch_inference
+from app.fun.pipeline import Stage, StagePipeline
+from app.fun.explainability_fun import encode_image, render_gradcam, raw_heatmap, MEAN, STD
+from app.fun.gradcam import cached_gradcam, GRADCAM_METHODS
+from app.fun.response_fields import filter_result, BATCH_DEFAULT_FIELDS
+from app.fun.ingest import ingest_image, boxes_to_original
+from app.fun.telemetry import span
+from app.fun.structured_log import get_logger, fields
+
+try:
+    from app.cropping_fun.fasterrcnn_crop import crop_batch
+    HAS_EXTERNAL_CROP = True
+except ImportError:
+    HAS_EXTERNAL_CROP = False
+
+log = get_logger("pipeline")
+
+config = dotenv_values(".env")
+
+# Worker e dimensione dei batch per ogni stage della pipeline detect -> classify
+PIPELINE_DECODE_WORKERS = int(config.get("PIPELINE_DECODE_WORKERS", 4))
+PIPELINE_DETECT_BATCH = int(config.get("PIPELINE_DETECT_BATCH", 4))
+PIPELINE_TRANSFORM_WORKERS = int(config.get("PIPELINE_TRANSFORM_WORKERS", 2))
+PIPELINE_CLASSIFY_BATCH = int(config.get("PIPELINE_CLASSIFY_BATCH", 16))
+PIPELINE_ENCODE_WORKERS = int(config.get("PIPELINE_ENCODE_WORKERS", 2))
+PIPELINE_QUEUE_SIZE = int(config.get("PIPELINE_QUEUE_SIZE", 8))
+
+
+def _class_name(CLASS_NAMES, idx):
+    return CLASS_NAMES[idx] if idx != -1 else "Unknown"
+
+def classify_images(images: List[Image.Image], model, onevall_models, device, CLASS_NAMES,
+                    transform_pipeline, model_strategy: str, crop_mode: str) -> List[Dict[str, Any]]:
+    """
+    Classifies a list of already decoded RGB images with batched detection and a
+    single stacked forward pass per strategy. No explainability is computed here.
+
+    Returns one result dict per image, with the same keys used by
+    process_single_image (minus the XAI and base64 fields).
+    """
+    if not images:
+        return []
+
+    # 1. Detection (one detector call for the whole batch)
+    crops = [None] * len(images)
+    boxes = [[] for _ in images]
+    scores = [[] for _ in images]
+    crop_error = None
+    if crop_mode in ['external', 'compare'] and HAS_EXTERNAL_CROP:
+        try:
+            for i, (cropped, img_boxes, img_scores) in enumerate(crop_batch(images)):
+                crops[i] = cropped
+                boxes[i] = img_boxes
+                scores[i] = img_scores
+        except Exception as e:
+            crop_error = f"Cropping failed: {str(e)}"
+
+    # 2. Tensors: primary view for every image, plus the cropped view in compare mode
+    primary_images = [
+        crops[i] if (crop_mode == "external" and crops[i] is not None) else img
+        for i, img in enumerate(images)
+    ]
+    with span('transform', batch=len(primary_images)):
+        primary_batch = torch.stack([transform_pipeline(img) for img in primary_images]).to(device)
+    primary_rows = perform_batch_inference(model, onevall_models, primary_batch, model_strategy, device)
+
+    secondary_rows = None
+    if crop_mode == "compare" and all(c is not None for c in crops):
+        with span('transform', batch=len(crops)):
+            secondary_batch = torch.stack([transform_pipeline(c) for c in crops]).to(device)
+        secondary_rows = perform_batch_inference(model, onevall_models, secondary_batch, model_strategy, device)
+
+    # 3. Build results
+    results = []
+    for i, (idx, conf, probs, err) in enumerate(primary_rows):
+        result = {
+            'success': True,
+            'predicted_class': _class_name(CLASS_NAMES, idx),
+            'confidence': conf,
+            'all_classes_probs': probs,
+            'boxes': boxes[i],
+            'scores': scores[i],
+            'error': err or crop_error,
+        }
+        if secondary_rows is not None:
+            sec_idx, sec_conf, sec_probs, _ = secondary_rows[i]
+            result.update({
+                'predicted_class_cropped': _class_name(CLASS_NAMES, sec_idx),
+                'confidence_cropped': sec_conf,
+                'all_classes_probs_cropped': sec_probs,
+            })
+        results.append(result)
+
+    return results
+
+
+# --- STAGE-PIPELINED EXECUTOR ---
+
+def build_classification_pipeline(model, onevall_models, device, CLASS_NAMES, transform_pipeline,
+                                  model_strategy: str, crop_mode: str, decode_workers: int = PIPELINE_DECODE_WORKERS,
+                                  fields=BATCH_DEFAULT_FIELDS, explain_method: str = "none",
+                                  xai_format: str = "image") -> StagePipeline:
+    """
+    decode -> detect -> crop/transform -> classify -> encode, each stage with its own
+    workers and a bounded queue in front of it. Inputs are raw bytes or file-like
+    objects; every output is a result dict shaped like process_single_image's,
+    restricted to the requested `fields`.
+    explain_method: 'none', or 'gradcam' / 'gradcam++' computed on the classify batch
+    (the other methods cost hundreds of passes per image and stay single-image only).
+    xai_format: 'image' for rendered heatmaps, 'raw' for layer-resolution maps (see raw_heatmap).
+    """
+    use_detector = crop_mode in ['external', 'compare'] and HAS_EXTERNAL_CROP
+    explain = explain_method in GRADCAM_METHODS and 'explanations' in fields
+    raw = xai_format == 'raw'
+
+    def decode(payloads):
+        states = []
+        for data in payloads:
+            ingested = ingest_image(data if isinstance(data, bytes) else data.read())
+            states.append({'image': ingested['image'], 'scale': ingested['scale'], 'crop_error': None})
+        return states
+
+    def detect(states):
+        if not use_detector:
+            return states
+        try:
+            for state, (cropped, boxes, scores) in zip(states, crop_batch([s['image'] for s in states])):
+                state.update({'image_cropped': cropped, 'boxes': boxes, 'scores': scores})
+        except Exception as e:
+            for state in states:
+                state['crop_error'] = f"Cropping failed: {str(e)}"
+        return states
+
+    def transform(states):
+        with span('transform', batch=len(states)):
+            return _transform(states)
+
+    def _transform(states):
+        for state in states:
+            state['tensor_original'] = transform_pipeline(state['image'])
+            cropped = state.get('image_cropped')
+            state['tensor_cropped'] = transform_pipeline(cropped) if cropped is not None else None
+        return states
+
+    def classify(states):
+        primary = [
+            s['tensor_cropped'] if (crop_mode == "external" and s['tensor_cropped'] is not None) else s['tensor_original']
+            for s in states
+        ]
+        primary_batch = torch.stack(primary).to(device)
+        for state, row in zip(states, perform_batch_inference(model, onevall_models, primary_batch, model_strategy, device)):
+            state['primary'] = row
+        if explain:
+            _explain(primary_batch, states, 'primary', 'gradcam')
+
+        if crop_mode == "compare":
+            with_crop = [s for s in states if s['tensor_cropped'] is not None]
+            if with_crop:
+                batch = torch.stack([s['tensor_cropped'] for s in with_crop]).to(device)
+                for state, row in zip(with_crop, perform_batch_inference(model, onevall_models, batch, model_strategy, device)):
+                    state['secondary'] = row
+                if explain:
+                    _explain(batch, with_crop, 'secondary', 'gradcam_cropped')
+        return states
+
+    def _explain(batch, states, row_key, out_key):
+        # Explanations always use the 6-class model, for the class each image was assigned.
+        # Only the maps are computed here, on the model's batch; rendering happens in encode.
+        targets = [s[row_key][0] for s in states]
+        try:
+            with span(f"xai_{explain_method}", batch=len(states)):
+                cams = cached_gradcam(model, batch, targets, plus_plus=GRADCAM_METHODS[explain_method], upsample=not raw)
+        except Exception as e:
+            log.warning("batch gradcam failed", extra=fields(method=explain_method, batch=len(states), error=str(e)))
+            return
+        for i, (state, cam) in enumerate(zip(states, cams)):
+            if cam is not None:
+                state[out_key] = (cam, batch[i:i + 1].cpu())
+
+    def _render(state, key):
+        if state.get(key) is None:
+            return None
+        cam, tensor = state[key]
+        if raw:
+            return raw_heatmap(cam.numpy(), "positive")
+        return render_gradcam(cam, tensor, MEAN, STD, plus_plus=GRADCAM_METHODS[explain_method])
+
+    def encode(states):
+        results = []
+        for state in states:
+            idx, conf, probs, err = state['primary']
+            result = {
+                'success': True,
+                'predicted_class': _class_name(CLASS_NAMES, idx),
+                'confidence': conf,
+                'all_classes_probs': probs,
+                'occlusion': None,
+                'integrated_gradients': None,
+                'gradcam': _render(state, 'gradcam'),
+                'error': err or state['crop_error'],
+                'boxes': boxes_to_original(state.get('boxes', []), state['scale']),
+                'scores': state.get('scores', []),
+            }
+            if state.get('image_cropped') is not None and 'crop_preview' in fields:
+                result['image_cropped'] = encode_image(state['image_cropped'])
+            if 'image' in fields:
+                result['image'] = encode_image(state['image'])
+            if state.get('secondary') is not None:
+                sec_idx, sec_conf, sec_probs, _ = state['secondary']
+                result.update({
+                    'predicted_class_cropped': _class_name(CLASS_NAMES, sec_idx),
+                    'confidence_cropped': sec_conf,
+                    'all_classes_probs_cropped': sec_probs,
+                    'occlusion_cropped': None,
+                    'integrated_gradients_cropped': None,
+                    'gradcam_cropped': _render(state, 'gradcam_cropped'),
+                })
+            results.append(filter_result(result, fields))
+        return results
+
+    return StagePipeline([
+        Stage('decode', decode, workers=decode_workers, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage('detect', detect, workers=1, batch_size=PIPELINE_DETECT_BATCH, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage('transform', transform, workers=PIPELINE_TRANSFORM_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage('classify', classify, workers=1, batch_size=PIPELINE_CLASSIFY_BATCH, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage('encode', encode, workers=PIPELINE_ENCODE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+    ])
@@ -0,0 +1,136 @@
+import io
+import os
+import time
+import zipfile
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from PIL import Image
+from dotenv import dotenv_values
+
+from app.fun.ingest import box_to_image
+from app.fun.telemetry import timed
+from app.fun.structured_log import get_logger, fields
+
+log = get_logger("export")
+
+config = dotenv_values(".env")
+
+# Thread per ritaglio / resize / encoding: Pillow rilascia il GIL in queste operazioni
+EXPORT_WORKERS = int(config.get("EXPORT_WORKERS", os.cpu_count() or 4))
+# Ritagli in volo al massimo: limita la memoria indipendentemente dalla dimensione del dataset
+EXPORT_MAX_IN_FLIGHT = int(config.get("EXPORT_MAX_IN_FLIGHT", EXPORT_WORKERS * 4))
+EXPORT_JPEG_QUALITY = 90
+
+# Pool condiviso tra gli export: il numero di thread resta fisso anche con più download insieme
+_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+
+def target_size(crop_size: Tuple[int, int], dim1: Optional[int], dim2: Optional[int]) -> Optional[Tuple[int, int]]:
+    """(w, h) to letterbox a crop into: (dim1, dim2) in the crop's own orientation, None to keep the crop as is."""
+    if not (dim1 and dim2):
+        return None
+    c_w, c_h = crop_size
+    # Crop verticale -> target verticale (es. 256x512), altrimenti orizzontale (512x256)
+    if c_h > c_w:
+        return (min(dim1, dim2), max(dim1, dim2))
+    return (max(dim1, dim2), min(dim1, dim2))
+
+@timed('export_crop')
+def encode_crop(image: Image.Image, box, target: Tuple[Optional[int], Optional[int]]) -> bytes:
+    """Crop (xmin, ymin, xmax, ymax), letterbox on black keeping proportions, encode as JPEG."""
+    crop = image.crop((int(box[0]), int(box[1]), int(box[2]), int(box[3])))
+    final_target = target_size(crop.size, *target)
+    if final_target is not None:
+        # reducing_gap: riduzione intera prima del LANCZOS, stesso risultato visivo a costo molto minore
+        crop.thumbnail(final_target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        final_img = Image.new("RGB", final_target, (0, 0, 0))
+        final_img.paste(crop, ((final_target[0] - crop.size[0]) // 2, (final_target[1] - crop.size[1]) // 2))
+    else:
+        final_img = crop
+
+    buf = io.BytesIO()
+    final_img.save(buf, format="JPEG", quality=EXPORT_JPEG_QUALITY)
+    return buf.getvalue()
+
+def _crop_entry(decoded, box, target) -> Optional[bytes]:
+    ingested = decoded.result()
+    if ingested is None:
+        return None
+    # Box nelle coordinate dell'originale, l'immagine può essere stata ridotta all'ingest
+    return encode_crop(ingested['image'], box_to_image(box, ingested['scale']), target)
+
+def _decode(name: str, open_image: Callable[[], Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    try:
+        return open_image()
+    except Exception as e:
+        log.warning("image not readable, skipped", extra=fields(filename=name, error=str(e)))
+        return None
+
+
+def export_entries(items: Iterable[Dict[str, Any]], target: Tuple[Optional[int], Optional[int]],
+                   folder_organized: bool, max_in_flight: int = EXPORT_MAX_IN_FLIGHT) -> Iterator[Tuple[str, bytes]]:
+    """
+    items: {'filename', 'boxes', 'open': callable returning ingest_image() of the original},
+    boxes in original coordinates.
+    Yields (path in zip, jpeg bytes) in input order while decode and crops run on the
+    shared pool. At most `max_in_flight` crops are pending, so only the images they
+    belong to stay decoded.
+    """
+    pending = collections.deque()
+    for item in items:
+        base_name = os.path.splitext(item['filename'])[0]
+        # Il decode entra in coda prima dei suoi ritagli: un worker non aspetta mai un decode non ancora partito
+        decoded = _executor.submit(_decode, item['filename'], item['open'])
+        for idx, box in enumerate(item['boxes']):
+            crop_name = f"{base_name}_{idx}.jpg"
+            path_in_zip = os.path.join(base_name, crop_name) if folder_organized else crop_name
+            pending.append((path_in_zip, _executor.submit(_crop_entry, decoded, box, target)))
+            while len(pending) >= max_in_flight:
+                path_in_zip, future = pending.popleft()
+                data = future.result()
+                if data is not None:
+                    yield path_in_zip, data
+        del decoded
+    while pending:
+        path_in_zip, future = pending.popleft()
+        data = future.result()
+        if data is not None:
+            yield path_in_zip, data
+
+
+class _ChunkSink:
+    """Write-only file object for ZipFile: no tell/seek, so zipfile writes a streamable archive."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(entries: Iterable[Tuple[str, bytes]]) -> Iterator[bytes]:
+    """
+    ZIP archive produced entry by entry: each yielded chunk is a finished local entry,
+    the last one the central directory. JPEGs are stored, deflating them gains nothing.
+    """
+    sink = _ChunkSink()
+    start = time.time()
+    count = 0
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+        for path_in_zip, data in entries:
+            info = zipfile.ZipInfo(path_in_zip, date_time=time.localtime(start)[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            zf.writestr(info, data)
+            count += 1
+            yield sink.drain()
+    yield sink.drain()
+    log.info("export done", extra=fields(crops=count, seconds=round(time.time() - start, 2)))
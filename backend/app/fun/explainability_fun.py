@@ -4,125 +4,170 @@ from dotenv import dotenv_values
 from typing import Optional
 import torch
 import numpy as np
-import matplotlib
-import gc # Garbage collection
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from captum.attr import IntegratedGradients, Occlusion
-from captum.attr import visualization as viz
 from PIL import Image
 
+from app.fun.attribution_engine import ENGINE
+from app.fun.adaptive_occlusion import adaptive_occlusion, OCCLUSION_MAX_PASSES, OCCLUSION_TIME_BUDGET, FINE_STRIDE
+from app.fun.occlusion_maps import all_class_occlusion, class_attribution_hwc, OCCLUSION_MAPS
+from app.fun.gradcam import cached_gradcam, GRADCAM_METHODS
+from app.fun.attribution_cache import ATTRIBUTION_CACHE, attribution_key
+from app.fun.heatmap_render import render_blended_heatmap, quantize_heatmap, downsample_map
+from app.fun.telemetry import span, timed, STAGE_ERRORS
+from app.fun.structured_log import get_logger, fields
+
 SLIDING_WINDOW_SIZE = 20
 STRIDE = 20
 
+log = get_logger("xai")
+
 config = dotenv_values(".env")
 MEAN = [float(x) for x in config.get("MEAN", "0.5364 0.5518 0.3866").split()]
 STD = [float(x) for x in config.get("STD", "0.2045 0.2296 0.2025").split()]
 
-def fig_to_base64(fig):
-    buf = io.BytesIO()
-    # --- OTTIMIZZAZIONE 2: DPI bassi ---
-    fig.savefig(buf, format="JPEG", bbox_inches='tight', pad_inches=0, dpi=72)
-    buf.seek(0)
-    img_str = base64.b64encode(buf.getvalue()).decode('utf-8')
-    
-    # --- OTTIMIZZAZIONE 3: Pulizia violenta della memoria ---
-    plt.close(fig)
-    plt.close('all')
-    gc.collect() # Forza il garbage collector di Python
-    return img_str
+class ImagePayload(bytes):
+    """
+    Encoded image bytes kept raw until the response is serialized
+    (see app.fun.response_format): base64 for JSON, binary for MessagePack/multipart.
+    data_uri=True means JSON clients expect a 'data:<mimetype>;base64,' prefix.
+    """
+
+    def __new__(cls, data: bytes, mimetype: str = "image/jpeg", data_uri: bool = False):
+        obj = super().__new__(cls, data)
+        obj.mimetype = mimetype
+        obj.data_uri = data_uri
+        obj.meta = {}  # e.g. the id of the stored attribution map behind an explanation
+        return obj
+
+    def to_base64(self) -> str:
+        encoded = base64.b64encode(self).decode('utf-8')
+        return f"data:{self.mimetype};base64,{encoded}" if self.data_uri else encoded
 
 def denormalize(tensor, mean, std):
     mean = torch.tensor(mean).view(3, 1, 1).to(tensor.device)
     std = torch.tensor(std).view(3, 1, 1).to(tensor.device)
     return tensor * std + mean
 
-def get_integrated_gradients_b64(model, input_tensor, target_label, mean, std):
+@timed('render')
+def render_heatmap(attribution_map, original_image, sign, title) -> ImagePayload:
+    """attribution_map / original_image: (H, W, 3) numpy arrays, the image denormalized in [0, 1]."""
+    # Array ops + PIL instead of a pyplot figure: a few ms and safe from worker threads
+    return encode_image(render_blended_heatmap(attribution_map, original_image, sign, title))
+
+def raw_heatmap(attribution_map, sign, step=1) -> dict:
+    """
+    Compact alternative to render_heatmap (xai_format=raw): the map at its natural
+    resolution (sampled every `step` pixels) as a uint8 PNG plus its scale, for the
+    client to colorize and blend. See heatmap_render.quantize_heatmap.
+    """
+    combined = attribution_map.sum(axis=2) if attribution_map.ndim == 3 else attribution_map
+    png, meta = quantize_heatmap(downsample_map(combined, step), sign)
+    return {'format': 'raw', 'data': ImagePayload(png, mimetype="image/png", data_uri=True), **meta}
+
+def explanation_payload(explanation):
+    """The ImagePayload behind an explanation, rendered or raw."""
+    return explanation['data'] if isinstance(explanation, dict) else explanation
+
+def tensor_to_display_image(input_tensor, mean=MEAN, std=STD):
+    """(1, 3, H, W) normalized tensor -> (H, W, 3) numpy image for rendering."""
+    return denormalize(input_tensor.squeeze(0), mean, std).detach().cpu().permute(1, 2, 0).numpy()
+
+def get_integrated_gradients_image(model, input_tensor, target_label, mean, std, raw=False):
     try:
         model.eval()
-        ig = IntegratedGradients(model)
         
-        # --- Parametri Memory-Friendly ---
-        # n_steps=10: Molto meno preciso ma 5 volte più leggero del default (50)
-        # internal_batch_size=1: Elabora una copia alla volta. Lento ma non crasha.
-        attributions = ig.attribute(
-            input_tensor, 
-            target=target_label, 
-            n_steps=10, 
-            internal_batch_size=1 
+        # n_steps e internal_batch_size vengono scelti dall'engine in base alla
+        # memoria disponibile e al budget di tempo (vedi attribution_engine.py)
+        attributions = ATTRIBUTION_CACHE.get_or_compute(
+            attribution_key(model, input_tensor, 'integrated_gradients', target_label),
+            lambda: ENGINE.integrated_gradients(model, input_tensor, target_label)[0]
         )
         
-        original_image = denormalize(input_tensor.squeeze(0), mean, std).detach().cpu().permute(1, 2, 0).numpy()
+        original_image = tensor_to_display_image(input_tensor, mean, std)
         attribution_map = attributions.squeeze(0).cpu().permute(1, 2, 0).detach().numpy()
-
-        fig, ax = plt.subplots(figsize=(4, 8))
-        viz.visualize_image_attr(
-            attribution_map,
-            original_image,
-            method="blended_heat_map",
-            sign="absolute_value",
-            show_colorbar=True,
-            title="IG",
-            plt_fig_axis=(fig, ax),
-            use_pyplot=False
-        )
         
-        # Pulizia tensori
         del attributions
-        del ig
-        if torch.cuda.is_available(): torch.cuda.empty_cache()
         
-        return fig_to_base64(fig)
+        if raw:
+            return raw_heatmap(attribution_map, "absolute_value")
+        return render_heatmap(attribution_map, original_image, "absolute_value", "IG")
     except Exception as e:
-        print(f"Errore IG: {e}")
+        log.warning("integrated gradients failed", extra=fields(error=str(e)))
         return None
 
-def get_occlusion_b64(model, input_tensor, target_label, mean, std):
+def get_occlusion_image(model, input_tensor, target_label, mean, std, adaptive=False, options=None, raw=False):
     try:
         model.eval()
-        occlusion = Occlusion(model)
-
-        # Increase strides for speed! 
-        # If image is 512x256, a stride of 25 reduces passes by 4x vs stride of 10.
-        attributions = occlusion.attribute(
-            input_tensor,
-            strides=(3, 25, 25), 
-            target=target_label,
-            sliding_window_shapes=(3, 30, 30),
-            baselines=0,
-            perturbations_per_eval=2 # Slightly faster if you have enough RAM
-        )
-
-        original_image = denormalize(input_tensor.squeeze(0), mean, std).detach().cpu().permute(1, 2, 0).numpy()
-        attribution_map = attributions.squeeze(0).cpu().permute(1, 2, 0).detach().numpy()
-
-        fig, ax = plt.subplots(figsize=(4, 8))
-        viz.visualize_image_attr(
-            attribution_map,
-            original_image,
-            method="blended_heat_map",
-            sign="positive",
-            show_colorbar=True,
-            title="Occlusion",
-            plt_fig_axis=(fig, ax),
-            use_pyplot=False
-        )
+        options = options or {}
+        map_id = None
+        original_image = tensor_to_display_image(input_tensor, mean, std)
+
+        if adaptive:
+            # Coarse sweep + refinement of the salient regions only, within a per-request budget
+            budget = {
+                'max_passes': options.get('max_passes', OCCLUSION_MAX_PASSES),
+                'time_budget': options.get('time_budget', OCCLUSION_TIME_BUDGET),
+            }
+            attributions = ATTRIBUTION_CACHE.get_or_compute(
+                attribution_key(model, input_tensor, 'occlusion_adaptive', target_label, budget),
+                lambda: adaptive_occlusion(model, input_tensor, target_label, **budget)[0]
+            )
+            attribution_map = attributions.squeeze(0).cpu().permute(1, 2, 0).detach().numpy()
+            step = FINE_STRIDE
+        else:
+            # Increase strides for speed! 
+            # If image is 512x256, a stride of 25 reduces passes by 4x vs stride of 10.
+            # One sweep records the logits of every class, so the maps of the other
+            # classes can be served later from OCCLUSION_MAPS without another forward pass.
+            # Cached without target: any class of the same input is served from one sweep
+            global_attribution = ATTRIBUTION_CACHE.get_or_compute(
+                attribution_key(model, input_tensor, 'occlusion', None, {'window': 30, 'stride': 25}),
+                lambda: all_class_occlusion(model, input_tensor, window=30, stride=25)[0]
+            )
+            map_id = OCCLUSION_MAPS.put(global_attribution, original_image, target_label, stride=25)
+            attribution_map = class_attribution_hwc(global_attribution, target_label)
+            step = 25
+
+        if raw:
+            # ~20x10 distinct cells at stride 25: no need to ship the full-size map
+            explanation = raw_heatmap(attribution_map, "positive", step)
+        else:
+            explanation = render_heatmap(attribution_map, original_image, "positive", "Occlusion")
+        if map_id is not None:
+            explanation_payload(explanation).meta['map_id'] = map_id
+        return explanation
+    except Exception as e:
+        log.warning("occlusion failed", extra=fields(error=str(e)))
+        return None
 
-        # Pulizia tensori
-        del attributions
-        del occlusion
-        if torch.cuda.is_available(): torch.cuda.empty_cache()
+def render_gradcam(cam, input_tensor, mean, std, plus_plus=False) -> ImagePayload:
+    """cam: (H, W) map in [0, 1] from app.fun.gradcam; input_tensor: the (1, 3, H, W) image it explains."""
+    attribution_map = np.repeat(cam.numpy()[:, :, None], 3, axis=2)
+    original_image = tensor_to_display_image(input_tensor, mean, std)
+    return render_heatmap(attribution_map, original_image, "positive", "Grad-CAM++" if plus_plus else "Grad-CAM")
 
-        return fig_to_base64(fig)
+def get_gradcam_images(model, input_batch, target_labels, mean, std, plus_plus=False, raw=False):
+    """Grad-CAM heatmaps for a whole (B, 3, H, W) batch: one forward + one backward pass. None where target is -1."""
+    try:
+        # Raw maps stay at layer4 resolution (16x8 for 512x256), the client upsamples them
+        cams = cached_gradcam(model, input_batch, list(target_labels), plus_plus=plus_plus, upsample=not raw)
+        return [
+            (raw_heatmap(cam.numpy(), "positive") if raw else render_gradcam(cam, input_batch[i:i + 1], mean, std, plus_plus))
+            if cam is not None else None
+            for i, cam in enumerate(cams)
+        ]
     except Exception as e:
-        print(f"Errore Occlusion: {e}")
-        return None
+        log.warning("gradcam failed", extra=fields(error=str(e)))
+        return [None] * len(target_labels)
 
-def image_to_base64(image: Image.Image) -> str:
+def get_gradcam_image(model, input_tensor, target_label, mean, std, plus_plus=False, raw=False):
+    return get_gradcam_images(model, input_tensor, [target_label], mean, std, plus_plus, raw)[0]
+
+@timed('encode')
+def encode_image(image: Image.Image, **save_kwargs) -> ImagePayload:
     buffered = io.BytesIO()
     # Save as JPEG to keep it light
-    image.save(buffered, format="JPEG") 
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    image.save(buffered, format="JPEG", **save_kwargs)
+    return ImagePayload(buffered.getvalue())
 
 def base64_to_image(base64_string):
     """Decodes a Base64 string into a PIL Image."""
@@ -133,21 +178,63 @@ def base64_to_image(base64_string):
     except Exception:
         return None
 
-def generate_explanation(model, tensor: torch.Tensor, target_idx: int, method: str) -> Optional[str]:
+def generate_explanation(model, tensor: torch.Tensor, target_idx: int, method: str, options=None):
+    """
+    method: 'occlusion' | 'occlusion_adaptive' | 'integrated_gradients' | 'gradcam' | 'gradcam++'
+    options: per-request budget for 'occlusion_adaptive' ({'max_passes', 'time_budget'})
+             and 'format': 'raw' for the compact payload instead of a rendered ImagePayload
+    """
     if method == "none" or target_idx == -1 or tensor is None:
         return None
-
+    with span(f"xai_{method}"):
+        explanation = _generate_explanation(model, tensor, target_idx, method, options or {})
+    if explanation is None:
+        # I metodi XAI intercettano i propri errori: qui None vuol dire fallito
+        STAGE_ERRORS.inc(stage=f"xai_{method}")
+    return explanation
+
+def _generate_explanation(model, tensor, target_idx, method, options):
+    raw = options.get('format') == 'raw'
     try:
         # Crucial: Disable gradients for both methods to save RAM/Time 
         # (IG needs them internally but handles its own logic, Occlusion definitely doesn't)
         with torch.no_grad(): 
             if method == 'occlusion':
-                return get_occlusion_b64(model, tensor, target_idx, MEAN, STD)
+                return get_occlusion_image(model, tensor, target_idx, MEAN, STD, raw=raw)
+            if method == 'occlusion_adaptive':
+                return get_occlusion_image(model, tensor, target_idx, MEAN, STD, adaptive=True, options=options, raw=raw)
             
         if method == 'integrated_gradients':
             # IG requires gradients, so call it outside the no_grad block
-            return get_integrated_gradients_b64(model, tensor, target_idx, MEAN, STD)
+            return get_integrated_gradients_image(model, tensor, target_idx, MEAN, STD, raw=raw)
+
+        if method in GRADCAM_METHODS:
+            # One forward + one backward pass on layer4
+            return get_gradcam_image(model, tensor, target_idx, MEAN, STD, plus_plus=GRADCAM_METHODS[method], raw=raw)
             
     except Exception as e:
-        print(f"XAI Generation Warning: {e}", flush=True)
-        return None
\ No newline at end of file
+        log.warning("explanation failed", extra=fields(method=method, error=str(e)))
+        return None
+
+# explain_method -> response key ('occlusion_adaptive' fills the regular 'occlusion' field)
+XAI_OUTPUT_KEYS = {
+    'occlusion': 'occlusion',
+    'occlusion_adaptive': 'occlusion',
+    'integrated_gradients': 'integrated_gradients',
+    'gradcam': 'gradcam',
+    'gradcam++': 'gradcam',
+}
+
+# Helper to handle 'both' or specific methods
+def get_xai(m, t, idx, explain_method, xai_options=None):
+    if idx == -1: return {}
+    xai_results = {}
+    methods = ['occlusion', 'integrated_gradients'] if explain_method == 'both' else [explain_method]
+    for meth in methods:
+        if meth in XAI_OUTPUT_KEYS:
+            xai_results[XAI_OUTPUT_KEYS[meth]] = generate_explanation(m, t, idx, meth, xai_options)
+    # The regular occlusion sweep stores every class: the id lets the client fetch other classes later
+    occlusion = xai_results.get('occlusion')
+    if occlusion is not None and explanation_payload(occlusion).meta.get('map_id'):
+        xai_results['occlusion_map_id'] = explanation_payload(occlusion).meta['map_id']
+    return xai_results
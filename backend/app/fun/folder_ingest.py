@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Tuple, Optional
+from dotenv import dotenv_values
+
+from app.fun.batch_logic import classify_images
+from app.fun.structured_log import get_logger, fields
+from app.fun.ingest import ingest_image, boxes_to_original, box_to_image
+
+try:
+    from app.cropping_fun.fasterrcnn_crop import crop_batch
+    HAS_EXTERNAL_CROP = True
+except ImportError:
+    HAS_EXTERNAL_CROP = False
+
+log = get_logger("folder_ingest")
+
+config = dotenv_values(".env")
+
+# Percorsi montati nel container da docker-compose
+DATASET_ROOT = config.get("DATASET_ROOT", "datasets")
+TEST_RESULTS_ROOT = config.get("TEST_RESULTS_ROOT", "test_results")
+PREFETCH_WORKERS = int(config.get("PREFETCH_WORKERS", 4))
+PREFETCH_DEPTH = int(config.get("PREFETCH_DEPTH", 32))
+
+ALLOWED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tiff'}
+VALID_MODES = {'detect', 'classify', 'both'}
+RESULTS_SUFFIX = "__results"
+
+
+def resolve_dataset_dir(relative_path):
+    """Resolves a folder under DATASET_ROOT, refusing paths that escape it."""
+    root = os.path.realpath(DATASET_ROOT)
+    target = os.path.realpath(os.path.join(root, relative_path))
+    if os.path.commonpath([root, target]) != root:
+        raise ValueError("Folder must be inside the dataset root")
+    if not os.path.isdir(target):
+        raise FileNotFoundError(f"Folder not found: {relative_path}")
+    return target
+
+def list_folder_images(folder):
+    """All images under `folder` (recursive), sorted by relative path. Output folders are skipped."""
+    items = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [d for d in dirnames if not d.endswith(RESULTS_SUFFIX)]
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() in ALLOWED_EXTENSIONS:
+                full_path = os.path.join(dirpath, name)
+                items.append({'filename': os.path.relpath(full_path, folder), 'path': full_path})
+    items.sort(key=lambda item: item['filename'])
+    return items
+
+def make_output_dir(folder, output="test_results"):
+    """
+    output="test_results": a timestamped folder under TEST_RESULTS_ROOT
+    output="alongside":    a sibling folder '<folder>__results' next to the data
+    """
+    if output == "alongside":
+        out_dir = folder.rstrip(os.sep) + RESULTS_SUFFIX
+    else:
+        name = os.path.basename(folder.rstrip(os.sep)) or "dataset"
+        out_dir = os.path.join(TEST_RESULTS_ROOT, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(out_dir, exist_ok=True)
+    return out_dir
+
+
+# --- PREFETCHING LOADER ---
+
+def prefetch_images(items: List[Dict[str, Any]], num_workers: int = PREFETCH_WORKERS,
+                    depth: int = PREFETCH_DEPTH) -> Iterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]], Optional[str]]]:
+    """
+    Decodes images on a thread pool while the caller consumes them, keeping at most
+    `depth` decoded images in flight. Yields (item, ingested, error) in input order,
+    ingested being the ingest_image() dict (image, original_size, scale).
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        pending = collections.deque()
+        it = iter(items)
+        for item in it:
+            pending.append((item, pool.submit(ingest_image, item['path'])))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            next_item = next(it, None)
+            if next_item is not None:
+                pending.append((next_item, pool.submit(ingest_image, next_item['path'])))
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, f"Cannot read image: {e}"
+
+def batched(iterable, size):
+    batch = []
+    for element in iterable:
+        batch.append(element)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# --- BATCH PROCESSING ---
+
+def run_batch(ingested: List[Dict[str, Any]], params: Dict[str, Any], model, onevall_models, device,
+              CLASS_NAMES, transform_pipeline) -> List[Dict[str, Any]]:
+    """
+    Runs detection and/or classification on already decoded images (ingest_image dicts).
+    Boxes in the results are in the coordinates of the original files.
+    params: mode ('detect' | 'classify' | 'both'), model_strategy, crop_mode
+    """
+    images = [i['image'] for i in ingested]
+    mode = params.get('mode', 'classify')
+    if mode == 'detect':
+        if not HAS_EXTERNAL_CROP:
+            raise RuntimeError("Detector not available")
+        results = [
+            {'success': True, 'boxes': boxes, 'scores': scores, 'count': len(scores)}
+            for _, boxes, scores in crop_batch(images)
+        ]
+    else:
+        crop_mode = params.get('crop_mode', 'integrated')
+        if mode == 'both' and crop_mode == 'integrated':
+            crop_mode = 'external'
+        results = classify_images(
+            images, model, onevall_models, device, CLASS_NAMES, transform_pipeline,
+            params.get('model_strategy', 'standard'), crop_mode
+        )
+    for ing, result in zip(ingested, results):
+        if result.get('boxes'):
+            result['boxes'] = boxes_to_original(result['boxes'], ing['scale'])
+    return results
+
+# results.jsonl -> filenames already in it (letto una volta per cartella), finché
+# la run o il job non finisce: vedi forget_recorded
+_recorded: Dict[str, set] = {}
+_recorded_lock = threading.Lock()
+
+def _recorded_filenames(results_path):
+    """
+    Filenames already written to results.jsonl. Items resumed after a restart may have
+    been recorded just before it: they are processed again but not appended twice.
+    A line cut short by the crash is dropped.
+    """
+    names = _recorded.get(results_path)
+    if names is None:
+        names = set()
+        if os.path.exists(results_path):
+            with open(results_path, "r+") as f:
+                content = f.read()
+                complete = content[:content.rfind("\n") + 1]
+                if len(complete) < len(content):
+                    f.truncate(len(complete.encode()))
+            for line in complete.splitlines():
+                try:
+                    names.add(json.loads(line)['filename'])
+                except (ValueError, KeyError):
+                    continue
+        _recorded[results_path] = names
+    return names
+
+def forget_recorded(out_dir):
+    """Drops the dedupe set of a finished run or job (reloaded from disk if it is resumed)."""
+    with _recorded_lock:
+        _recorded.pop(os.path.join(out_dir, "results.jsonl"), None)
+
+def save_item_outputs(out_dir, item, ingested, result, save_crops=False, min_score=0.0):
+    """
+    Appends the result to results.jsonl (once per filename, also across resumes) and
+    writes one JPEG per detected box above min_score.
+    """
+    crop_paths = []
+    if save_crops and ingested is not None:
+        image = ingested['image']
+        base_name = os.path.splitext(item['filename'])[0]
+        crop_counter = 1
+        for box, score in zip(result.get('boxes') or [], result.get('scores') or []):
+            if score < min_score:
+                continue
+            crop_path = os.path.join(out_dir, "crops", f"{base_name}_{crop_counter}.jpg")
+            os.makedirs(os.path.dirname(crop_path), exist_ok=True)
+            image.crop(box_to_image(box, ingested['scale'])).save(crop_path, "JPEG", quality=95)
+            crop_paths.append(os.path.relpath(crop_path, out_dir))
+            crop_counter += 1
+
+    record = {'filename': item['filename'], **result, 'crops': crop_paths}
+    if ingested is not None:
+        record['original_size'] = list(ingested['original_size'])
+    results_path = os.path.join(out_dir, "results.jsonl")
+    with _recorded_lock:
+        recorded = _recorded_filenames(results_path)
+        if item['filename'] not in recorded:
+            with open(results_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            recorded.add(item['filename'])
+    return crop_paths
+
+def run_folder(relative_folder, params, model, onevall_models, device, CLASS_NAMES, transform_pipeline,
+               batch_size=8, output="test_results", save_crops=False, min_score=0.0):
+    """
+    Streams every image under DATASET_ROOT/relative_folder through the prefetching loader,
+    processes them in batches and writes results (and optionally crops) to disk.
+    """
+    folder = resolve_dataset_dir(relative_folder)
+    items = list_folder_images(folder)
+    out_dir = make_output_dir(folder, output)
+    total = len(items)
+    processed = errors = 0
+    start = time.time()
+
+    log.info("folder run started", extra=fields(images=total, folder=folder, output_dir=out_dir))
+    try:
+        for batch in batched(prefetch_images(items), batch_size):
+            ok = [(item, ing) for item, ing, err in batch if err is None]
+            for item, _, err in batch:
+                if err is not None:
+                    save_item_outputs(out_dir, item, None, {'success': False, 'error': err})
+                    errors += 1
+
+            if ok:
+                ingested = [ing for _, ing in ok]
+                try:
+                    results = run_batch(ingested, params, model, onevall_models, device, CLASS_NAMES, transform_pipeline)
+                except Exception as e:
+                    results = [{'success': False, 'error': str(e)} for _ in ok]
+                    errors += len(ok)
+                for (item, ing), result in zip(ok, results):
+                    save_item_outputs(out_dir, item, ing, result, save_crops, min_score)
+                    ing['image'].close()
+
+            processed += len(batch)
+            elapsed = time.time() - start
+            log.info("folder progress", extra=fields(processed=processed, images=total,
+                                                     images_per_second=round(processed / elapsed, 2)))
+    finally:
+        forget_recorded(out_dir)
+
+    return {
+        'folder': relative_folder,
+        'output_dir': out_dir,
+        'total': total,
+        'errors': errors,
+        'seconds': round(time.time() - start, 3),
+    }
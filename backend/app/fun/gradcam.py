@@ -0,0 +1,148 @@
+import copy
+import time
+import weakref
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import torch
+import torch.nn.functional as F
+from dotenv import dotenv_values
+
+from app.fun.attribution_engine import ENGINE, PeakMemorySampler
+from app.fun.attribution_cache import ATTRIBUTION_CACHE, attribution_key
+
+config = dotenv_values(".env")
+
+# Layer convoluzionale su cui calcolare Grad-CAM (ultimo blocco della ResNet-18)
+GRADCAM_LAYER = config.get("GRADCAM_LAYER", "layer4")
+
+# explain_method -> variante
+GRADCAM_METHODS = {
+    'gradcam': False,
+    'gradcam++': True,
+}
+
+# Gli hook si montano solo su modelli che nessuna richiesta usa per l'inferenza:
+# la copia privata di ogni modello condiviso, o un modello dedicato (use_dedicated).
+# Una spiegazione alla volta per processo.
+_hook_lock = threading.Lock()
+_replicas: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_dedicated: "weakref.WeakSet" = weakref.WeakSet()
+
+
+def use_dedicated(model):
+    """
+    Marks a model that only explanations run on (the XAI worker replica, the offline
+    renderer's workers): Grad-CAM hooks it directly instead of keeping a copy.
+    """
+    _dedicated.add(model)
+    return model
+
+
+def _hook_target(model):
+    """
+    The model Grad-CAM may hook (call under _hook_lock): the model itself if dedicated,
+    otherwise a private copy made on first use, so forwards of request threads on the
+    serving model never run the hook and its parameters never receive gradients.
+    """
+    if model in _dedicated:
+        return model
+    replica = _replicas.get(model)
+    if replica is None:
+        replica = copy.deepcopy(model).eval()
+        _replicas[model] = replica
+    return replica
+
+
+def _weights(activations: torch.Tensor, grads: torch.Tensor, plus_plus: bool) -> torch.Tensor:
+    """Channel weights (B, K, 1, 1): mean gradient (Grad-CAM) or the alpha-weighted positive gradients (Grad-CAM++)."""
+    if not plus_plus:
+        return grads.mean(dim=(2, 3), keepdim=True)
+    grads_2 = grads.pow(2)
+    grads_3 = grads.pow(3)
+    denominator = 2 * grads_2 + activations.sum(dim=(2, 3), keepdim=True) * grads_3
+    alpha = grads_2 / torch.where(denominator != 0, denominator, torch.ones_like(denominator))
+    return (alpha * F.relu(grads)).sum(dim=(2, 3), keepdim=True)
+
+
+def gradcam(model, input_batch: torch.Tensor, targets: List[int], plus_plus: bool = False,
+            layer: str = GRADCAM_LAYER, upsample: bool = True) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """
+    Grad-CAM (or Grad-CAM++) for a (B, C, H, W) batch, one target class per image,
+    with a single forward and a single backward pass for the whole batch.
+    Returns (maps (B, H, W) on CPU, each scaled to [0, 1], stats); with upsample=False
+    the maps keep the layer's own resolution (H/32 x W/32 for layer4).
+    Targets of -1 (no prediction) give an all-zero map.
+    """
+    captured = {}
+
+    def forward_hook(_, __, output):
+        # Solo i forward con grafo (il nostro): mai quelli sotto no_grad
+        if output.requires_grad:
+            captured['activations'] = output
+
+    start = time.perf_counter()
+    valid = torch.tensor([t != -1 for t in targets])
+    target_idx = torch.tensor([max(t, 0) for t in targets], device=input_batch.device)
+
+    with _hook_lock, PeakMemorySampler(input_batch.device) as sampler:
+        target_model = _hook_target(model)
+        target_model.eval()
+        module = dict(target_model.named_modules())[layer]
+        handle = module.register_forward_hook(forward_hook)
+        try:
+            with torch.enable_grad():
+                # Batch-norm in eval: the images do not interact, so summing the target
+                # scores gives every image its own gradient in one pass. autograd.grad
+                # only differentiates w.r.t. the activations: parameter .grad stays untouched
+                outputs = target_model(input_batch.detach().requires_grad_(True))
+                score = outputs.gather(1, target_idx.unsqueeze(1)).sum()
+                grads, = torch.autograd.grad(score, captured['activations'])
+        finally:
+            handle.remove()
+
+        activations = captured['activations'].detach()
+        grads = grads.detach()
+        cam = F.relu((_weights(activations, grads, plus_plus) * activations).sum(dim=1, keepdim=True))
+        if upsample:
+            cam = F.interpolate(cam, size=input_batch.shape[2:], mode='bilinear', align_corners=False)
+        cam = cam.squeeze(1)
+        peak = cam.flatten(1).max(dim=1).values.clamp(min=1e-8).view(-1, 1, 1)
+        cam = (cam / peak).cpu()
+        cam[~valid] = 0
+
+    stats = ENGINE.record('gradcam++' if plus_plus else 'gradcam', {
+        'seconds': time.perf_counter() - start,
+        'peak_memory_bytes': sampler.peak_delta,
+        'batch_size': int(input_batch.shape[0]),
+        'layer': layer,
+    })
+    return cam, stats
+
+
+def cached_gradcam(model, input_batch: torch.Tensor, targets: List[int], plus_plus: bool = False,
+                   upsample: bool = True) -> List[Optional[torch.Tensor]]:
+    """
+    gradcam() through the attribution cache: only the images of the batch without a
+    cached map are recomputed, still in a single pass. Returns one map per image
+    (None where the target is -1).
+    """
+    method = 'gradcam++' if plus_plus else 'gradcam'
+    params = {'layer': GRADCAM_LAYER, 'upsample': upsample}
+    maps: List[Optional[torch.Tensor]] = [None] * len(targets)
+    keys, missing = {}, []
+    for i, target in enumerate(targets):
+        if target == -1:
+            continue
+        keys[i] = attribution_key(model, input_batch[i:i + 1], method, target, params)
+        cached = ATTRIBUTION_CACHE.get(keys[i], count_miss=True)
+        if cached is None:
+            missing.append(i)
+        else:
+            maps[i] = cached
+
+    if missing:
+        cams, _ = gradcam(model, input_batch[missing], [targets[i] for i in missing], plus_plus, upsample=upsample)
+        for cam, i in zip(cams, missing):
+            ATTRIBUTION_CACHE.put(keys[i], cam)
+            maps[i] = cam
+    return maps
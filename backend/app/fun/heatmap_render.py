@@ -0,0 +1,146 @@
+import io
+from typing import Any, Dict, Tuple
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from matplotlib import colormaps
+from matplotlib.colors import LinearSegmentedColormap
+
+# Stesse regole di captum.attr.visualization.visualize_image_attr(method="blended_heat_map"),
+# ma con operazioni su array e PIL: niente figure pyplot, quindi sicuro nei thread worker.
+OUTLIER_PERC = 2
+ALPHA_OVERLAY = 0.5
+LUT_SIZE = 256
+
+# sign -> (colormap, vmin, vmax), as chosen by captum
+_SIGN_CMAPS = {
+    'positive': ('Greens', 0, 1),
+    'absolute_value': ('Blues', 0, 1),
+    'negative': ('Reds', 0, 1),
+    'all': (LinearSegmentedColormap.from_list("RdWhGn", ["red", "white", "green"]), -1, 1),
+}
+
+def _build_lut(cmap) -> np.ndarray:
+    cmap = colormaps[cmap] if isinstance(cmap, str) else cmap
+    return (cmap(np.linspace(0, 1, LUT_SIZE))[:, :3] * 255).astype(np.float32)
+
+# Lookup table (LUT_SIZE, 3) per sign, computed once at import
+LUTS = {sign: _build_lut(cmap) for sign, (cmap, _, _) in _SIGN_CMAPS.items()}
+
+
+def _cumulative_sum_threshold(values: np.ndarray, percentile: float) -> float:
+    sorted_vals = np.sort(values.flatten())
+    cum_sums = np.cumsum(sorted_vals)
+    threshold_id = np.where(cum_sums >= cum_sums[-1] * 0.01 * percentile)[0][0]
+    return sorted_vals[threshold_id]
+
+def sign_threshold(attr: np.ndarray, sign: str, outlier_perc: float = OUTLIER_PERC):
+    """(H, W, C) or (H, W) attributions -> (channel-summed map filtered by sign, scale that maps it to [-1, 1])."""
+    combined = attr.sum(axis=2) if attr.ndim == 3 else attr
+    if sign == 'all':
+        threshold = _cumulative_sum_threshold(np.abs(combined), 100 - outlier_perc)
+    elif sign == 'positive':
+        combined = (combined > 0) * combined
+        threshold = _cumulative_sum_threshold(combined, 100 - outlier_perc)
+    elif sign == 'negative':
+        combined = (combined < 0) * combined
+        threshold = -1 * _cumulative_sum_threshold(np.abs(combined), 100 - outlier_perc)
+    elif sign == 'absolute_value':
+        combined = np.abs(combined)
+        threshold = _cumulative_sum_threshold(combined, 100 - outlier_perc)
+    else:
+        raise ValueError(f"Unknown sign: {sign}")
+    return combined, float(threshold)
+
+def normalize_attr(attr: np.ndarray, sign: str, outlier_perc: float = OUTLIER_PERC) -> np.ndarray:
+    """(H, W, C) attributions -> (H, W) map in [-1, 1]: channel sum, sign filter, outlier-clipped scale (captum rules)."""
+    combined, threshold = sign_threshold(attr, sign, outlier_perc)
+    if threshold == 0:
+        # Mappa nulla (es. nessuna attribuzione positiva): captum fallirebbe, qui resta a zero
+        return np.zeros_like(combined, dtype=np.float32)
+    return np.clip(combined / threshold, -1, 1).astype(np.float32)
+
+def colorize(norm_attr: np.ndarray, sign: str) -> np.ndarray:
+    """(H, W) normalized map -> (H, W, 3) float RGB in [0, 255] through the sign's LUT."""
+    _, vmin, vmax = _SIGN_CMAPS[sign]
+    scaled = (np.clip(norm_attr, vmin, vmax) - vmin) / (vmax - vmin)
+    return LUTS[sign][np.minimum((scaled * LUT_SIZE).astype(np.int32), LUT_SIZE - 1)]
+
+def _grayscale(original_image: np.ndarray) -> np.ndarray:
+    # imshow(np.mean(image, axis=2), cmap="gray") autoscales to the data range
+    gray = original_image.mean(axis=2) if original_image.ndim == 3 else original_image
+    lo, hi = gray.min(), gray.max()
+    gray = (gray - lo) / (hi - lo) if hi > lo else np.zeros_like(gray)
+    return np.repeat((gray * 255)[:, :, None], 3, axis=2)
+
+
+def _colorbar(sign: str, height: int, width: int = 12) -> np.ndarray:
+    _, vmin, vmax = _SIGN_CMAPS[sign]
+    ramp = np.linspace(vmax, vmin, height)[:, None].repeat(width, axis=1)
+    return colorize(ramp, sign)
+
+def render_blended_heatmap(attribution_map: np.ndarray, original_image: np.ndarray, sign: str,
+                           title: str = None, show_colorbar: bool = True,
+                           alpha: float = ALPHA_OVERLAY) -> Image.Image:
+    """
+    attribution_map / original_image: (H, W, 3) numpy arrays, the image in [0, 1].
+    Grayscale image with the colorized attributions blended on top at `alpha`,
+    plus the title above and the colorbar on the right like the captum figure.
+    """
+    norm_attr = normalize_attr(attribution_map, sign)
+    blended = (1 - alpha) * _grayscale(original_image) + alpha * colorize(norm_attr, sign)
+    height, width = norm_attr.shape
+
+    title_h = 18 if title else 0
+    bar_w, gap = (12, 6) if show_colorbar else (0, 0)
+    label_w = 24 if show_colorbar else 0
+    canvas = np.full((height + title_h, width + gap + bar_w + label_w, 3), 255, dtype=np.uint8)
+    canvas[title_h:, :width] = blended.astype(np.uint8)
+    if show_colorbar:
+        canvas[title_h:, width + gap:width + gap + bar_w] = _colorbar(sign, height, bar_w).astype(np.uint8)
+
+    image = Image.fromarray(canvas)
+    if title or show_colorbar:
+        draw = ImageDraw.Draw(image)
+        font = ImageFont.load_default()
+        if title:
+            text_w = draw.textlength(title, font=font)
+            draw.text(((width - text_w) / 2, 3), title, fill=(0, 0, 0), font=font)
+        if show_colorbar:
+            _, vmin, vmax = _SIGN_CMAPS[sign]
+            x = width + gap + bar_w + 2
+            draw.text((x, title_h), f"{vmax:g}", fill=(0, 0, 0), font=font)
+            draw.text((x, title_h + height - 12), f"{vmin:g}", fill=(0, 0, 0), font=font)
+    return image
+
+
+# --- RAW PAYLOAD (client-side rendering) ---
+
+def downsample_map(attr_map: np.ndarray, step: int) -> np.ndarray:
+    """Samples a map every `step` pixels (at cell centers): occlusion/Grad-CAM maps are constant or smooth per cell."""
+    if step <= 1:
+        return attr_map
+    offset = step // 2
+    return attr_map[offset::step, offset::step]
+
+def quantize_heatmap(attr: np.ndarray, sign: str) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Attribution map as a compact payload the client colorizes itself: the sign-filtered
+    channel sum quantized to a grayscale uint8 PNG at its own resolution, plus what is
+    needed to undo the quantization (value = min + pixel / 255 * (max - min)) and to
+    normalize like captum (clip(value / scale, -1, 1)). Returns (png bytes, metadata).
+    """
+    combined, threshold = sign_threshold(attr, sign)
+    lo, hi = float(combined.min()), float(combined.max())
+    span = hi - lo if hi > lo else 1.0
+    quantized = np.round((combined - lo) / span * 255).astype(np.uint8)
+
+    buf = io.BytesIO()
+    Image.fromarray(quantized, mode="L").save(buf, format="PNG")
+    return buf.getvalue(), {
+        'width': int(quantized.shape[1]),
+        'height': int(quantized.shape[0]),
+        'min': lo,
+        'max': hi,
+        'scale': threshold,
+        'sign': sign,
+    }
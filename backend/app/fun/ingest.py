@@ -0,0 +1,114 @@
+import io
+import math
+from typing import Any, Dict, List, Optional, Tuple
+from PIL import Image
+from dotenv import dotenv_values
+
+from app.fun.telemetry import timed
+
+config = dotenv_values(".env")
+
+# Oltre questa soglia l'immagine viene ridotta in decodifica (o rifiutata con INGEST_POLICY=reject)
+INGEST_MAX_MEGAPIXELS = float(config.get("INGEST_MAX_MEGAPIXELS", 24))
+INGEST_POLICY = config.get("INGEST_POLICY", "downsample")  # 'downsample' | 'reject'
+# Limite assoluto (decompression bomb): rifiutata sempre, prima di decodificare
+INGEST_HARD_MAX_MEGAPIXELS = float(config.get("INGEST_HARD_MAX_MEGAPIXELS", 200))
+
+# Pillow alza DecompressionBombError oltre il doppio di MAX_IMAGE_PIXELS
+Image.MAX_IMAGE_PIXELS = int(INGEST_HARD_MAX_MEGAPIXELS * 1_000_000)
+
+EXIF_ORIENTATION_TAG = 0x0112
+# Orientamento EXIF -> trasformazione che riporta l'immagine dritta
+_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+class ImageTooLarge(ValueError):
+    """Image above the hard pixel limit, or above the cap with INGEST_POLICY=reject."""
+
+
+def _open(source) -> Image.Image:
+    if isinstance(source, (bytes, bytearray)):
+        return Image.open(io.BytesIO(source))
+    if hasattr(source, 'stream'):  # werkzeug FileStorage
+        return Image.open(source.stream)
+    return Image.open(source)
+
+def capped_size(size: Tuple[int, int], max_megapixels: Optional[float] = INGEST_MAX_MEGAPIXELS) -> Tuple[int, int]:
+    """Size an image of `size` has after ingest (downsampled to the megapixel cap if above it)."""
+    width, height = size
+    limit = (max_megapixels or 0) * 1_000_000
+    if not limit or width * height <= limit:
+        return width, height
+    ratio = math.sqrt(limit / (width * height))
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+def check_size(size: Tuple[int, int], max_megapixels: Optional[float] = INGEST_MAX_MEGAPIXELS,
+               policy: str = INGEST_POLICY) -> Tuple[int, int]:
+    """Header check: raises ImageTooLarge if `size` is not accepted, otherwise returns the ingested size."""
+    width, height = size
+    if width * height > INGEST_HARD_MAX_MEGAPIXELS * 1_000_000:
+        raise ImageTooLarge(f"Image of {width}x{height} exceeds {INGEST_HARD_MAX_MEGAPIXELS:g} megapixels")
+    target = capped_size(size, max_megapixels)
+    if target != (width, height) and policy == 'reject':
+        raise ImageTooLarge(f"Image of {width}x{height} exceeds {max_megapixels:g} megapixels")
+    return target
+
+@timed('decode')
+def ingest_image(source, max_megapixels: Optional[float] = INGEST_MAX_MEGAPIXELS,
+                 policy: str = INGEST_POLICY) -> Dict[str, Any]:
+    """
+    The single entry point for decoding uploads and files (bytes, path, file object or
+    FileStorage). Reads the header first and refuses images above the hard limit;
+    above `max_megapixels` the image is rejected or downsampled, for JPEGs directly in
+    the decoder (draft). EXIF orientation is applied and the mode converted to RGB once.
+    Returns {'image', 'original_size', 'scale', 'orientation'}: original_size is the
+    upright full-resolution (w, h), scale = image size / original size, so boxes found
+    on 'image' map back with boxes_to_original.
+    """
+    img = _open(source)
+    image = img
+    try:
+        stored_w, stored_h = img.size
+        target = check_size((stored_w, stored_h), max_megapixels, policy)
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        if target != (stored_w, stored_h):
+            # JPEG: il decoder produce direttamente 1/2, 1/4 o 1/8 (almeno target)
+            img.draft('RGB', target)
+
+        image = img if img.mode == 'RGB' else img.convert('RGB')
+        image.load()
+        if image.size[0] > target[0] or image.size[1] > target[1]:
+            image = image.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if orientation in _TRANSPOSE:
+            image = image.transpose(_TRANSPOSE[orientation])
+    except Exception:
+        img.close()
+        raise
+    if image is not img:
+        img.close()
+
+    original_size = (stored_h, stored_w) if orientation in (5, 6, 7, 8) else (stored_w, stored_h)
+    return {
+        'image': image,
+        'original_size': original_size,
+        'scale': image.size[0] / original_size[0],
+        'orientation': orientation,
+    }
+
+def boxes_to_original(boxes: List[List[float]], scale: float) -> List[List[int]]:
+    """Boxes found on the ingested image -> coordinates of the upright original."""
+    if scale == 1.0:
+        return boxes
+    return [[int(round(v / scale)) for v in box] for box in boxes]
+
+def box_to_image(box, scale: float) -> Tuple[int, int, int, int]:
+    """Box in original coordinates -> coordinates on the ingested image."""
+    return tuple(int(round(v * scale)) for v in box[:4])
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+
+# Cartella persistente (il volume test_results è montato nel container)
+JOB_STORE_DIR = config.get("JOB_STORE_DIR", "test_results/jobs")
+JOB_DB_PATH = os.path.join(JOB_STORE_DIR, "jobs.sqlite3")
+JOB_UPLOAD_DIR = os.path.join(JOB_STORE_DIR, "uploads")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    source TEXT NOT NULL,
+    params TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, job_id, idx);
+"""
+
+
+class JobStore:
+    """
+    SQLite-backed job store. Every image of a job is a row in `items` with status
+    pending -> running -> done / failed, so a restart only re-queues what was running
+    and finished items are never processed again.
+    """
+
+    def __init__(self, db_path: str = JOB_DB_PATH):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+
+    def create_job(self, source: str, params: Dict[str, Any], items: List[Dict[str, str]]) -> str:
+        """items: list of {'filename', 'path'} in the order results should be reported."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, source, params, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, "queued", source, json.dumps(params), len(items), now, now)
+            )
+            self.conn.executemany(
+                "INSERT INTO items (job_id, idx, filename, path, status, updated_at) VALUES (?, ?, ?, ?, 'pending', ?)",
+                [(job_id, i, item['filename'], item['path'], now) for i, item in enumerate(items)]
+            )
+        return job_id
+
+    def requeue_running(self) -> int:
+        """Called at startup: items left 'running' by a crash go back to 'pending'."""
+        with self.lock, self.conn:
+            cur = self.conn.execute("UPDATE items SET status = 'pending' WHERE status = 'running'")
+            return cur.rowcount
+
+    def claim_items(self, limit: int) -> List[Dict[str, Any]]:
+        """
+        Marks up to `limit` pending items of the oldest unfinished job as running and
+        returns them. Items of one claim always belong to the same job (same params).
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT j.id, j.params FROM jobs j WHERE EXISTS "
+                "(SELECT 1 FROM items i WHERE i.job_id = j.id AND i.status = 'pending') "
+                "ORDER BY j.created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return []
+            job_id, params = row['id'], json.loads(row['params'])
+            rows = self.conn.execute(
+                "SELECT idx, filename, path FROM items WHERE job_id = ? AND status = 'pending' ORDER BY idx LIMIT ?",
+                (job_id, limit)
+            ).fetchall()
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE items SET status = 'running', updated_at = ? WHERE job_id = ? AND idx = ?",
+                [(now, job_id, r['idx']) for r in rows]
+            )
+            self.conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (now, job_id))
+        return [
+            {'job_id': job_id, 'params': params, 'idx': r['idx'], 'filename': r['filename'], 'path': r['path']}
+            for r in rows
+        ]
+
+    def finish_items(self, job_id: str, outcomes: List[Dict[str, Any]]) -> bool:
+        """outcomes: list of {'idx', 'result'} or {'idx', 'error'}. True if the job is now completed."""
+        now = time.time()
+        with self.lock, self.conn:
+            for outcome in outcomes:
+                if outcome.get('error') is None:
+                    self.conn.execute(
+                        "UPDATE items SET status = 'done', result = ?, error = NULL, updated_at = ? WHERE job_id = ? AND idx = ?",
+                        (json.dumps(outcome['result']), now, job_id, outcome['idx'])
+                    )
+                else:
+                    self.conn.execute(
+                        "UPDATE items SET status = 'failed', error = ?, updated_at = ? WHERE job_id = ? AND idx = ?",
+                        (str(outcome['error']), now, job_id, outcome['idx'])
+                    )
+            remaining = self.conn.execute(
+                "SELECT COUNT(*) FROM items WHERE job_id = ? AND status IN ('pending', 'running')", (job_id,)
+            ).fetchone()[0]
+            if remaining == 0:
+                self.conn.execute("UPDATE jobs SET status = 'completed', updated_at = ? WHERE id = ?", (now, job_id))
+        return remaining == 0
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(self.conn.execute(
+                "SELECT status, COUNT(*) FROM items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+        done = counts.get('done', 0)
+        failed = counts.get('failed', 0)
+        return {
+            'job_id': job['id'],
+            'status': job['status'],
+            'source': job['source'],
+            'params': json.loads(job['params']),
+            'total': job['total'],
+            'done': done,
+            'failed': failed,
+            'pending': counts.get('pending', 0),
+            'running': counts.get('running', 0),
+            'progress': (done + failed) / job['total'] if job['total'] else 1.0,
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at'],
+        }
+
+    def get_results(self, job_id: str, offset: int = 0, limit: int = 100, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        query = "SELECT idx, filename, status, result, error FROM items WHERE job_id = ?"
+        args = [job_id]
+        if status:
+            query += " AND status = ?"
+            args.append(status)
+        query += " ORDER BY idx LIMIT ? OFFSET ?"
+        args += [limit, offset]
+        with self.lock:
+            rows = self.conn.execute(query, args).fetchall()
+        return [
+            {
+                'index': r['idx'],
+                'filename': r['filename'],
+                'status': r['status'],
+                'result': json.loads(r['result']) if r['result'] else None,
+                'error': r['error'],
+            }
+            for r in rows
+        ]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_job_store() -> JobStore:
+    """Ritorna lo store condiviso (creato alla prima chiamata)."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = JobStore()
+        return _store
@@ -0,0 +1,173 @@
+import time
+import threading
+from typing import Dict, List
+from dotenv import dotenv_values
+
+from app import model_state
+from app.model_fun.preprocess_data import getTransforms
+from app.fun.folder_ingest import prefetch_images, run_batch, save_item_outputs, forget_recorded
+from app.fun.job_store import get_job_store
+from app.fun.structured_log import get_logger, fields
+
+log = get_logger("jobs")
+
+config = dotenv_values(".env")
+
+WIDTH = int(config.get("WIDTH", 256))
+HEIGHT = int(config.get("HEIGHT", 512))
+MEAN = [float(x) for x in config.get("MEAN", '0.5414286851882935 0.5396731495857239 0.3529253602027893').split()]
+STD = [float(x) for x in config.get("STD", '0.2102500945329666 0.23136012256145477 0.19928686320781708').split()]
+
+JOB_BATCH_SIZES = [int(x) for x in config.get("JOB_BATCH_SIZES", "1 2 4 8 16").split()]
+JOB_POLL_INTERVAL = float(config.get("JOB_POLL_INTERVAL", 1.0))
+
+
+class BatchSizeTuner:
+    """
+    Picks the batch size with the best measured throughput (images/s).
+    Every candidate is tried once, then the best one is used, with periodic
+    re-probing of its neighbours so the choice follows load changes.
+    """
+
+    def __init__(self, candidates: List[int], reprobe_every: int = 50, smoothing: float = 0.3):
+        self.candidates = sorted(set(candidates))
+        self.reprobe_every = reprobe_every
+        self.smoothing = smoothing
+        self.throughput: Dict[int, float] = {}
+        self.calls = 0
+
+    def next_size(self) -> int:
+        self.calls += 1
+        for size in self.candidates:
+            if size not in self.throughput:
+                return size
+        best = self.best()
+        if self.calls % self.reprobe_every == 0:
+            pos = self.candidates.index(best)
+            neighbours = self.candidates[max(0, pos - 1):pos + 2]
+            return neighbours[(self.calls // self.reprobe_every) % len(neighbours)]
+        return best
+
+    def record(self, size: int, num_images: int, seconds: float):
+        # Batch incompleti (coda quasi vuota) non dicono nulla sul throughput della size
+        if size not in self.candidates or num_images < size or seconds <= 0:
+            return
+        measured = num_images / seconds
+        previous = self.throughput.get(size)
+        self.throughput[size] = measured if previous is None else (
+            self.smoothing * measured + (1 - self.smoothing) * previous
+        )
+
+    def best(self) -> int:
+        return max(self.throughput, key=self.throughput.get) if self.throughput else self.candidates[0]
+
+
+def process_claimed_items(items, requested_size=None, tuner=None):
+    """
+    Processes one claimed batch (all items belong to the same job) and stores the outcomes.
+    requested_size: the batch size asked of the tuner; a job with fewer items left
+    yields a shorter batch, which is not recorded as a measurement.
+    """
+    store = get_job_store()
+    model, onevall_models, device, CLASS_NAMES = model_state.get_models()
+    params = items[0]['params']
+    job_id = items[0]['job_id']
+    out_dir = params.get('output_dir')
+
+    outcomes = []
+    loaded, loaded_items = [], []
+    for item, ingested, err in prefetch_images(items):
+        if err is None:
+            loaded.append(ingested)
+            loaded_items.append(item)
+        else:
+            outcomes.append({'idx': item['idx'], 'error': err})
+            if out_dir:
+                # Come run_folder: results.jsonl copre ogni input, anche quelli illeggibili
+                save_item_outputs(out_dir, item, None, {'success': False, 'error': err})
+
+    start = time.time()
+    if loaded:
+        transform_pipeline = getTransforms(WIDTH, HEIGHT, True, MEAN, STD)
+        try:
+            results = run_batch(loaded, params, model, onevall_models, device, CLASS_NAMES, transform_pipeline)
+            for item, ingested, result in zip(loaded_items, loaded, results):
+                if out_dir:
+                    result['crops'] = save_item_outputs(
+                        out_dir, item, ingested, result, params.get('save_crops', False), params.get('min_score', 0.0)
+                    )
+                outcomes.append({'idx': item['idx'], 'result': result})
+        except Exception as e:
+            # Gli item già salvati tengono il loro risultato, gli altri falliscono
+            done = {o['idx'] for o in outcomes}
+            for item in loaded_items:
+                if item['idx'] in done:
+                    continue
+                outcomes.append({'idx': item['idx'], 'error': str(e)})
+                if out_dir:
+                    save_item_outputs(out_dir, item, None, {'success': False, 'error': str(e)})
+        finally:
+            for ingested in loaded:
+                ingested['image'].close()
+
+    if tuner is not None and requested_size is not None:
+        tuner.record(requested_size, len(loaded), time.time() - start)
+    if store.finish_items(job_id, outcomes) and out_dir:
+        forget_recorded(out_dir)
+
+
+class JobWorker(threading.Thread):
+    """Background thread that drains the job queue independently of any HTTP client."""
+
+    def __init__(self):
+        super().__init__(name="job-worker", daemon=True)
+        self.tuner = BatchSizeTuner(JOB_BATCH_SIZES)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        store = get_job_store()
+        requeued = store.requeue_running()
+        if requeued:
+            log.info("resumed interrupted items", extra=fields(items=requeued))
+
+        while not self.stop_event.is_set():
+            items = []
+            try:
+                size = self.tuner.next_size()
+                items = store.claim_items(size)
+                if not items:
+                    self.stop_event.wait(JOB_POLL_INTERVAL)
+                    continue
+                process_claimed_items(items, size, self.tuner)
+            except Exception as e:
+                # Il thread non deve morire: i job in coda resterebbero pending per sempre
+                log.exception("job batch failed", extra=fields(items=len(items), error=str(e)))
+                if items:
+                    try:
+                        store.finish_items(items[0]['job_id'], [{'idx': item['idx'], 'error': str(e)} for item in items])
+                    except Exception:
+                        log.exception("cannot store job errors")
+                else:
+                    self.stop_event.wait(JOB_POLL_INTERVAL)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+_worker = None
+
+def start_job_worker():
+    """Avvia il worker una sola volta (chiamato da create_app dopo il caricamento dei modelli)."""
+    global _worker
+    if _worker is None:
+        _worker = JobWorker()
+        _worker.start()
+    return _worker
+
+def get_batch_tuner_stats():
+    if _worker is None:
+        return {}
+    return {
+        'current_best': _worker.tuner.best(),
+        'throughput': {str(k): round(v, 3) for k, v in _worker.tuner.throughput.items()},
+    }
@@ -0,0 +1,171 @@
+import gc
+import time
+import ctypes
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+import torch
+from dotenv import dotenv_values
+
+from app.fun.attribution_engine import current_rss_bytes, _read_int
+
+config = dotenv_values(".env")
+
+# Limite di memoria del processo: esplicito, altrimenti quello del cgroup (container) o la RAM totale
+MEMORY_LIMIT_MB = config.get("MEMORY_LIMIT_MB")
+# Sopra questa frazione del limite si libera memoria (gc + cache CUDA + malloc_trim)
+MEMORY_HIGH_WATER = float(config.get("MEMORY_HIGH_WATER", 0.8))
+# Nuovo lavoro ammesso finché la memoria prevista (vedi _fits) resta sotto questa frazione
+MEMORY_ADMIT_FRACTION = float(config.get("MEMORY_ADMIT_FRACTION", 0.9))
+MEMORY_ADMIT_TIMEOUT = float(config.get("MEMORY_ADMIT_TIMEOUT", 30))
+# Byte per pixel di ogni copia a piena risoluzione (RGBA-equivalente)
+MEMORY_BYTES_PER_PIXEL = float(config.get("MEMORY_BYTES_PER_PIXEL", 4))
+MEMORY_CLEANUP_INTERVAL = float(config.get("MEMORY_CLEANUP_INTERVAL", 2.0))
+
+# Copie a piena risoluzione che ogni percorso tiene vive insieme (immagine, tensori, crop)
+DETECTION_STAGES = 4
+INFERENCE_STAGES = 6
+
+
+def _total_memory_bytes() -> int:
+    limit = _read_int("/sys/fs/cgroup/memory.max") or _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if limit is not None and limit < (1 << 60):
+        return limit
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 8 * 1024 ** 3
+
+def _malloc_trim():
+    # glibc tiene le pagine liberate: malloc_trim le restituisce al sistema
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryBusy(Exception):
+    """Work not admitted within the timeout: the caller answers 503."""
+
+
+class MemoryGovernor:
+    """
+    Admits work by its estimated memory cost (pixels x stages) against the larger of
+    the process RSS and the idle RSS plus the cost of work already running, and frees
+    memory only when RSS crosses the high-water mark instead of after every image.
+    """
+
+    def __init__(self, limit_bytes: Optional[int] = None):
+        self.limit = limit_bytes or (int(float(MEMORY_LIMIT_MB) * 1024 * 1024) if MEMORY_LIMIT_MB else _total_memory_bytes())
+        self.high_water = int(self.limit * MEMORY_HIGH_WATER)
+        self.admit_limit = int(self.limit * MEMORY_ADMIT_FRACTION)
+        self.cond = threading.Condition()
+        self.reserved = 0
+        self.in_flight = 0
+        # RSS a riposo, letto quando nessun lavoro ammesso è in corso
+        self.baseline_rss = 0
+        self.peak_rss = 0
+        self.peak_reserved = 0
+        self.admitted = 0
+        self.waited = 0
+        self.rejected = 0
+        self.cleanups = 0
+        self.last_cleanup = 0.0
+
+    @staticmethod
+    def estimate(size: Tuple[int, int], stages: int) -> int:
+        """Bytes for an image of size (w, h) kept at full resolution through `stages` copies."""
+        return int(size[0] * size[1] * stages * MEMORY_BYTES_PER_PIXEL)
+
+    def _rss(self) -> int:
+        rss = current_rss_bytes()
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def _fits(self, cost: int) -> bool:
+        # Un lavoro da solo passa sempre, anche se stimato oltre il limite
+        if self.in_flight == 0:
+            return True
+        # RSS already includes what running work has allocated: adding every reservation
+        # on top would count it twice. baseline + reserved is the worst case of work not
+        # yet at its peak, the current RSS whatever it actually uses.
+        projected = max(self._rss(), self.baseline_rss + self.reserved)
+        return projected + cost <= self.admit_limit
+
+    def acquire(self, cost: int, timeout: float = MEMORY_ADMIT_TIMEOUT):
+        with self.cond:
+            if not self._fits(cost):
+                self.waited += 1
+                if not self.cond.wait_for(lambda: self._fits(cost), timeout):
+                    self.rejected += 1
+                    raise MemoryBusy(f"Not enough memory for {cost / 1024 ** 2:.0f} MB of work")
+            if self.in_flight == 0:
+                self.baseline_rss = self._rss()
+            self.reserved += cost
+            self.in_flight += 1
+            self.admitted += 1
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+
+    def release(self, cost: int):
+        with self.cond:
+            self.reserved -= cost
+            self.in_flight -= 1
+            self.cond.notify_all()
+        self.check()
+
+    @contextmanager
+    def admit(self, cost: int, timeout: float = MEMORY_ADMIT_TIMEOUT):
+        self.acquire(cost, timeout)
+        try:
+            yield
+        finally:
+            self.release(cost)
+
+    def check(self) -> bool:
+        """Cleanup if RSS is above the high-water mark (at most once per MEMORY_CLEANUP_INTERVAL)."""
+        if self._rss() < self.high_water:
+            return False
+        now = time.monotonic()
+        with self.cond:
+            if now - self.last_cleanup < MEMORY_CLEANUP_INTERVAL:
+                return False
+            self.last_cleanup = now
+            self.cleanups += 1
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        _malloc_trim()
+        with self.cond:
+            # La memoria liberata può sbloccare lavoro in attesa
+            self.cond.notify_all()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            stats = {
+                'rss_bytes': self._rss(),
+                'peak_rss_bytes': self.peak_rss,
+                'limit_bytes': self.limit,
+                'high_water_bytes': self.high_water,
+                'admit_limit_bytes': self.admit_limit,
+                'baseline_rss_bytes': self.baseline_rss,
+                'reserved_bytes': self.reserved,
+                'peak_reserved_bytes': self.peak_reserved,
+                'in_flight': self.in_flight,
+                'admitted': self.admitted,
+                'waited': self.waited,
+                'rejected': self.rejected,
+                'cleanups': self.cleanups,
+            }
+        if torch.cuda.is_available():
+            stats['cuda_allocated_bytes'] = torch.cuda.memory_allocated()
+            stats['cuda_peak_allocated_bytes'] = torch.cuda.max_memory_allocated()
+            stats['cuda_reserved_bytes'] = torch.cuda.memory_reserved()
+        return stats
+
+
+GOVERNOR = MemoryGovernor()
@@ -21,6 +21,16 @@ CLASS_NAMES = ['O. exaltata', 'O. garganica', 'O. incubacea', 'O. majellensis',
 
 # --- FUNZIONE DI CARICAMENTO MODELLI ---
 
+def main_model_path() -> str:
+    """Percorso del modello 6-Class configurato, con il fallback su app/models/model.pt."""
+    if os.path.exists(SIXCLASS_MODEL_PATH):
+        return SIXCLASS_MODEL_PATH
+    fallback = "app/models/model.pt"
+    if os.path.exists(fallback):
+        print(f"Warning: Configured path not found. Using fallback: {fallback}", flush=True)
+        return fallback
+    raise FileNotFoundError(f"Main model not found at {SIXCLASS_MODEL_PATH}")
+
 def load_resources() -> Dict[str, Any]:
     """
     Carica il device, il modello 5-Class e i modelli 1-vs-All.
@@ -41,16 +51,7 @@ def load_resources() -> Dict[str, Any]:
 
     # 1. Load 5-Class Model
     try:
-        current_model_path = SIXCLASS_MODEL_PATH
-        if not os.path.exists(current_model_path):
-            fallback = "app/models/model.pt"
-            if os.path.exists(fallback):
-                print(f"Warning: Configured path not found. Using fallback: {fallback}", flush=True)
-                current_model_path = fallback
-            else:
-                raise FileNotFoundError(f"Main model not found at {SIXCLASS_MODEL_PATH}")
-        
-        model = loadModel(current_model_path, len(CLASS_NAMES), device)
+        model = loadModel(main_model_path(), len(CLASS_NAMES), device)
         print("Success: six Class Model loaded.", flush=True)
     except Exception as e:
         print(f"CRITICAL ERROR: Failed to load 5-Class Model. {e}", flush=True)
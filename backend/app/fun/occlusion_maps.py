@@ -0,0 +1,133 @@
+import time
+import uuid
+import threading
+import collections
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import torch
+from dotenv import dotenv_values
+
+from app.fun.attribution_engine import ENGINE, PeakMemorySampler
+from app.fun.adaptive_occlusion import grid_windows, occluded_outputs, accumulate_map
+
+config = dotenv_values(".env")
+
+# Quante mappe di occlusione (tutte le classi) tenere in memoria per le richieste successive
+OCCLUSION_MAP_STORE_SIZE = int(config.get("OCCLUSION_MAP_STORE_SIZE", 32))
+
+
+def all_class_occlusion(model, input_tensor: torch.Tensor, window: int = 30, stride: int = 25,
+                        baseline: float = 0.0) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """
+    One occlusion sweep over a (1, C, H, W) input that keeps the logits of every class
+    for every window, instead of a single target. Returns (attributions (num_classes, H, W),
+    stats): attributions[k] is the occlusion map of class k, i.e. base logit minus
+    occluded logit averaged over the windows covering each pixel.
+    """
+    model.eval()
+    _, _, height, width = input_tensor.shape
+    batch_size = ENGINE.occlusion_batch_size() if ENGINE.calibrated else 8
+    windows = grid_windows(height, width, window, stride)
+    start = time.perf_counter()
+
+    with PeakMemorySampler(input_tensor.device) as sampler:
+        with torch.no_grad():
+            base_logits = model(input_tensor).detach().cpu()[0]
+        occluded = occluded_outputs(model, input_tensor, windows, batch_size, baseline)
+        deltas = base_logits.unsqueeze(0) - occluded  # (N windows, num_classes)
+        maps, _ = accumulate_map(height, width, windows, deltas)
+
+    stats = ENGINE.record('occlusion', {
+        'seconds': time.perf_counter() - start,
+        'peak_memory_bytes': sampler.peak_delta,
+        'forward_passes': len(windows),
+        'classes': int(base_logits.shape[0]),
+        'perturbations_per_eval': batch_size,
+    })
+    return maps, stats
+
+def class_attribution_hwc(maps: torch.Tensor, class_idx: int, channels: int = 3) -> np.ndarray:
+    """(num_classes, H, W) -> (H, W, channels) map of one class, the layout the heatmap renderer expects."""
+    class_map = maps[class_idx].float().numpy()
+    return np.repeat(class_map[:, :, None], channels, axis=2)
+
+
+class OcclusionMapStore:
+    """
+    Bounded LRU of all-class occlusion maps, so another class, the dominance map or
+    hover values can be served without re-running the sweep. Maps are kept as float16
+    (num_classes, H, W); the display image as uint8 (H, W, 3).
+    """
+
+    def __init__(self, max_entries: int = OCCLUSION_MAP_STORE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, maps: torch.Tensor, display_image: np.ndarray, target: int, stride: int = 25) -> str:
+        map_id = uuid.uuid4().hex
+        entry = {
+            'maps': maps.to(torch.float16).contiguous(),
+            'image': (np.clip(display_image, 0, 1) * 255).astype(np.uint8),
+            'target': int(target),
+            'stride': int(stride),
+        }
+        self.restore(map_id, entry)
+        return map_id
+
+    def restore(self, map_id: str, entry: Dict[str, Any]):
+        """Inserts an entry exported by another process's store (see pop)."""
+        with self.lock:
+            self.entries[map_id] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, map_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return self.entries.pop(map_id, None)
+
+    def get(self, map_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(map_id)
+            if entry is not None:
+                self.entries.move_to_end(map_id)
+            return entry
+
+    def dominance(self, map_id: str) -> Optional[Dict[str, Any]]:
+        """Class with the largest positive attribution per cell, sampled every `stride` pixels."""
+        entry = self.get(map_id)
+        if entry is None:
+            return None
+        maps, stride = entry['maps'], entry['stride']
+        sampled = maps[:, ::stride, ::stride].float()
+        dominant = sampled.argmax(dim=0)
+        # Celle dove nessuna classe perde logit all'occlusione: nessuna classe dominante
+        dominant[sampled.max(dim=0).values <= 0] = -1
+        return {
+            'stride': stride,
+            'height': int(maps.shape[1]),
+            'width': int(maps.shape[2]),
+            'grid': dominant.tolist(),
+        }
+
+    def hover(self, map_id: str, x: int, y: int) -> Optional[List[Tuple[int, float]]]:
+        """[(class_idx, attribution)] at pixel (x, y), sorted by attribution descending."""
+        entry = self.get(map_id)
+        if entry is None:
+            return None
+        maps = entry['maps']
+        y = min(max(0, y), maps.shape[1] - 1)
+        x = min(max(0, x), maps.shape[2] - 1)
+        values = maps[:, y, x].float().tolist()
+        return sorted(enumerate(values), key=lambda kv: kv[1], reverse=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': sum(e['maps'].numel() * 2 + e['image'].nbytes for e in self.entries.values()),
+            }
+
+
+OCCLUSION_MAPS = OcclusionMapStore()
@@ -0,0 +1,176 @@
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, List
+
+from app.fun.telemetry import bind, QUEUE_DEPTH
+
+_END = object()
+
+
+class Stage:
+    """
+    One step of a StagePipeline.
+
+    fn receives a list of payloads (at most batch_size, fewer if the input queue
+    runs dry) and must return a list of the same length. An exception fails every
+    item of that call; failed items skip the remaining stages.
+    """
+
+    def __init__(self, name: str, fn: Callable[[List[Any]], List[Any]], workers: int = 1,
+                 batch_size: int = 1, queue_size: int = 8):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.queue_size = max(1, queue_size)
+
+
+class _StageStats:
+    def __init__(self, stage: Stage):
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.busy = 0.0
+        self.items = 0
+        self.calls = 0
+        self.errors = 0
+        self.max_queue = 0
+
+    def as_dict(self, wall: float) -> Dict[str, Any]:
+        capacity = wall * self.stage.workers
+        return {
+            'workers': self.stage.workers,
+            'batch_size': self.stage.batch_size,
+            'items': self.items,
+            'calls': self.calls,
+            'errors': self.errors,
+            'busy_seconds': round(self.busy, 4),
+            'utilization': round(self.busy / capacity, 4) if capacity > 0 else 0.0,
+            'avg_batch': round(self.items / self.calls, 2) if self.calls else 0.0,
+            'max_queue_depth': self.max_queue,
+        }
+
+
+class StagePipeline:
+    """
+    Runs items through a chain of stages, each with its own worker threads and a
+    bounded input queue, so that e.g. detection of image N+1 overlaps
+    classification of image N. Results are returned in input order.
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self.stats: List[_StageStats] = []
+        self.wall = 0.0
+
+    def _worker(self, idx, in_q, out_q, stats, state):
+        stage = self.stages[idx]
+        while True:
+            envelope = in_q.get()
+            if envelope is _END:
+                in_q.put(_END)  # lascia la sentinella agli altri worker dello stesso stage
+                break
+            batch = [envelope]
+            while len(batch) < stage.batch_size:
+                try:
+                    nxt = in_q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _END:
+                    in_q.put(_END)
+                    break
+                batch.append(nxt)
+
+            depth = in_q.qsize() + len(batch)
+            QUEUE_DEPTH.observe(depth, stage=stage.name)
+            with stats.lock:
+                stats.max_queue = max(stats.max_queue, depth)
+
+            live = [e for e in batch if e[2] is None]
+            start = time.perf_counter()
+            if live:
+                try:
+                    outputs = stage.fn([e[1] for e in live])
+                    if len(outputs) != len(live):
+                        raise RuntimeError(f"Stage '{stage.name}' returned {len(outputs)} outputs for {len(live)} inputs")
+                    live = [(e[0], out, None) for e, out in zip(live, outputs)]
+                except Exception as e:
+                    live = [(env[0], None, f"{stage.name}: {e}") for env in live]
+                    with stats.lock:
+                        stats.errors += len(live)
+            elapsed = time.perf_counter() - start
+
+            with stats.lock:
+                stats.busy += elapsed
+                stats.items += len(live)
+                stats.calls += 1 if live else 0
+
+            for e in live + [e for e in batch if e[2] is not None]:
+                out_q.put(e)
+
+        with state['lock']:
+            state['alive'][idx] -= 1
+            if state['alive'][idx] == 0:
+                out_q.put(_END)
+
+    def run(self, payloads: Iterable[Any]) -> List[Dict[str, Any]]:
+        """
+        Returns one {'index', 'result', 'error'} dict per input payload, in input order.
+        An exception raised while iterating `payloads` is re-raised here once the
+        items already fed have drained.
+        """
+        self.stats = [_StageStats(stage) for stage in self.stages]
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages] + [queue.Queue()]
+        state = {'lock': threading.Lock(), 'alive': [stage.workers for stage in self.stages]}
+
+        start = time.perf_counter()
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for w in range(stage.workers):
+                t = threading.Thread(
+                    # bind: gli span dei worker finiscono nel Server-Timing della richiesta
+                    target=bind(self._worker), args=(i, queues[i], queues[i + 1], self.stats[i], state),
+                    name=f"pipeline-{stage.name}-{w}", daemon=True
+                )
+                t.start()
+                threads.append(t)
+
+        feed_error = []
+
+        def feed():
+            # La sentinella parte sempre, anche se l'iteratore dei payload solleva:
+            # altrimenti il collector resterebbe bloccato su queues[-1]
+            try:
+                for i, payload in enumerate(payloads):
+                    queues[0].put((i, payload, None))
+            except Exception as e:
+                feed_error.append(e)
+            finally:
+                queues[0].put(_END)
+
+        feeder = threading.Thread(target=feed, name="pipeline-feeder", daemon=True)
+        feeder.start()
+
+        collected = []
+        while True:
+            envelope = queues[-1].get()
+            if envelope is _END:
+                break
+            collected.append(envelope)
+
+        feeder.join()
+        for t in threads:
+            t.join()
+        self.wall = time.perf_counter() - start
+        if feed_error:
+            raise feed_error[0]
+
+        collected.sort(key=lambda e: e[0])
+        return [{'index': i, 'result': result, 'error': error} for i, result, error in collected]
+
+    def report(self) -> Dict[str, Any]:
+        """Per-stage utilization of the last run."""
+        return {
+            'wall_seconds': round(self.wall, 4),
+            'stages': {s.stage.name: s.as_dict(self.wall) for s in self.stats},
+        }
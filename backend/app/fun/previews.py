@@ -0,0 +1,148 @@
+import io
+import os
+import re
+import hashlib
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+from PIL import Image
+from dotenv import dotenv_values
+
+from app.fun.ingest import EXIF_ORIENTATION_TAG, _TRANSPOSE
+
+config = dotenv_values(".env")
+
+PREVIEW_MAX_SIDE = int(config.get("PREVIEW_MAX_SIDE", 1024))
+PREVIEW_QUALITY = 75
+# Fa parte della chiave: cambiare resa o qualità invalida le anteprime già salvate
+PREVIEW_VERSION = 3
+PREVIEW_CACHE_DIR = config.get("PREVIEW_CACHE_DIR", os.path.join(tempfile.gettempdir(), "orchitech_previews"))
+PREVIEW_CACHE_MAX_MB = float(config.get("PREVIEW_CACHE_MAX_MB", 512))
+# Il contenuto di una chiave non cambia mai: il browser può tenerla per sempre
+PREVIEW_MAX_AGE = 365 * 24 * 3600
+
+_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+def preview_key(data: bytes, max_side: int = PREVIEW_MAX_SIDE) -> str:
+    """Content address of a preview: hash of the original bytes and of how the preview is made."""
+    digest = hashlib.blake2b(data, digest_size=20)
+    digest.update(f"|{max_side}|{PREVIEW_QUALITY}|v{PREVIEW_VERSION}".encode())
+    return digest.hexdigest()
+
+def make_preview(data: bytes, max_side: int = PREVIEW_MAX_SIDE) -> bytes:
+    """
+    JPEG preview fitting in max_side x max_side, decoded at reduced scale: for JPEGs
+    draft() lets the decoder produce 1/2, 1/4 or 1/8 of the resolution directly, the
+    rest is a bilinear resample of an already small image. EXIF orientation is applied
+    so the preview matches the image the boxes refer to (see ingest.py).
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        img.draft("RGB", (max_side, max_side))
+        preview_img = img.convert("RGB")
+    preview_img.thumbnail((max_side, max_side), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    if orientation in _TRANSPOSE:
+        preview_img = preview_img.transpose(_TRANSPOSE[orientation])
+    buffered = io.BytesIO()
+    preview_img.save(buffered, format="JPEG", quality=PREVIEW_QUALITY)
+    return buffered.getvalue()
+
+
+class PreviewStore:
+    """
+    Content-addressed previews on disk (GET /dbinference/previews/<key>). The same
+    photo at the same size maps to the same key, so it is rendered once; above
+    PREVIEW_CACHE_MAX_MB the least recently used files are removed.
+    """
+
+    def __init__(self, root: str = PREVIEW_CACHE_DIR, max_bytes: int = int(PREVIEW_CACHE_MAX_MB * 1024 * 1024)):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+        self.bytes = sum(
+            os.path.getsize(os.path.join(dirpath, name))
+            for dirpath, _, names in os.walk(self.root) for name in names
+        )
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.jpg")
+
+    def path(self, key: str) -> Optional[str]:
+        """File of a stored preview, None for unknown or malformed keys."""
+        if not _KEY_RE.match(key):
+            return None
+        path = self._path(key)
+        return path if os.path.exists(path) else None
+
+    def get_or_create(self, data: bytes, max_side: int = PREVIEW_MAX_SIDE) -> str:
+        """Key of the preview of `data`, rendered and stored only if not already there."""
+        key = preview_key(data, max_side)
+        path = self._path(key)
+        if os.path.exists(path):
+            try:
+                os.utime(path)  # mtime = ultimo uso, per la pulizia LRU
+            except OSError:
+                pass
+            with self.lock:
+                self.hits += 1
+            return key
+
+        preview = make_preview(data, max_side)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(preview)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.misses += 1
+            self.bytes += len(preview)
+            if self.bytes > self.max_bytes:
+                self._prune()
+        return key
+
+    def read(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _prune(self):
+        # Scende al 90% del limite togliendo i file usati meno di recente
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        self.bytes = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.bytes -= size
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+PREVIEWS = PreviewStore()
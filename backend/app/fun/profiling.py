@@ -0,0 +1,333 @@
+import os
+import sys
+import signal
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+import collections
+from typing import Any, Dict, List, Optional
+import torch
+from torch.profiler import profile, ProfilerActivity
+from dotenv import dotenv_values
+
+from app.fun.structured_log import get_logger, fields
+
+log = get_logger("profiling")
+
+config = dotenv_values(".env")
+
+# Cartella montata da docker-compose: i file restano sull'host
+PROFILE_DIR = config.get("PROFILE_DIR", os.path.join(config.get("TEST_RESULTS_ROOT", "test_results"), "profiles"))
+# Se impostato, POST /admin/profile richiede l'header X-Admin-Token; altrimenti solo da localhost
+PROFILE_ADMIN_TOKEN = config.get("PROFILE_ADMIN_TOKEN")
+# kill -USR2 <pid>: profila le prossime PROFILE_SIGNAL_REQUESTS richieste
+PROFILE_SIGNAL_REQUESTS = int(config.get("PROFILE_SIGNAL_REQUESTS", 10))
+PROFILE_SAMPLE_INTERVAL = float(config.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_MAX_REQUESTS = 100
+PROFILE_MAX_SECONDS = 300
+OPS_ROW_LIMIT = 60
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of every thread (pools and pipeline workers included)
+    every `interval` seconds; written as folded stacks, the flamegraph input format.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Capture:
+    """
+    One profiling capture: torch.profiler (operator CPU time, memory, shapes), the
+    stack sampler and, for a single request, cProfile of the thread serving it.
+    """
+
+    def __init__(self, use_torch: bool = True, use_python: bool = True, cprofile: bool = False):
+        self.torch_prof = None
+        if use_torch:
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self.torch_prof = profile(activities=activities, profile_memory=True, record_shapes=True)
+        self.sampler = StackSampler() if use_python else None
+        self.cprofile = cProfile.Profile() if (use_python and cprofile) else None
+        self.started = None
+        self.seconds = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.torch_prof is not None:
+            self.torch_prof.start()
+        if self.sampler is not None:
+            self.sampler.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.torch_prof is not None:
+            self.torch_prof.stop()
+        self.seconds = time.perf_counter() - self.started
+
+    def write(self, prefix: str, meta: Dict[str, Any]) -> List[str]:
+        """<prefix>.trace.json (chrome://tracing, Perfetto), .ops.txt, .pstats, .folded.txt, .json (meta)."""
+        written = []
+        if self.torch_prof is not None:
+            self.torch_prof.export_chrome_trace(f"{prefix}.trace.json")
+            sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+            with open(f"{prefix}.ops.txt", "w") as f:
+                f.write(self.torch_prof.key_averages().table(sort_by=sort_by, row_limit=OPS_ROW_LIMIT))
+                f.write("\n\n")
+                f.write(self.torch_prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=OPS_ROW_LIMIT))
+            written += [f"{prefix}.trace.json", f"{prefix}.ops.txt"]
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(f"{prefix}.pstats")
+            with open(f"{prefix}.pstats.txt", "w") as f:
+                pstats.Stats(self.cprofile, stream=f).sort_stats("cumulative").print_stats(OPS_ROW_LIMIT)
+            written += [f"{prefix}.pstats", f"{prefix}.pstats.txt"]
+        if self.sampler is not None:
+            self.sampler.write(f"{prefix}.folded.txt")
+            meta = {**meta, 'python_samples': self.sampler.samples, 'sample_interval': self.sampler.interval}
+            written.append(f"{prefix}.folded.txt")
+        with open(f"{prefix}.json", "w") as f:
+            json.dump({**meta, 'seconds': round(self.seconds, 4), 'files': [os.path.basename(p) for p in written]}, f, indent=2, default=str)
+        return written
+
+
+class Profiler:
+    """
+    On-demand profiling of live traffic: armed for the next N requests or for a time
+    window (POST /admin/profile or SIGUSR2), without restarting the app.
+    Request mode profiles one request at a time: a request arriving while another is
+    being profiled runs unprofiled and does not use up a slot.
+    """
+
+    def __init__(self, root: str = PROFILE_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.session: Optional[Dict[str, Any]] = None
+        self.active = False
+        self.window: Optional[Capture] = None
+        self.history = collections.deque(maxlen=20)
+
+    def arm(self, requests: Optional[int] = None, seconds: Optional[float] = None,
+            use_torch: bool = True, use_python: bool = True, label: str = "") -> Dict[str, Any]:
+        """Starts a session; raises RuntimeError if one is already running."""
+        if not requests and not seconds:
+            raise ValueError("Either requests or seconds is required")
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError(f"Profiling session {self.session['id']} already running")
+            session_id = f"{time.strftime('%Y%m%d_%H%M%S')}_{label or ('window' if seconds else 'requests')}_{uuid.uuid4().hex[:6]}"
+            self.session = {
+                'id': session_id,
+                'dir': os.path.join(self.root, session_id),
+                'mode': 'window' if seconds else 'requests',
+                'remaining': min(int(requests), PROFILE_MAX_REQUESTS) if requests else None,
+                'seconds': min(float(seconds), PROFILE_MAX_SECONDS) if seconds else None,
+                'torch': use_torch,
+                'python': use_python,
+                'captured': 0,
+                'requests': [],
+                'started_at': time.time(),
+            }
+            os.makedirs(self.session['dir'], exist_ok=True)
+            if seconds:
+                self.window = Capture(use_torch, use_python)
+                self.window.start()
+                timer = threading.Timer(self.session['seconds'], self._finish_window, args=(self.session,))
+                timer.daemon = True
+                timer.start()
+            session = dict(self.session)
+        log.info("profiling armed", extra=fields(session=session['id'], mode=session['mode'],
+                                                  requests=session['remaining'], seconds=session['seconds']))
+        return session
+
+    def disarm(self) -> Optional[str]:
+        with self.lock:
+            session = self.session
+        if session is None:
+            return None
+        if session['mode'] == 'window':
+            self._finish_window(session)
+        else:
+            self._close(session)
+        return session['id']
+
+    def _close(self, session):
+        with self.lock:
+            if self.session is not session:
+                return False
+            self.session = None
+            self.history.append({k: session[k] for k in ('id', 'dir', 'mode', 'captured')})
+        with open(os.path.join(session['dir'], "requests.jsonl"), "w") as f:
+            for entry in session['requests']:
+                f.write(json.dumps(entry, default=str) + "\n")
+        log.info("profiling done", extra=fields(session=session['id'], dir=session['dir'], captured=session['captured']))
+        return True
+
+    def _finish_window(self, session):
+        with self.lock:
+            capture, self.window = self.window, None
+            if self.session is not session or capture is None:
+                return
+        capture.stop()
+        session['captured'] = len(session['requests'])
+        try:
+            capture.write(os.path.join(session['dir'], "window"), {'session': session['id'], 'mode': 'window',
+                                                                   'requests': len(session['requests'])})
+        except Exception as e:
+            log.error("profile not written", extra=fields(session=session['id'], error=str(e)))
+        self._close(session)
+
+    def begin_request(self) -> Optional[Dict[str, Any]]:
+        """Called before a request: a started Capture if this request is to be profiled, else None."""
+        with self.lock:
+            session = self.session
+            if session is None or session['mode'] != 'requests' or self.active or session['remaining'] <= 0:
+                return None
+            self.active = True
+            session['remaining'] -= 1
+            session['captured'] += 1
+            seq = session['captured']
+        try:
+            capture = Capture(session['torch'], session['python'], cprofile=True)
+            capture.start()
+        except Exception as e:
+            log.error("profiling capture failed to start", extra=fields(error=str(e)))
+            with self.lock:
+                self.active = False
+            return None
+        return {'capture': capture, 'session': session, 'seq': seq}
+
+    def end_request(self, handle: Optional[Dict[str, Any]], meta: Dict[str, Any]):
+        """Called after a request with its parameters; files are written off the request thread."""
+        with self.lock:
+            session = self.session
+        if handle is None:
+            if session is not None and session['mode'] == 'window':
+                session['requests'].append(meta)
+            return
+        capture, session = handle['capture'], handle['session']
+        try:
+            capture.stop()
+        finally:
+            with self.lock:
+                self.active = False
+        session['requests'].append({**meta, 'seq': handle['seq']})
+        prefix = os.path.join(session['dir'], f"req_{handle['seq']:03d}_{meta.get('endpoint') or 'unmatched'}")
+        last = session['remaining'] <= 0
+        threading.Thread(target=self._write_request, args=(capture, prefix, meta, session, last),
+                         name="profile-writer", daemon=True).start()
+
+    def _write_request(self, capture, prefix, meta, session, last):
+        try:
+            capture.write(prefix, {'session': session['id'], **meta})
+        except Exception as e:
+            log.error("profile not written", extra=fields(session=session['id'], error=str(e)))
+        if last:
+            self._close(session)
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            session = self.session
+            current = None
+            if session is not None:
+                current = {k: session[k] for k in ('id', 'dir', 'mode', 'remaining', 'seconds', 'captured', 'started_at')}
+            return {'session': current, 'recent': list(self.history)}
+
+
+PROFILER = Profiler()
+
+
+def request_meta(request, response=None) -> Dict[str, Any]:
+    """Parameters of a request for the capture: form fields, file names and sizes, query string."""
+    from flask import g
+    form = {k: (v if len(v) <= 500 else v[:500] + "...") for k, v in request.form.items()}
+    files = [{'field': k, 'filename': f.filename, 'content_type': f.content_type} for k, f in request.files.items(multi=True)]
+    return {
+        'endpoint': request.endpoint,
+        'method': request.method,
+        'path': request.path,
+        'args': request.args.to_dict(),
+        'form': form,
+        'files': files,
+        'content_length': request.content_length,
+        'request_id': g.get('request_id'),
+        'status': response.status_code if response is not None else None,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def _arm_from_signal():
+    try:
+        PROFILER.arm(requests=PROFILE_SIGNAL_REQUESTS, label="signal")
+    except RuntimeError as e:
+        log.warning("profiling signal ignored", extra=fields(error=str(e)))
+
+def _on_signal(signum, frame):
+    # L'handler interrompe il thread principale, che potrebbe tenere il lock: si arma da un altro thread
+    threading.Thread(target=_arm_from_signal, name="profile-signal", daemon=True).start()
+
+def init_app(app, skip_blueprints=('profiling', 'metrics')):
+    """Profiles armed requests (the admin and metrics endpoints never are) and installs the SIGUSR2 trigger."""
+    from flask import g, request
+
+    @app.before_request
+    def _begin_profile():
+        if request.blueprint not in skip_blueprints:
+            g.profile_handle = PROFILER.begin_request()
+
+    @app.after_request
+    def _end_profile(response):
+        if 'profile_handle' in g:
+            handle = g.pop('profile_handle')
+            if handle is not None or PROFILER.session is not None:
+                PROFILER.end_request(handle, request_meta(request, response))
+        return response
+
+    try:
+        signal.signal(signal.SIGUSR2, _on_signal)
+    except (ValueError, AttributeError):
+        # Non dal thread principale (o piattaforma senza SIGUSR2): resta l'endpoint
+        pass
@@ -0,0 +1,37 @@
+from typing import Optional, Set, Dict, Any
+
+# Optional outputs a caller can ask for with the `fields` form parameter
+# (comma separated). Label, confidence and errors are always returned.
+FIELD_KEYS = {
+    'probs': ['all_classes_probs', 'all_classes_probs_cropped'],
+    'crop_preview': ['image_cropped'],
+    'image': ['image'],
+    'boxes': ['boxes', 'scores'],
+    'explanations': ['occlusion', 'integrated_gradients', 'occlusion_cropped', 'integrated_gradients_cropped',
+                     'occlusion_map_id', 'occlusion_map_id_cropped', 'gradcam', 'gradcam_cropped'],
+}
+ALL_FIELDS = frozenset(FIELD_KEYS)
+
+# What the endpoints returned before `fields` existed
+SINGLE_DEFAULT_FIELDS = ALL_FIELDS
+BATCH_DEFAULT_FIELDS = ALL_FIELDS - {'image'}
+
+def parse_fields(value: Optional[str], default=ALL_FIELDS) -> Set[str]:
+    """'probs,boxes' -> {'probs', 'boxes'}; 'all' or missing -> default."""
+    if value is None or value.strip() == "":
+        return set(default)
+    if value.strip() == "all":
+        return set(ALL_FIELDS)
+    fields = {f.strip() for f in value.split(",") if f.strip()}
+    unknown = fields - ALL_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. Valid: {', '.join(sorted(ALL_FIELDS))}")
+    return fields
+
+def filter_result(result: Dict[str, Any], fields: Set[str]) -> Dict[str, Any]:
+    """Drops the keys of every optional field that was not requested."""
+    for field, keys in FIELD_KEYS.items():
+        if field not in fields:
+            for key in keys:
+                result.pop(key, None)
+    return result
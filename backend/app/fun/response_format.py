@@ -0,0 +1,114 @@
+import json
+import uuid
+from typing import Any, Dict, List, Tuple
+from flask import Response, request
+
+from app.fun.explainability_fun import ImagePayload
+
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+# Response formats accepted via ?format= / form field `format` or the Accept header.
+# JSON stays the default; images are base64 strings only in JSON.
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+MULTIPART_MIMETYPE = "multipart/mixed"
+
+
+def negotiate_format() -> str:
+    """'json' | 'msgpack' | 'multipart' from the explicit parameter, else the Accept header."""
+    explicit = request.args.get("format") or request.form.get("format")
+    if explicit:
+        return explicit.lower()
+    accept = request.headers.get("Accept", "")
+    for mimetype in accept.split(","):
+        mimetype = mimetype.split(";")[0].strip().lower()
+        if mimetype in MSGPACK_MIMETYPES:
+            return "msgpack"
+        if mimetype == MULTIPART_MIMETYPE:
+            return "multipart"
+        if mimetype in ("application/json", "*/*"):
+            return "json"
+    return "json"
+
+
+def _to_json_compatible(obj):
+    if isinstance(obj, ImagePayload):
+        return obj.to_base64()
+    if isinstance(obj, dict):
+        return {k: _to_json_compatible(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_json_compatible(v) for v in obj]
+    return obj
+
+def _extract_parts(obj, path: str, parts: List[Tuple[str, ImagePayload]]):
+    """Replaces every ImagePayload with {'$part': <name>} and collects the raw bytes."""
+    if isinstance(obj, ImagePayload):
+        parts.append((path, obj))
+        return {'$part': path}
+    if isinstance(obj, dict):
+        return {k: _extract_parts(v, f"{path}.{k}" if path else str(k), parts) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_extract_parts(v, f"{path}.{i}", parts) for i, v in enumerate(obj)]
+    return obj
+
+def _msgpack_default(obj):
+    if isinstance(obj, ImagePayload):
+        return bytes(obj)
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+def to_json(payload) -> str:
+    """Compact JSON with every ImagePayload as base64 (also used for server-sent events)."""
+    return json.dumps(_to_json_compatible(payload), separators=(",", ":"))
+
+def _json_response(payload, status):
+    return Response(to_json(payload), status=status, mimetype="application/json")
+
+def _msgpack_response(payload, status):
+    # ImagePayload is a bytes subclass: msgpack writes it as bin without base64.
+    # Floats are packed as float32, enough for probabilities/confidences.
+    body = msgpack.packb(payload, default=_msgpack_default, use_bin_type=True, use_single_float=True)
+    return Response(body, status=status, mimetype="application/msgpack")
+
+def _multipart_response(payload, status):
+    parts: List[Tuple[str, ImagePayload]] = []
+    skeleton = _extract_parts(payload, "", parts)
+    boundary = uuid.uuid4().hex
+
+    chunks = [
+        f"--{boundary}\r\nContent-Type: application/json\r\nContent-Disposition: inline; name=\"json\"\r\n\r\n".encode(),
+        json.dumps(skeleton, separators=(",", ":")).encode(),
+        b"\r\n",
+    ]
+    for name, data in parts:
+        chunks.append(
+            f"--{boundary}\r\nContent-Type: {data.mimetype}\r\nContent-Disposition: inline; name=\"{name}\"\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n".encode()
+        )
+        chunks.append(bytes(data))
+        chunks.append(b"\r\n")
+    chunks.append(f"--{boundary}--\r\n".encode())
+    return Response(b"".join(chunks), status=status, content_type=f"{MULTIPART_MIMETYPE}; boundary={boundary}")
+
+
+def make_response(payload: Dict[str, Any], status: int = 200) -> Response:
+    """
+    Serializes an endpoint payload in the negotiated format:
+    - json:      images as base64 strings (default, unchanged for existing clients)
+    - msgpack:   images as raw binary, floats as float32
+    - multipart: a JSON part where images are {'$part': name} references, followed
+                 by one raw image/jpeg (or png) part per image
+    """
+    fmt = negotiate_format()
+    if fmt == "msgpack":
+        if not HAS_MSGPACK:
+            return _json_response({'error': 'MessagePack support is not installed on the server'}, 406)
+        return _msgpack_response(payload, status)
+    if fmt == "multipart":
+        return _multipart_response(payload, status)
+    if fmt != "json":
+        return _json_response({'error': f"Unsupported format: {fmt}"}, 406)
+    return _json_response(payload, status)
@@ -0,0 +1,145 @@
+import re
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+
+LOG_LEVEL = config.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = config.get("LOG_FORMAT", "json")  # 'json' | 'text'
+# Frazione delle inferenze di cui registrare il dettaglio (probabilità, confidenza)
+LOG_SAMPLE_RATE = float(config.get("LOG_SAMPLE_RATE", 0.01))
+# Record in attesa di essere scritti: oltre, vengono scartati invece di bloccare chi logga
+LOG_QUEUE_SIZE = int(config.get("LOG_QUEUE_SIZE", 10000))
+
+# Correlation id of the request being served, propagated to pools by telemetry.bind
+REQUEST_ID: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+_setup_lock = threading.Lock()
+_handler: Optional["DroppingQueueHandler"] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"orchitech.{name}")
+
+def fields(**values) -> Dict[str, Any]:
+    """extra= for a log call: values become top-level keys of the JSON line."""
+    return {'fields': values}
+
+def sampled(rate: float = LOG_SAMPLE_RATE) -> bool:
+    """True for about `rate` of the calls: per-inference detail is logged only then."""
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+class _RequestIdFilter(logging.Filter):
+    # Gira nel thread che logga: lì il contextvar ha ancora l'id della richiesta
+    def filter(self, record):
+        record.request_id = REQUEST_ID.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', '-'),
+            'thread': record.threadName,
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} [{getattr(record, 'request_id', '-')}] {record.name}: {record.getMessage()}"
+        extra = getattr(record, 'fields', None)
+        if extra:
+            line += " " + " ".join(f"{k}={v}" for k, v in extra.items())
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the writer thread; never blocks, drops (and counts) when the queue is full."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, queue_size: int = LOG_QUEUE_SIZE) -> DroppingQueueHandler:
+    """
+    Routes the 'orchitech' loggers through a bounded queue to one writer thread, so
+    request threads only format the message and enqueue it. Idempotent.
+    """
+    global _handler
+    with _setup_lock:
+        if _handler is not None:
+            return _handler
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        log_queue = queue.Queue(maxsize=queue_size)
+        handler = DroppingQueueHandler(log_queue)
+        handler.addFilter(_RequestIdFilter())
+        listener = QueueListener(log_queue, stream, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+        root = logging.getLogger("orchitech")
+        root.setLevel(level)
+        root.addHandler(handler)
+        root.propagate = False
+        _handler = handler
+        return handler
+
+def stats() -> Dict[str, Any]:
+    if _handler is None:
+        return {'queued': 0, 'dropped': 0}
+    return {'queued': _handler.queue.qsize(), 'dropped': _handler.dropped}
+
+
+def init_app(app):
+    """Logging setup plus a correlation id per request (X-Request-ID in and out)."""
+    from flask import g, request
+    setup_logging()
+
+    @app.before_request
+    def _bind_request_id():
+        incoming = request.headers.get('X-Request-ID', '')
+        request_id = incoming if _REQUEST_ID_RE.match(incoming) else uuid.uuid4().hex
+        g.request_id = request_id
+        g.request_id_token = REQUEST_ID.set(request_id)
+
+    @app.after_request
+    def _send_request_id(response):
+        if 'request_id' in g:
+            response.headers['X-Request-ID'] = g.request_id
+        return response
+
+    @app.teardown_request
+    def _unbind_request_id(_exc):
+        token = g.pop('request_id_token', None)
+        if token is not None:
+            try:
+                REQUEST_ID.reset(token)
+            except ValueError:
+                REQUEST_ID.set("-")
@@ -0,0 +1,271 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from dotenv import dotenv_values
+
+from app.fun.structured_log import get_logger, fields
+
+config = dotenv_values(".env")
+
+# Server-Timing nella risposta: sempre, oppure solo se il client lo chiede (header X-Timing: 1 o ?timing=1)
+TIMING_HEADER_ALWAYS = config.get("TIMING_HEADER_ALWAYS", "false").lower() == "true"
+
+# Secondi: dal decode di una miniatura (ms) all'occlusion completa (decine di s)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+log = get_logger("metrics")
+
+# Spans of the current request: a list shared by every thread working for it (see bind)
+_REQUEST_SPANS: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("request_spans", default=None)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # labels -> [conteggi per bucket (non cumulativi), somma, numero]
+        self.series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Collected:
+    """
+    Metric read at scrape time from an existing stats() source instead of being
+    pushed: fn returns a number, or {label value(s): number} for labelled series.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], Any], labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.labelnames = labelnames
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            log.warning("metric unavailable", extra=fields(metric=self.name, error=str(e)))
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                if v is not None:
+                    lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}")
+        elif value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics, rendered in the Prometheus text format by GET /metrics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: Dict[str, Any] = {}
+
+    def _register(self, metric):
+        with self.lock:
+            # Stesso nome -> stessa metrica (moduli reimportati, blueprint registrati due volte)
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def collect(self, name: str, help: str, fn: Callable[[], Any], kind: str = "gauge",
+                labelnames: Tuple[str, ...] = ()) -> Collected:
+        return self._register(Collected(name, help, kind, fn, labelnames))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+STAGE_SECONDS = METRICS.histogram(
+    "orchitech_stage_seconds", "Latency of one pipeline stage call.", ("stage", "strategy"))
+STAGE_ERRORS = METRICS.counter(
+    "orchitech_stage_errors_total", "Stage calls that raised.", ("stage",))
+BATCH_SIZE = METRICS.histogram(
+    "orchitech_batch_size", "Items per stage call.", ("stage",), buckets=SIZE_BUCKETS)
+QUEUE_DEPTH = METRICS.histogram(
+    "orchitech_queue_depth", "Items waiting in front of a stage when it takes a batch.", ("stage",), buckets=SIZE_BUCKETS)
+HTTP_REQUESTS = METRICS.counter(
+    "orchitech_http_requests_total", "HTTP requests by endpoint and status.", ("endpoint", "method", "status"))
+HTTP_SECONDS = METRICS.histogram(
+    "orchitech_http_request_seconds", "Time to build the response (streamed bodies excluded).", ("endpoint",))
+
+
+@contextmanager
+def span(stage: str, strategy: str = "", batch: Optional[int] = None):
+    """
+    Times a block as one call of `stage`: feeds the stage histogram (errors counted
+    separately) and the Server-Timing breakdown of the request being served.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage, strategy=strategy)
+        if batch is not None:
+            BATCH_SIZE.observe(batch, stage=stage)
+        spans = _REQUEST_SPANS.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+def timed(stage: str):
+    """Decorator form of span() for functions that are a stage as a whole."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def bind(fn: Callable) -> Callable:
+    """
+    fn bound to the current request's context variables (spans, correlation id), for
+    work handed to pools and threads: their spans show up in the request's
+    Server-Timing and their logs carry the request id.
+    """
+    values = list(contextvars.copy_context().items())
+    if not values:
+        return fn
+
+    @wraps(fn)
+    def run(*args, **kwargs):
+        # Un Context non si può attivare in due thread insieme: si copiano i valori
+        tokens = [(var, var.set(value)) for var, value in values]
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            for var, token in reversed(tokens):
+                var.reset(token)
+    return run
+
+def server_timing(spans: List[Tuple[str, float]], total: float) -> str:
+    """Server-Timing value: time summed per stage (parallel work can add up to more than total)."""
+    per_stage: Dict[str, List[float]] = {}
+    for stage, elapsed in spans:
+        entry = per_stage.setdefault(stage, [0.0, 0])
+        entry[0] += elapsed
+        entry[1] += 1
+    parts = [f'{stage};dur={seconds * 1000:.1f};desc="x{n}"' for stage, (seconds, n) in per_stage.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def init_app(app):
+    """Request counters and latency, and the per-request Server-Timing header."""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timing():
+        g.telemetry_start = time.perf_counter()
+        g.telemetry_spans = []
+        g.telemetry_token = _REQUEST_SPANS.set(g.telemetry_spans)
+
+    @app.after_request
+    def _finish_timing(response):
+        start = g.pop('telemetry_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or "unmatched"
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        HTTP_SECONDS.observe(elapsed, endpoint=endpoint)
+        if TIMING_HEADER_ALWAYS or request.headers.get('X-Timing') == '1' or request.args.get('timing') == '1':
+            response.headers['Server-Timing'] = server_timing(g.telemetry_spans, elapsed)
+        return response
+
+    @app.teardown_request
+    def _stop_timing(_exc):
+        token = g.pop('telemetry_token', None)
+        if token is not None:
+            try:
+                _REQUEST_SPANS.reset(token)
+            except ValueError:
+                # Teardown in un contesto diverso (risposte in streaming): basta staccare la lista
+                _REQUEST_SPANS.set(None)
@@ -3,9 +3,13 @@ from typing import List, Tuple, Optional, Any
 import numpy as np
 import collections
 import torch
-from app.model_fun.inference import getValues6ClassModel, getValues1vsAllModel
+from app.model_fun.inference import getValues6ClassModel, getValues1vsAllModel, getValues6ClassModelBatch, getValues1vsAllModelBatch
+from app.fun.telemetry import span, STAGE_ERRORS
+from app.fun.structured_log import get_logger, fields, sampled
 CLASS_NAMES = ['O. exaltata', 'O. garganica', 'O. incubacea', 'O. majellensis', 'O. sphegodes', 'O. sphegodes_Palena']
 
+log = get_logger("inference")
+
 # --- TTA AUGMENTATION FUNCTION DEFINITION ---
 
 def createAugmentedImages(image: Image.Image) -> List[Image.Image]:
@@ -117,7 +121,7 @@ def aggregate_tta_results(
             if err: continue
             all_probs_list.append(probs)
         except Exception as e:
-            print(f"DEBUG: Error view {i+1}: {e}", flush=True)
+            log.warning("TTA view failed", extra=fields(view=i + 1, error=str(e)))
 
     if not all_probs_list:
         return -1, 0.0, None, "TTA failed: No successful inference."
@@ -131,13 +135,20 @@ def aggregate_tta_results(
     # Calculate overall means for the UI/Response
     all_means = np.mean(probs_array, axis=0).tolist()
 
-    print(f"DEBUG: TTA Finished using {aggregation_func.__name__}")
-    print(f"DEBUG: Predicted: {final_idx} ({CLASS_NAMES[final_idx]}) | Conf: {final_conf:.2f}%", flush=True)
+    if sampled():
+        log.info("TTA prediction", extra=fields(
+            aggregation=aggregation_func.__name__, views=len(all_probs_list),
+            predicted=CLASS_NAMES[final_idx], confidence=round(final_conf, 2)))
 
     return final_idx, final_conf, all_means, None
 
 # --- STANDARD INFERENCE FUNCTION DEFINITION ---
 
+def _log_prediction(strategy, idx, conf, probs):
+    # Dettaglio per-inferenza solo su un campione (LOG_SAMPLE_RATE): niente I/O sincrono per ogni immagine
+    if sampled():
+        log.info("prediction", extra=fields(strategy=strategy, class_idx=idx, confidence=round(conf, 4), probs=probs))
+
 def perform_inference(model, onevall_models, tensor: torch.Tensor, strategy: str, device) -> Tuple[int, float, Any, Optional[str]]:
     """
     Executes the prediction based on the selected strategy.
@@ -148,24 +159,59 @@ def perform_inference(model, onevall_models, tensor: torch.Tensor, strategy: str
     """
     if tensor is None:
         return -1, 0.0, None, "No image tensor provided."
-    
+    with span('classify', strategy=strategy, batch=1):
+        return _perform_inference(model, onevall_models, tensor, strategy, device)
+
+def _perform_inference(model, onevall_models, tensor, strategy, device):
     try:
         if strategy == "standard":
             idx, conf, probs = getValues6ClassModel(model, tensor, device)
             # Assuming conf/probs are already scaled by getValues6ClassModel
-            print(f"DEBUG: Standard 5-Class Result -> Class: {idx}, Conf: {conf:.4f}, Probs: {probs}", flush=True)
+            _log_prediction(strategy, idx, conf, probs)
             return idx, conf, probs, None
         
         elif strategy == "1vsall":
             idx, conf, probs = getValues1vsAllModel(onevall_models, tensor, device)
             # Assuming conf/probs are already scaled by getValues1vsAllModel
-            print(f"DEBUG: 1vsAll Model Result -> Class: {idx}, Conf: {conf:.4f}, Probs: {probs}", flush=True)
+            _log_prediction(strategy, idx, conf, probs)
             if idx == -1:
                 return -1, 0.0, probs, "No class predicted with sufficient confidence."
             return idx, conf, probs, None
             
     except Exception as e:
-        print(f"DEBUG: Inference Error encountered: {str(e)}", flush=True)
+        STAGE_ERRORS.inc(stage='classify')
+        log.error("inference failed", extra=fields(strategy=strategy, error=str(e)))
         return -1, 0.0, None, f"Inference Error: {str(e)}"
 
-    return -1, 0.0, None, "Unknown Strategy"
\ No newline at end of file
+    return -1, 0.0, None, "Unknown Strategy"
+
+def perform_batch_inference(model, onevall_models, batch_tensor: torch.Tensor, strategy: str, device) -> List[Tuple[int, float, Any, Optional[str]]]:
+    """
+    Batched counterpart of perform_inference: runs one forward pass on a (B, C, H, W)
+    tensor and returns one (predicted_index, confidence, probabilities, error) tuple per row.
+    """
+    if batch_tensor is None or batch_tensor.shape[0] == 0:
+        return []
+    with span('classify', strategy=strategy, batch=batch_tensor.shape[0]):
+        return _perform_batch_inference(model, onevall_models, batch_tensor, strategy, device)
+
+def _perform_batch_inference(model, onevall_models, batch_tensor, strategy, device):
+    try:
+        if strategy == "standard":
+            rows = getValues6ClassModelBatch(model, batch_tensor, device)
+            return [(idx, conf, probs, None) for idx, conf, probs in rows]
+
+        elif strategy == "1vsall":
+            rows = getValues1vsAllModelBatch(onevall_models, batch_tensor, device)
+            return [
+                (-1, 0.0, probs, "No class predicted with sufficient confidence.") if idx == -1
+                else (idx, conf, probs, None)
+                for idx, conf, probs in rows
+            ]
+
+    except Exception as e:
+        STAGE_ERRORS.inc(stage='classify')
+        log.error("batch inference failed", extra=fields(strategy=strategy, batch=batch_tensor.shape[0], error=str(e)))
+        return [(-1, 0.0, None, f"Inference Error: {str(e)}")] * batch_tensor.shape[0]
+
+    return [(-1, 0.0, None, "Unknown Strategy")] * batch_tensor.shape[0]
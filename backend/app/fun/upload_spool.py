@@ -0,0 +1,193 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import collections
+from typing import Any, Dict, Optional
+from dotenv import dotenv_values
+
+from app.fun.structured_log import get_logger, fields
+
+log = get_logger("upload_spool")
+
+config = dotenv_values(".env")
+
+# Originali caricati su /dbinference, riusati da /save_dataset nella stessa sessione
+UPLOAD_SPOOL_DIR = config.get("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "orchitech_uploads"))
+UPLOAD_SPOOL_TTL = float(config.get("UPLOAD_SPOOL_TTL", 3600))
+UPLOAD_SPOOL_MAX_MB = float(config.get("UPLOAD_SPOOL_MAX_MB", 4096))
+UPLOAD_SESSION_MAX_MB = float(config.get("UPLOAD_SESSION_MAX_MB", 2048))
+
+
+class UploadSpool:
+    """
+    Uploaded originals kept on disk per annotation session, addressed by opaque ids.
+    A session expires UPLOAD_SPOOL_TTL seconds after its last use; when the spool
+    exceeds its size bound the least recently used sessions are dropped first.
+    Ids are only valid together with the session that created them. A pinned session
+    (an export reading from it) neither expires nor is evicted until unpinned.
+    """
+
+    def __init__(self, root: str = UPLOAD_SPOOL_DIR, ttl: float = UPLOAD_SPOOL_TTL,
+                 max_bytes: int = int(UPLOAD_SPOOL_MAX_MB * 1024 * 1024),
+                 session_max_bytes: int = int(UPLOAD_SESSION_MAX_MB * 1024 * 1024)):
+        # Una cartella per processo: le sessioni vivono nella memoria di questo processo
+        self.base = root
+        self.root = os.path.join(root, str(os.getpid()))
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.session_max_bytes = session_max_bytes
+        self.sessions = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.expired_sessions = 0
+        self.evicted_sessions = 0
+        self.rejected_uploads = 0
+        shutil.rmtree(self.root, ignore_errors=True)
+        self._remove_stale_roots()
+
+    def _remove_stale_roots(self):
+        """Folders left by processes that are gone (previous runs): nobody can reach their sessions."""
+        try:
+            names = os.listdir(self.base)
+        except OSError:
+            return
+        for name in names:
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(self.base, name), ignore_errors=True)
+            except OSError:
+                # Processo vivo di un altro utente: la cartella resta
+                continue
+
+    def open_session(self, session_id: Optional[str] = None) -> str:
+        """Returns `session_id` if it is still alive (and refreshes it), otherwise a new session."""
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id) if session_id else None
+            if session is None:
+                session_id = uuid.uuid4().hex
+                session = {'uploads': {}, 'bytes': 0, 'pins': 0, 'last_used': time.time()}
+                self.sessions[session_id] = session
+            self._touch(session_id, session)
+            return session_id
+
+    def put(self, session_id: str, filename: str, data: bytes) -> Optional[str]:
+        """Spools one original; None if the session is gone or would exceed its own bound."""
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None or session['bytes'] + len(data) > self.session_max_bytes:
+                self.rejected_uploads += 1
+                return None
+            # Spazio riservato prima della scrittura, così upload concorrenti non sforano il limite
+            session['bytes'] += len(data)
+            self.bytes += len(data)
+            self._touch(session_id, session)
+
+        path = os.path.join(self.root, session_id, upload_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            log.warning("spool write failed", extra=fields(filename=filename, error=str(e)))
+            with self.lock:
+                if self.sessions.get(session_id) is session:
+                    session['bytes'] -= len(data)
+                    self.bytes -= len(data)
+            return None
+
+        with self.lock:
+            if self.sessions.get(session_id) is not session:
+                # Sessione scaduta durante la scrittura
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                return None
+            session['uploads'][upload_id] = {'path': path, 'filename': filename, 'size': len(data)}
+            self._evict(keep=session_id)
+        return upload_id
+
+    def path(self, session_id: str, upload_id: str) -> Optional[str]:
+        """On-disk original of an upload of this session, None if unknown or expired."""
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            upload = session['uploads'].get(upload_id)
+            if upload is None:
+                return None
+            self._touch(session_id, session)
+            return upload['path']
+
+    def pin(self, session_id: str) -> bool:
+        """
+        Keeps the session and its files until unpin(), e.g. while a streamed export still
+        has to open them. False if the session is unknown or expired.
+        """
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            session['pins'] += 1
+            self._touch(session_id, session)
+            return True
+
+    def unpin(self, session_id: str):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session['pins'] = max(0, session['pins'] - 1)
+                # Il TTL riparte dalla fine dell'export
+                self._touch(session_id, session)
+
+    def drop_session(self, session_id: str):
+        with self.lock:
+            self._drop(session_id)
+
+    def _touch(self, session_id: str, session: Dict[str, Any]):
+        session['last_used'] = time.time()
+        self.sessions.move_to_end(session_id)
+
+    def _expire(self):
+        now = time.time()
+        for session_id in [sid for sid, s in self.sessions.items() if not s['pins'] and now - s['last_used'] > self.ttl]:
+            self._drop(session_id)
+            self.expired_sessions += 1
+
+    def _evict(self, keep: str):
+        # Le sessioni meno recenti lasciano spazio, quella attiva per ultima
+        while self.bytes > self.max_bytes:
+            victim = next((sid for sid, s in self.sessions.items() if sid != keep and not s['pins']), None)
+            if victim is None:
+                break
+            self._drop(victim)
+            self.evicted_sessions += 1
+
+    def _drop(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        self.bytes -= session['bytes']
+        shutil.rmtree(os.path.join(self.root, session_id), ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'sessions': len(self.sessions),
+                'uploads': sum(len(s['uploads']) for s in self.sessions.values()),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'expired_sessions': self.expired_sessions,
+                'evicted_sessions': self.evicted_sessions,
+                'rejected_uploads': self.rejected_uploads,
+            }
+
+
+UPLOAD_SPOOL = UploadSpool()
@@ -0,0 +1,226 @@
+import time
+import uuid
+import threading
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional
+import torch
+from dotenv import dotenv_values
+
+from app.fun.structured_log import get_logger, fields, setup_logging
+
+log = get_logger("xai_worker")
+
+config = dotenv_values(".env")
+
+WIDTH = int(config.get("WIDTH", 256))
+HEIGHT = int(config.get("HEIGHT", 512))
+
+# Thread torch del processo XAI: non competono con quelli delle richieste di inferenza
+XAI_WORKER_THREADS = int(config.get("XAI_WORKER_THREADS", 2))
+XAI_WORKER_PROCESSES = int(config.get("XAI_WORKER_PROCESSES", 1))
+XAI_WORKER_GPU = config.get("XAI_WORKER_GPU", config.get("GPU", "False")).lower() in ('true', '1', 't')
+# Risultati conservati per il polling, poi scartati
+XAI_JOB_TTL = float(config.get("XAI_JOB_TTL", 600))
+XAI_MAX_JOBS = int(config.get("XAI_MAX_JOBS", 256))
+# Job ancora in coda o in esecuzione: oltre il limite la richiesta riceve 503
+XAI_MAX_PENDING = int(config.get("XAI_MAX_PENDING", 32))
+
+
+class XaiBusy(Exception):
+    """Too many explanation jobs still pending: the caller answers 503."""
+
+
+# --- WORKER PROCESS ---
+# Each worker process loads its own replica of the 6-class model: captum / Grad-CAM
+# hooks never touch the model used by the request threads.
+
+_replica = None
+_replica_device = None
+
+def _init_replica(threads: int, use_gpu: bool):
+    global _replica, _replica_device
+    # Processo spawn: il logging del server non è ereditato
+    setup_logging()
+    from app.model_fun.inference import loadModel, loadDevice
+    from app.fun.model_loader import main_model_path, CLASS_NAMES
+    from app.fun.attribution_engine import ENGINE
+    from app.fun.gradcam import use_dedicated
+
+    torch.set_num_threads(threads)
+    _replica_device = loadDevice(forceCpu=not (use_gpu and torch.cuda.is_available()))
+    _replica = loadModel(main_model_path(), len(CLASS_NAMES), _replica_device)
+    _replica.eval()
+    # Nessuna richiesta usa la replica: Grad-CAM la aggancia direttamente, senza copia
+    use_dedicated(_replica)
+    ENGINE.calibrate(_replica, (1, 3, HEIGHT, WIDTH), _replica_device)
+    log.info("replica ready", extra=fields(device=str(_replica_device), threads=threads))
+
+def _explain_views(views: Dict[str, Any], explain_method: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    views: {suffix: (cpu tensor (1, 3, H, W), target class)}, suffix '' for the primary
+    view and '_cropped' for the crop. Returns the response keys of every view (e.g.
+    'occlusion', 'occlusion_cropped') and the occlusion maps stored meanwhile, which
+    the parent moves into its own store.
+    """
+    from app.fun.explainability_fun import get_xai
+    from app.fun.occlusion_maps import OCCLUSION_MAPS
+
+    fields = {}
+    for suffix, (tensor, target) in views.items():
+        for key, value in get_xai(_replica, tensor.to(_replica_device), target, explain_method, options).items():
+            fields[f"{key}{suffix}"] = value
+    maps = {
+        value: OCCLUSION_MAPS.pop(value)
+        for key, value in fields.items() if key.startswith('occlusion_map_id') and value
+    }
+    return {'fields': fields, 'occlusion_maps': maps}
+
+
+# --- JOB REGISTRY (server process) ---
+
+class XaiJobs:
+    """
+    Explanation jobs submitted by /inference (explain_async=true): the response carries
+    the job id right after classification, the client polls or subscribes for the result.
+    """
+
+    def __init__(self, processes: int = XAI_WORKER_PROCESSES, threads: int = XAI_WORKER_THREADS,
+                 use_gpu: bool = XAI_WORKER_GPU):
+        self.processes = processes
+        self.threads = threads
+        self.use_gpu = use_gpu
+        self.executor = None
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # spawn: CUDA and torch threads cannot be safely forked from the server
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_replica,
+                    initargs=(self.threads, self.use_gpu),
+                )
+            return self.executor
+
+    def _reset_executor(self, broken: ProcessPoolExecutor):
+        """
+        Drops a pool that can no longer run jobs (a worker was killed, e.g. by the OOM
+        killer, or _init_replica failed): the next submit spawns a fresh one.
+        """
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.executor = None
+        log.warning("XAI worker pool broken, it will be restarted")
+        broken.shutdown(wait=False)
+
+    def start(self):
+        """Starts the worker processes now, so the replica is loaded before the first request."""
+        self._get_executor().submit(time.sleep, 0)
+
+    def submit(self, views: Dict[str, Any], explain_method: str, options: Optional[Dict[str, Any]] = None) -> str:
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'status': 'pending',
+            'method': explain_method,
+            'created_at': time.time(),
+            'finished_at': None,
+            'result': None,
+            'error': None,
+            'done': threading.Event(),
+            'future': None,
+        }
+        cpu_views = {suffix: (tensor.detach().cpu(), int(target)) for suffix, (tensor, target) in views.items()}
+        with self.lock:
+            self._evict()
+            # _evict scarta solo job finiti: i pending si limitano qui
+            pending = sum(1 for j in self.jobs.values() if not j['done'].is_set())
+            if pending >= XAI_MAX_PENDING:
+                raise XaiBusy(f"{pending} explanation jobs pending, retry later")
+            self.jobs[job_id] = job
+        future, error = None, None
+        for _ in range(2):
+            try:
+                executor = self._get_executor()
+                future = executor.submit(_explain_views, cpu_views, explain_method, dict(options or {}))
+                break
+            except BrokenProcessPool as e:
+                # Un pool rotto si scopre anche al submit: si riprova una volta con uno nuovo
+                self._reset_executor(executor)
+                error = e
+            except Exception as e:
+                error = e
+                break
+        if future is None:
+            # Mai lasciare in 'pending' un job che non è partito
+            self._fail(job, error)
+            return job_id
+        job['future'] = future
+        future.add_done_callback(lambda f: self._finish(job, f, executor))
+        return job_id
+
+    def _fail(self, job, error: Exception):
+        log.warning("explanation job failed", extra=fields(job_id=job['id'], error=str(error)))
+        job.update({'status': 'error', 'error': str(error), 'finished_at': time.time()})
+        job['done'].set()
+
+    def _finish(self, job, future, executor):
+        from app.fun.occlusion_maps import OCCLUSION_MAPS
+        try:
+            outcome = future.result()
+            for map_id, entry in outcome['occlusion_maps'].items():
+                if entry is not None:
+                    OCCLUSION_MAPS.restore(map_id, entry)
+            job.update({'status': 'done', 'result': outcome['fields']})
+        except BrokenProcessPool as e:
+            self._reset_executor(executor)
+            self._fail(job, e)
+            return
+        except Exception as e:
+            job.update({'status': 'error', 'error': str(e)})
+        job['finished_at'] = time.time()
+        job['done'].set()
+
+    def _evict(self):
+        now = time.time()
+        for job_id in list(self.jobs):
+            job = self.jobs[job_id]
+            expired = job['finished_at'] is not None and now - job['finished_at'] > XAI_JOB_TTL
+            if expired or (len(self.jobs) >= XAI_MAX_JOBS and job['done'].is_set()):
+                del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        job = self.get(job_id)
+        if job is not None:
+            job['done'].wait(timeout)
+        return job
+
+    @staticmethod
+    def to_dict(job: Dict[str, Any]) -> Dict[str, Any]:
+        data = {k: v for k, v in job.items() if k not in ('done', 'future')}
+        if data['status'] == 'pending' and job['future'] is not None and job['future'].running():
+            data['status'] = 'running'
+        return data
+
+    def handle(self, job_id: str) -> Dict[str, Any]:
+        """What /inference returns in place of the explanations."""
+        return {
+            'id': job_id,
+            'status': 'pending',
+            'poll': f"/explanations/jobs/{job_id}",
+            'events': f"/explanations/jobs/{job_id}/events",
+        }
+
+
+XAI_JOBS = XaiJobs()
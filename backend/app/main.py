@@ -1,27 +1,65 @@
 from flask import Flask
 from flask_cors import CORS
-from app.api.inference import inference_bp
+from app.api.inference import inference_bp, WIDTH, HEIGHT
 from app.fun.model_loader import load_resources # Resource loading function
-from app.api.db_inference import db_inference_bp
+from app.api.detection import detection_bp
 from app.api.save_db import save_bp
-from app.api.new_db_inference import new_db_inference_bp
+from app.api.jobs import jobs_bp
+from app.api.folder_inference import folder_inference_bp
+from app.api.explanations import explanations_bp
+from app.api.metrics import metrics_bp
+from app.api.profiling import profiling_bp
+from app.fun import telemetry, structured_log, profiling
+from app.fun.attribution_engine import ENGINE
+from app.fun.job_worker import start_job_worker
+from app.fun.xai_worker import XAI_JOBS
 from app import model_state
 
+log = structured_log.get_logger("startup")
+
 onevall_models = None
 model = None
 
 def create_app():
     app = Flask(__name__)
-    CORS(app)
+    CORS(app, expose_headers=['Server-Timing', 'X-Request-ID'])
+    # Log JSON su un thread dedicato, con l'id di correlazione di ogni richiesta (vedi structured_log.py)
+    structured_log.init_app(app)
+    # Conteggi e latenza per endpoint, Server-Timing su richiesta (vedi telemetry.py)
+    telemetry.init_app(app)
+    # Profilazione su richiesta del traffico reale: POST /admin/profile o SIGUSR2 (vedi profiling.py)
+    profiling.init_app(app)
 
     resources = load_resources()
     model_state.load_and_set_models(resources)
+    # Il detector si carica qui e non all'import: i processi XAI (spawn) reimportano
+    # app.main e non devono tenere una copia di Faster R-CNN
+    try:
+        from app.cropping_fun.fasterrcnn_crop import get_detector
+        get_detector()
+    except ImportError as e:
+        log.warning("detector not available", extra=structured_log.fields(error=str(e)))
     print("--- MODELS LOADED SUCCESSFULLY ---")
 
+    # Misura memoria e costo per campione una volta sola, prima delle richieste
+    try:
+        ENGINE.calibrate(model_state.model, (1, 3, HEIGHT, WIDTH), model_state.device)
+    except Exception as e:
+        log.warning("XAI calibration failed, will retry on first explanation",
+                    extra=structured_log.fields(error=str(e)))
+
     app.register_blueprint(inference_bp)
-    app.register_blueprint(db_inference_bp)
-    app.register_blueprint(new_db_inference_bp)
+    app.register_blueprint(detection_bp)
     app.register_blueprint(save_bp)
+    app.register_blueprint(jobs_bp)
+    app.register_blueprint(folder_inference_bp)
+    app.register_blueprint(explanations_bp)
+    app.register_blueprint(metrics_bp)
+    app.register_blueprint(profiling_bp)
+
+    start_job_worker()
+    # Processo XAI con la sua replica del modello (explain_async=true su /inference)
+    XAI_JOBS.start()
 
     return app
 
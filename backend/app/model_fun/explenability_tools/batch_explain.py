@@ -0,0 +1,313 @@
+"""
+Renders the explanation sheets of a processed dataset (the same output as
+generateOutputImages) across worker processes, resumable.
+
+Each worker loads its own model replica and explains the images in chunks: one
+forward pass for the predictions and one batched attribution pass per method for
+the whole chunk. Sheets are written to a temporary file and renamed into place, and
+every finished image is appended to manifest.jsonl in the output folder: a rerun
+skips the images already listed there.
+
+Usage (from the backend folder / container workdir):
+    python -m app.model_fun.explenability_tools.batch_explain <dataset.pt> <output dir> [--workers 2] [--batch-size 8]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import torch
+from PIL import Image, ImageDraw, ImageFont
+from dotenv import dotenv_values
+from torch.nn import functional as F
+from captum.attr import IntegratedGradients
+
+import app.model_fun.preprocessing_tools.normalization as normalization
+from app.model_fun.preprocessing_tools.dataset_tool import getDatasetFromFile
+from app.fun.adaptive_occlusion import grid_windows, accumulate_map
+from app.fun.heatmap_render import render_blended_heatmap
+from app.fun.gradcam import gradcam, use_dedicated
+
+config = dotenv_values(".env")
+
+MANIFEST_NAME = "manifest.jsonl"
+METHODS = ['occlusion', 'integrated_gradients', 'gradcam', 'gradcam++']
+# Stesso sign usato dalle heatmap dell'API
+METHOD_SIGNS = {
+    'occlusion': 'positive',
+    'integrated_gradients': 'absolute_value',
+    'gradcam': 'positive',
+    'gradcam++': 'positive',
+}
+METHOD_TITLES = {
+    'occlusion': 'Occlusion',
+    'integrated_gradients': 'IntegratedGradients',
+    'gradcam': 'Grad-CAM',
+    'gradcam++': 'Grad-CAM++',
+}
+MISPREDICTED_BG = (240, 128, 128)  # lightcoral, come generateOutputImages
+TITLE_HEIGHT = 18  # riga del titolo di render_blended_heatmap
+
+
+def unpackItem(data):
+    # Stessi casi di generateOutputImages: (immagine, etichetta, nome) o (immagine, nome)
+    if isinstance(data, tuple) and len(data) == 3:
+        image, label, filename = data
+    elif isinstance(data, tuple) and len(data) == 2:
+        image, filename = data
+        label = None
+    else:
+        image, label, filename = data, None, None
+    if isinstance(label, torch.Tensor):
+        label = label.item()
+    return image, label, filename
+
+def planOutputs(dataset):
+    """index -> output path relative to the output folder, numbered per class like generateOutputImages."""
+    class_counters = defaultdict(int)
+    plan = []
+    for idx in range(len(dataset)):
+        _, label, filename = unpackItem(dataset[idx])
+        label_dir = f"{dataset.classes[label]}" if label is not None else "unlabeled"
+        class_counters[label_dir] += 1
+        name = os.path.splitext(filename)[0] if filename else str(idx)
+        plan.append((idx, os.path.join(label_dir, f"{class_counters[label_dir]}_{name}.png")))
+    return plan
+
+def readManifest(output_dir):
+    """Outputs already recorded by a previous run (and still on disk)."""
+    done = set()
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Riga troncata da un'interruzione
+            if os.path.exists(os.path.join(output_dir, record['output'])):
+                done.add(record['output'])
+    return done
+
+
+# --- WORKER PROCESS ---
+
+_worker = {}
+
+def _initWorker(dataset_path, model_path, class_size, threads, use_gpu):
+    from app.model_fun.inference import loadModel, loadDevice
+
+    torch.set_num_threads(threads)
+    device = loadDevice(forceCpu=not use_gpu)
+    model = loadModel(model_path, class_size, device)
+    model.eval()
+    _worker.update({
+        'dataset': getDatasetFromFile(dataset_path),
+        'model': use_dedicated(model),
+        'device': device,
+    })
+
+def batchedOcclusion(model, batch, targets, window, stride, perturbations):
+    """
+    Occlusion maps (B, H, W) of the target class of every image: each forward pass
+    evaluates the same windows on all the images of the chunk.
+    """
+    size, _, height, width = batch.shape
+    windows = grid_windows(height, width, window, stride)
+    per_pass = max(1, perturbations // size)
+    target_idx = torch.tensor(targets)
+    deltas = []
+    with torch.no_grad():
+        base = model(batch).detach().cpu().gather(1, target_idx.unsqueeze(1)).squeeze(1)
+        for start in range(0, len(windows), per_pass):
+            chunk = windows[start:start + per_pass]
+            occluded = batch.repeat(len(chunk), 1, 1, 1)  # window-major: row w * size + i
+            for w, (y, x, h, wd) in enumerate(chunk):
+                occluded[w * size:(w + 1) * size, :, y:y + h, x:x + wd] = 0
+            scores = model(occluded).detach().cpu().view(len(chunk), size, -1)
+            deltas.append(base.unsqueeze(0) - scores.gather(2, target_idx.view(1, size, 1).expand(len(chunk), size, 1)).squeeze(2))
+    maps, _ = accumulate_map(height, width, windows, torch.cat(deltas))  # (B, H, W)
+    return maps
+
+def batchedAttributions(model, batch, targets, method, options):
+    """(B, H, W, 3) numpy attributions for the chunk, one batched pass per method."""
+    if method == 'occlusion':
+        maps = batchedOcclusion(model, batch, targets, options['window'], options['stride'], options['perturbations'])
+        return np.repeat(maps.numpy()[..., None], 3, axis=3)
+    if method == 'integrated_gradients':
+        attributions = IntegratedGradients(model).attribute(
+            batch, target=targets, n_steps=options['ig_steps'],
+            internal_batch_size=options['perturbations']
+        )
+        return attributions.detach().cpu().permute(0, 2, 3, 1).numpy()
+    cams, _ = gradcam(model, batch, targets, plus_plus=method == 'gradcam++')
+    return np.repeat(cams.numpy()[..., None], 3, axis=3)
+
+def composeSheet(display_image, panels, caption, mispredicted):
+    """Original image + one heatmap per method side by side, confidence lines below."""
+    font = ImageFont.load_default()
+    tiles = [Image.fromarray((display_image * 255).astype(np.uint8))] + panels
+    gap, caption_h = 8, 14 * len(caption) + 8
+    width = sum(tile.width for tile in tiles) + gap * (len(tiles) + 1)
+    height = max(tile.height for tile in tiles) + caption_h + 2 * gap
+    sheet = Image.new("RGB", (width, height), MISPREDICTED_BG if mispredicted else (255, 255, 255))
+    x = gap
+    for tile in tiles:
+        # L'immagine originale è allineata sotto i titoli delle heatmap
+        sheet.paste(tile, (x, gap + (TITLE_HEIGHT if panels and tile is tiles[0] else 0)))
+        x += tile.width + gap
+    draw = ImageDraw.Draw(sheet)
+    for i, line in enumerate(caption):
+        draw.text((gap, height - caption_h + 14 * i), line, fill=(0, 0, 0), font=font)
+    return sheet
+
+def saveAtomic(image, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    image.save(tmp_path, format="PNG")
+    os.replace(tmp_path, path)
+
+def explainChunk(items, output_dir, methods, class_names, options):
+    """items: [(dataset index, relative output path)]. Returns the manifest records of the chunk."""
+    dataset, model, device = _worker['dataset'], _worker['model'], _worker['device']
+    start = time.perf_counter()
+    images, labels, filenames = [], [], []
+    for idx, _ in items:
+        image, label, filename = unpackItem(dataset[idx])
+        images.append(image)
+        labels.append(label)
+        filenames.append(filename)
+    batch = torch.stack(images).to(device)
+
+    with torch.no_grad():
+        percentages = F.softmax(model(batch), dim=1).cpu() * 100
+    predicted = percentages.argmax(dim=1).tolist()
+    # Come generateOutputImages: si spiega l'etichetta se c'è, altrimenti la predizione
+    targets = [label if label is not None else pred for label, pred in zip(labels, predicted)]
+
+    attributions = {method: batchedAttributions(model, batch, targets, method, options) for method in methods}
+
+    mean, std = normalization.get_mean(), normalization.get_std()
+    records = []
+    for i, (idx, output) in enumerate(items):
+        display_image = normalization.denormalize_image(images[i], mean, std).cpu().permute(1, 2, 0).numpy()
+        panels = [
+            render_blended_heatmap(attributions[method][i], display_image, METHOD_SIGNS[method],
+                                   f"{METHOD_TITLES[method]}: {class_names[targets[i]]}")
+            for method in methods
+        ]
+        label_name = class_names[labels[i]] if labels[i] is not None else 'Undefined'
+        caption = [f"Filename: {filenames[i]}", f"Predicted: {class_names[predicted[i]]}  Label: {label_name}"]
+        caption += [f"{name}: {percentages[i, k]:.2f}%" for k, name in enumerate(class_names)]
+        sheet = composeSheet(display_image, panels, caption, mispredicted=labels[i] is None or predicted[i] != labels[i])
+        saveAtomic(sheet, os.path.join(output_dir, output))
+        records.append({
+            'index': idx,
+            'filename': filenames[i],
+            'output': output,
+            'label': labels[i],
+            'predicted': predicted[i],
+            'methods': methods,
+        })
+    seconds = time.perf_counter() - start
+    for record in records:
+        record['seconds'] = round(seconds / len(records), 4)
+    return records
+
+
+# --- DRIVER ---
+
+def formatEta(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def runBatchExplain(dataset_path, output_dir, model_path, class_names, methods, workers, threads, batch_size,
+                    use_gpu, options):
+    os.makedirs(output_dir, exist_ok=True)
+    dataset = getDatasetFromFile(dataset_path)
+    plan = planOutputs(dataset)
+    done = readManifest(output_dir)
+    pending = [item for item in plan if item[1] not in done]
+    del dataset  # ogni worker carica la propria copia
+    print(f"{len(plan)} immagini, {len(plan) - len(pending)} già presenti nel manifest, {len(pending)} da elaborare", flush=True)
+    if not pending:
+        return {'total': len(plan), 'rendered': 0, 'skipped': len(plan), 'failed': 0}
+
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    rendered, failed = 0, 0
+    start = time.perf_counter()
+    with open(os.path.join(output_dir, MANIFEST_NAME), "a") as manifest, ProcessPoolExecutor(
+        max_workers=workers,
+        # spawn: ogni worker inizializza torch (e CUDA) da zero
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initWorker,
+        initargs=(dataset_path, model_path, len(class_names), threads, use_gpu),
+    ) as executor:
+        futures = {executor.submit(explainChunk, chunk, output_dir, methods, class_names, options): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                records = future.result()
+            except Exception as e:
+                failed += len(futures[future])
+                print(f"Errore sul blocco {futures[future][0][1]}...: {e}", flush=True)
+                continue
+            for record in records:
+                manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+            rendered += len(records)
+
+            elapsed = time.perf_counter() - start
+            rate = rendered / elapsed
+            remaining = len(pending) - rendered - failed
+            print(f"[{rendered + failed}/{len(pending)}] {rate:.2f} img/s, ETA {formatEta(remaining / rate) if rate else '?'}", flush=True)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'total': len(plan),
+        'rendered': rendered,
+        'skipped': len(plan) - len(pending),
+        'failed': failed,
+        'seconds': round(elapsed, 2),
+        'images_per_second': round(rendered / elapsed, 3) if elapsed else None,
+    }
+
+def main():
+    from app.fun.model_loader import main_model_path, CLASS_NAMES
+
+    parser = argparse.ArgumentParser(description="Parallel, resumable explanation rendering for a processed dataset")
+    parser.add_argument("dataset", help="Processed dataset file (torch.save'd {'data': dataset})")
+    parser.add_argument("output", help="Output folder (one subfolder per class, manifest.jsonl at the top)")
+    parser.add_argument("--model", default=None, help="Model checkpoint, defaults to the configured 6-Class model")
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=['occlusion', 'integrated_gradients'])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads per worker")
+    parser.add_argument("--batch-size", type=int, default=8, help="Images per attribution pass")
+    parser.add_argument("--gpu", action="store_true")
+    parser.add_argument("--window", type=int, default=int(config.get("SLIDING_WINDOW_SIZE", 30)))
+    parser.add_argument("--stride", type=int, default=int(config.get("SLIDING_WINDOW_STRIDE", 25)))
+    parser.add_argument("--ig-steps", type=int, default=50)
+    parser.add_argument("--perturbations", type=int, default=64, help="Occluded / interpolated images per forward pass")
+    args = parser.parse_args()
+
+    class_names = eval(config['CLASS_NAMES']) if 'CLASS_NAMES' in config else CLASS_NAMES
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    options = {
+        'window': args.window,
+        'stride': args.stride,
+        'ig_steps': args.ig_steps,
+        'perturbations': args.perturbations,
+    }
+    summary = runBatchExplain(
+        args.dataset, args.output, args.model or main_model_path(), class_names, args.methods,
+        args.workers, threads, args.batch_size, args.gpu and torch.cuda.is_available(), options
+    )
+    print(json.dumps(summary, indent=2))
+    return 0 if summary['failed'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
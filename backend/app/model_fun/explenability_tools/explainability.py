@@ -91,6 +91,7 @@ def showAndTestImages(dataset, model, device, classNames, slidingWindowSize, str
     plt.show(block=True)
 
 
+# Una immagine alla volta: per dataset interi vedi batch_explain.py (worker paralleli, ripresa da manifest)
 def generateOutputImages(dataset, model, device, classNames, output_dir, slidingWindowSize, stride):
     model.to(device)
     ig = IntegratedGradients(model)
@@ -126,5 +126,31 @@ def getValues1vsAllModel(models, processed_image, device):
     conf = probs[pred_class_idx][0].item() * 100 # Confidence of the predicted class
     all_classes_probs = [round(p * 100, 2) for p in all_classes_probs]          # Convert probabilities to
 
-    print(f"All class probabilities:' {all_classes_probs}, '\nPredicted class index:' {pred_class_idx} '\nConfidence:', {conf}", flush=True)
-    return pred_class_idx, conf, all_classes_probs
\ No newline at end of file
+    return pred_class_idx, conf, all_classes_probs
+
+# Versioni batch delle due funzioni precedenti: processed_images ha forma (B, C, H, W)
+# e viene restituita una tupla (pred_class_idx, conf, all_classes_probs) per ogni immagine
+def getValues6ClassModelBatch(model, processed_images, device):
+    values, predicted = inference(model, processed_images, device)
+    probs = torch.softmax(values, dim=1).cpu().detach()
+    results = []
+    for row, pred_class_idx in zip(probs, predicted.cpu().tolist()):
+        conf = row[pred_class_idx].item() * 100
+        all_classes_probs = [p * 100 for p in row.numpy().tolist()]
+        results.append((pred_class_idx, conf, all_classes_probs))
+    return results
+
+def getValues1vsAllModelBatch(models, processed_images, device):
+    # values: (B, numModels, 2), un forward per modello sull'intero batch
+    values = torch.stack([inference(model, processed_images, device)[0].cpu() for model in models], dim=1)
+    probs = torch.softmax(values, dim=2)
+    results = []
+    for i in range(values.shape[0]):
+        if torch.all(values[i, :, 0] < 0):
+            pred_class_idx = -1
+        else:
+            pred_class_idx = torch.argmax(values[i, :, 0]).item()
+        all_classes_probs = [round(p * 100, 2) for p in probs[i, :, 0].numpy().tolist()]
+        conf = probs[i][pred_class_idx][0].item() * 100
+        results.append((pred_class_idx, conf, all_classes_probs))
+    return results
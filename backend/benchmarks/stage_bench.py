@@ -0,0 +1,378 @@
+"""
+In-process microbenchmarks of the inference stages: decode (ingest), getTransforms,
+6-class and 1-vs-All classification, Faster R-CNN detection and crop, occlusion,
+integrated gradients, heatmap rendering and JPEG + base64 encoding, at several
+batch sizes and thread counts.
+
+Images are synthetic (deterministic, at realistic camera resolutions) plus, with
+--images, a sample of real photos. Results are written as JSON together with the
+hardware and software the run happened on; --baseline compares the run with a
+previous result file and exits with status 1 if a stage got slower than its
+threshold. There is no stored baseline in the repository: numbers only mean
+something on the machine that produced them, so save one per machine with
+--save-baseline and compare against it.
+
+Usage (from the backend folder / container workdir):
+    python -m benchmarks.stage_bench [--stages decode,classify_6class] [--batch-sizes 1,4,16]
+        [--threads 1,4] [--resolutions 4032x3024,1920x1080] [--images <dir>]
+        [--output test_results/benchmarks] [--baseline <file.json>] [--threshold 0.10]
+        [--save-baseline benchmarks/baselines/<machine>.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+import torch
+import PIL
+from PIL import Image
+from dotenv import dotenv_values
+
+from app.fun.ingest import ingest_image
+from app.fun.tta_logic import perform_batch_inference
+from app.fun.explainability_fun import encode_image, render_heatmap, tensor_to_display_image, MEAN, STD
+from app.fun.occlusion_maps import all_class_occlusion
+from app.fun.attribution_engine import ENGINE
+from app.model_fun.preprocess_data import getTransforms
+
+config = dotenv_values(".env")
+
+WIDTH = int(config.get("WIDTH", 256))
+HEIGHT = int(config.get("HEIGHT", 512))
+TEST_RESULTS_ROOT = config.get("TEST_RESULTS_ROOT", "test_results")
+
+STAGES = ['decode', 'transform', 'classify_6class', 'classify_1vsall', 'detect', 'crop',
+          'occlusion', 'integrated_gradients', 'render', 'encode_base64']
+# Stage che dipendono dalla risoluzione dell'immagine caricata (gli altri lavorano a WIDTHxHEIGHT)
+RESOLUTION_STAGES = {'decode', 'transform', 'detect', 'crop', 'encode_base64'}
+# Stage che accettano un batch; gli altri girano a batch 1
+BATCHED_STAGES = {'decode', 'transform', 'classify_6class', 'classify_1vsall', 'detect', 'encode_base64'}
+# Stage su thread pool (PIL); gli altri usano torch.set_num_threads
+POOL_STAGES = {'decode', 'transform', 'encode_base64'}
+DEFAULT_RESOLUTIONS = "4032x3024,1920x1080"
+
+
+# --- INPUTS ---
+
+def synthetic_jpeg(width: int, height: int, seed: int = 0) -> bytes:
+    """
+    Deterministic photo-like JPEG: smooth gradients plus mild noise, so it compresses
+    (and decodes) like a real photo rather than like pure noise.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        128 + 100 * np.sin(x / width * 6.0),
+        128 + 100 * np.cos(y / height * 4.0),
+        128 + 80 * np.sin((x + y) / (width + height) * 9.0),
+    ], axis=2)
+    base += rng.normal(0, 12, size=base.shape).astype(np.float32)
+    image = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8), "RGB")
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+def sample_images(folder: str, limit: int) -> List[bytes]:
+    names = sorted(n for n in os.listdir(folder) if os.path.splitext(n)[1].lower() in ('.jpg', '.jpeg', '.png', '.webp'))
+    samples = []
+    for name in names[:limit]:
+        with open(os.path.join(folder, name), "rb") as f:
+            samples.append(f.read())
+    return samples
+
+def parse_resolution(value: str):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+# --- METADATA ---
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def hardware_metadata() -> Dict[str, Any]:
+    meta = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'mkldnn': torch.backends.mkldnn.is_available(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        'git_commit': git_commit(),
+    }
+    try:
+        with open("/proc/cpuinfo") as f:
+            model = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), None)
+        meta['cpu_model'] = model
+    except OSError:
+        pass
+    return meta
+
+
+# --- STAGES ---
+
+def load_models(device):
+    """(model, onevall_models, detector); None where loading fails, the stages using it are skipped."""
+    model, onevall_models = None, []
+    try:
+        from app.fun.model_loader import load_resources
+        resources = load_resources()
+        model, onevall_models = resources['model'], resources['onevall_models']
+        model.eval()
+        for m in onevall_models:
+            m.eval()
+    except Exception as e:
+        print(f"Classification models not loaded: {e}", flush=True)
+    try:
+        from app.cropping_fun import fasterrcnn_crop
+        detector = fasterrcnn_crop
+        if detector.get_detector() is None:
+            detector = None
+    except Exception as e:
+        print(f"Detector not loaded: {e}", flush=True)
+        detector = None
+    return model, onevall_models, detector
+
+def build_stage(name: str, data: bytes, batch: int, pool: ThreadPoolExecutor, ctx: Dict[str, Any]) -> Optional[Callable[[], Any]]:
+    """
+    Returns a callable running one iteration of `name` on `batch` items (inputs are
+    prepared here, outside the timed region), or None if the stage cannot run.
+    """
+    transform = ctx['transform']
+    model, onevall_models, detector, device = ctx['model'], ctx['onevall_models'], ctx['detector'], ctx['device']
+
+    if name == 'decode':
+        return lambda: [r['image'].close() for r in pool.map(ingest_image, [data] * batch)]
+
+    image = ingest_image(data)['image']
+    if name == 'transform':
+        return lambda: list(pool.map(transform, [image] * batch))
+    if name == 'encode_base64':
+        return lambda: list(pool.map(lambda img: encode_image(img).to_base64(), [image] * batch))
+    if name in ('detect', 'crop'):
+        if detector is None:
+            return None
+        if name == 'detect':
+            return lambda: detector.detect_batch([image] * batch)
+        return lambda: detector.crop(image)
+
+    tensor = transform(image).unsqueeze(0).to(device)
+    if name in ('classify_6class', 'classify_1vsall'):
+        strategy = 'standard' if name == 'classify_6class' else '1vsall'
+        if model is None or (strategy == '1vsall' and not onevall_models):
+            return None
+        batch_tensor = tensor.repeat(batch, 1, 1, 1)
+        return lambda: perform_batch_inference(model, onevall_models, batch_tensor, strategy, device)
+    if name == 'occlusion':
+        if model is None:
+            return None
+        return lambda: all_class_occlusion(model, tensor, window=30, stride=25)
+    if name == 'integrated_gradients':
+        if model is None:
+            return None
+        steps = ctx['ig_steps']
+        return lambda: ENGINE.integrated_gradients(model, tensor, 0, n_steps=steps)
+    if name == 'render':
+        rng = np.random.default_rng(0)
+        attribution_map = rng.random((HEIGHT, WIDTH, 3), dtype=np.float32)
+        original_image = tensor_to_display_image(tensor.cpu(), MEAN, STD)
+        return lambda: render_heatmap(attribution_map, original_image, "positive", "Occlusion")
+    raise ValueError(f"Unknown stage: {name}")
+
+def time_runs(fn: Callable[[], Any], warmup: int, repeat: int) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summarize(times: List[float], batch: int) -> Dict[str, Any]:
+    ordered = sorted(times)
+    median = statistics.median(ordered)
+    return {
+        'median_s': median,
+        'p90_s': ordered[min(len(ordered) - 1, int(round(0.9 * (len(ordered) - 1))))],
+        'min_s': ordered[0],
+        'mean_s': statistics.fmean(ordered),
+        'stdev_s': statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+        'items_per_s': batch / median if median > 0 else None,
+        'runs': len(ordered),
+    }
+
+def result_key(entry: Dict[str, Any]) -> str:
+    return f"{entry['stage']}|{entry['input']}|b{entry['batch']}|t{entry['threads']}"
+
+def run_suite(args) -> Dict[str, Any]:
+    device = torch.device('cuda' if (args.gpu and torch.cuda.is_available()) else 'cpu')
+    stages = [s for s in args.stages.split(",") if s]
+    for stage in stages:
+        if stage not in STAGES:
+            raise SystemExit(f"Unknown stage: {stage}. Expected some of: {', '.join(STAGES)}")
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    thread_counts = [int(t) for t in args.threads.split(",")]
+
+    model, onevall_models, detector = load_models(device)
+    if model is not None:
+        ENGINE.calibrate(model, (1, 3, HEIGHT, WIDTH), device)
+    ctx = {
+        'transform': getTransforms(WIDTH, HEIGHT, True, MEAN, STD),
+        'model': model, 'onevall_models': onevall_models, 'detector': detector,
+        'device': device, 'ig_steps': args.ig_steps,
+    }
+
+    inputs = {f"{w}x{h}": synthetic_jpeg(w, h) for w, h in (parse_resolution(r) for r in args.resolutions.split(","))}
+    if args.images:
+        for i, data in enumerate(sample_images(args.images, args.max_images)):
+            inputs[f"sample_{i}"] = data
+    model_input = next(iter(inputs))
+
+    results, skipped = [], []
+    default_threads = torch.get_num_threads()
+    for stage in stages:
+        stage_inputs = list(inputs) if stage in RESOLUTION_STAGES else [model_input]
+        stage_batches = batch_sizes if stage in BATCHED_STAGES else [1]
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                for input_name in stage_inputs:
+                    for batch in stage_batches:
+                        fn = build_stage(stage, inputs[input_name], batch, pool, ctx)
+                        if fn is None:
+                            if stage not in skipped:
+                                skipped.append(stage)
+                            continue
+                        entry = {
+                            'stage': stage,
+                            'input': input_name if stage in RESOLUTION_STAGES else f"{WIDTH}x{HEIGHT}",
+                            'batch': batch,
+                            'threads': threads,
+                            **summarize(time_runs(fn, args.warmup, args.repeat), batch),
+                        }
+                        results.append(entry)
+                        print(f"{result_key(entry):<50} median {entry['median_s'] * 1000:9.2f} ms  "
+                              f"{entry['items_per_s']:9.2f} items/s", flush=True)
+    torch.set_num_threads(default_threads)
+
+    return {
+        'meta': {**hardware_metadata(), 'device': str(device), 'model_input': [WIDTH, HEIGHT],
+                 'warmup': args.warmup, 'repeat': args.repeat, 'ig_steps': args.ig_steps},
+        'skipped_stages': skipped,
+        'results': results,
+    }
+
+
+# --- BASELINE COMPARISON ---
+
+def parse_stage_thresholds(values: List[str]) -> Dict[str, float]:
+    thresholds = {}
+    for value in values or []:
+        stage, threshold = value.split("=", 1)
+        thresholds[stage] = float(threshold)
+    return thresholds
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float,
+            stage_thresholds: Dict[str, float], min_delta: float) -> List[Dict[str, Any]]:
+    """
+    One row per benchmark: 'regressed' if the median got slower by more than the
+    stage threshold (fraction) and by more than min_delta seconds, 'improved' if
+    faster by as much, 'ok' otherwise; 'new' / 'missing' for unmatched entries.
+    """
+    base = {result_key(e): e for e in baseline.get('results', [])}
+    rows = []
+    for entry in current['results']:
+        key = result_key(entry)
+        old = base.pop(key, None)
+        if old is None:
+            rows.append({'key': key, 'status': 'new', 'current_s': entry['median_s']})
+            continue
+        limit = stage_thresholds.get(entry['stage'], threshold)
+        delta = entry['median_s'] - old['median_s']
+        change = delta / old['median_s'] if old['median_s'] > 0 else 0.0
+        if change > limit and delta > min_delta:
+            status = 'regressed'
+        elif change < -limit and -delta > min_delta:
+            status = 'improved'
+        else:
+            status = 'ok'
+        rows.append({'key': key, 'status': status, 'baseline_s': old['median_s'],
+                     'current_s': entry['median_s'], 'change': change, 'threshold': limit})
+    rows.extend({'key': key, 'status': 'missing', 'baseline_s': old['median_s']} for key, old in base.items())
+    return rows
+
+def print_comparison(rows: List[Dict[str, Any]]):
+    print(f"\n{'benchmark':<50} {'baseline ms':>12} {'current ms':>12} {'change':>9}  status")
+    for row in rows:
+        baseline = f"{row['baseline_s'] * 1000:.2f}" if 'baseline_s' in row else "-"
+        current = f"{row['current_s'] * 1000:.2f}" if 'current_s' in row else "-"
+        change = f"{row['change'] * 100:+.1f}%" if 'change' in row else "-"
+        print(f"{row['key']:<50} {baseline:>12} {current:>12} {change:>9}  {row['status']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stage-level microbenchmarks with baseline comparison")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--batch-sizes", default="1,4,16")
+    parser.add_argument("--threads", default=str(torch.get_num_threads()), help="comma separated torch / pool thread counts")
+    parser.add_argument("--resolutions", default=DEFAULT_RESOLUTIONS, help="synthetic inputs, WxH comma separated")
+    parser.add_argument("--images", help="folder of sample photos to benchmark as well")
+    parser.add_argument("--max-images", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--ig-steps", type=int, default=32, help="fixed IG steps, so the number does not depend on the time budget")
+    parser.add_argument("--gpu", action="store_true")
+    parser.add_argument("--output", default=os.path.join(TEST_RESULTS_ROOT, "benchmarks"))
+    parser.add_argument("--baseline", help="result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown of the median, as a fraction")
+    parser.add_argument("--stage-threshold", action="append", metavar="STAGE=FRACTION",
+                        help="per-stage override, e.g. occlusion=0.2 (repeatable)")
+    parser.add_argument("--min-delta", type=float, default=0.001, help="ignore changes smaller than this many seconds")
+    parser.add_argument("--save-baseline", help="also copy the result file here")
+    args = parser.parse_args(argv)
+
+    report = run_suite(args)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"stage_bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults: {path}", flush=True)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or ".", exist_ok=True)
+        shutil.copyfile(path, args.save_baseline)
+        print(f"Baseline saved: {args.save_baseline}", flush=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('cpu_model') != report['meta'].get('cpu_model'):
+            print("Warning: baseline recorded on a different CPU, the comparison is only indicative", flush=True)
+        rows = compare(report, baseline, args.threshold, parse_stage_thresholds(args.stage_threshold), args.min_delta)
+        print_comparison(rows)
+        regressed = [r for r in rows if r['status'] == 'regressed']
+        if regressed:
+            print(f"\n{len(regressed)} regression(s) above threshold", flush=True)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,12 +17,14 @@ import { SaveStrategy, getBoxesForStrategy } from "@/utils/saveStrategies";
 interface SaveMetadata {
   filename: string;
   boxes: number[][]; 
+  upload_id?: string;
 }
 
 const ITEMS_PER_PAGE = 10;
 const BATCH_SIZE = 16; 
-const API_URL = 'http://localhost:5000/dbinference';
-const SAVE_API_URL = 'http://localhost:5000/save_dataset'; 
+const API_ORIGIN = 'http://localhost:5000';
+const API_URL = `${API_ORIGIN}/dbinference`;
+const SAVE_API_URL = `${API_ORIGIN}/save_dataset`;
 
 export default function FolderTransformer() {
   // --- STATE ---
@@ -32,6 +34,8 @@ export default function FolderTransformer() {
 
   const [isTransforming, setIsTransforming] = useState(false);
   const [processedCount, setProcessedCount] = useState(0);
+  // Sessione dello spool lato server: al salvataggio si inviano solo gli ID degli originali
+  const [uploadSession, setUploadSession] = useState<string | null>(null);
 
   // Save UI States
   const [folderName, setFolderName] = useState<string>("processed_dataset");
@@ -62,6 +66,7 @@ export default function FolderTransformer() {
       setTransformedFiles([]);
       setOriginalTransformedFiles([]);
       setProcessedCount(0);
+      setUploadSession(null);
       setCurrentPage(1);
       setIsTransforming(false);
       setIsSavingRemote(false);
@@ -117,27 +122,25 @@ export default function FolderTransformer() {
     setIsSavingRemote(true);
     setShowOrganizeModal(false);
     
-    const formData = new FormData();
-    formData.append('folder_organized', String(folderOrganized));
-    if (resize) {
-      formData.append('resize_w', resize.width.toString());
-      formData.append('resize_h', resize.height.toString());
-    }
+    const buildForm = () => {
+      const formData = new FormData();
+      formData.append('folder_organized', String(folderOrganized));
+      if (resize) {
+        formData.append('resize_w', resize.width.toString());
+        formData.append('resize_h', resize.height.toString());
+      }
+      return formData;
+    };
 
-    try {
-      const fileData = await Promise.all(
-        transformedFiles.map(async (file) => {
-          const res = await fetch(file.url);
-          const blob = await res.blob();
-          return { blob, name: file.name, originalFile: file };
-        })
-      );
+    // Immagine da ricaricare solo se l'originale non è (più) nello spool del server
+    // (instanceof: dopo il reset globale i File clonati via JSON non sono più Blob)
+    const fileBlob = async (file: ImageFile): Promise<Blob> =>
+      file.file instanceof Blob ? file.file : await (await fetch(file.url)).blob();
 
+    try {
       const metadata: SaveMetadata[] = [];
 
-      fileData.forEach(({ blob, name, originalFile }) => {
-        formData.append('images_files', blob, name);
-        
+      transformedFiles.forEach((originalFile) => {
         let baseStrategy = strategy;
         if (typeof threshold === 'number') {
           if (strategy === 'global_best') baseStrategy = 'global_all';
@@ -155,7 +158,7 @@ export default function FolderTransformer() {
         }
 
         if (boxesToSend.length > 0) {
-          metadata.push({ filename: name, boxes: boxesToSend });
+          metadata.push({ filename: originalFile.name, boxes: boxesToSend, upload_id: originalFile.uploadId || undefined });
         }
       });
 
@@ -165,9 +168,33 @@ export default function FolderTransformer() {
         return;
       }
 
+      const filesByName = new Map(transformedFiles.map(f => [f.name, f]));
+      const sendImages = async (formData: FormData, names: Set<string>) => {
+        const blobs = await Promise.all(
+          metadata.filter(m => names.has(m.filename)).map(async (m) => ({ name: m.filename, blob: await fileBlob(filesByName.get(m.filename)!) }))
+        );
+        blobs.forEach(({ name, blob }) => formData.append('images_files', blob, name));
+      };
+
+      // 1. Solo metadati + ID: le immagini già nello spool non vengono ricaricate
+      let formData = buildForm();
+      if (uploadSession) formData.append('upload_session', uploadSession);
+      await sendImages(formData, new Set(metadata.filter(m => !(uploadSession && m.upload_id)).map(m => m.filename)));
       formData.append('metadata', JSON.stringify(metadata));
-      
-      const response = await fetch(SAVE_API_URL, { method: 'POST', body: formData });
+
+      let response = await fetch(SAVE_API_URL, { method: 'POST', body: formData });
+
+      // 2. Originali scaduti sul server: si ricaricano solo quelli mancanti
+      if (response.status === 410) {
+        const { missing } = await response.json();
+        formData = buildForm();
+        if (uploadSession) formData.append('upload_session', uploadSession);
+        await sendImages(formData, new Set<string>(missing));
+        formData.append('metadata', JSON.stringify(
+          metadata.map(m => missing.includes(m.filename) ? { filename: m.filename, boxes: m.boxes } : m)
+        ));
+        response = await fetch(SAVE_API_URL, { method: 'POST', body: formData });
+      }
       if (!response.ok) throw new Error("Errore nel salvataggio lato server");
 
       const zipBlob = await response.blob();
@@ -198,6 +225,7 @@ export default function FolderTransformer() {
     setProcessedCount(0);
     
     let accumulatedCount = 0;
+    let session = uploadSession;
     const allTransformedResults: ImageFile[] = [];
 
     try {
@@ -205,14 +233,20 @@ export default function FolderTransformer() {
         const currentBatch = files.slice(i, i + BATCH_SIZE);
         const formData = new FormData();
         currentBatch.forEach(f => f.file && formData.append('images', f.file));
+        // Anteprime per URL: cache del browser e dello store lato server, niente base64 nel JSON
+        formData.append('preview', 'url');
+        if (session) formData.append('upload_session', session);
 
         const res = await fetch(API_URL, { method: 'POST', body: formData });
         if (!res.ok) throw new Error(res.statusText);
         const data: BackendResponse = await res.json();
+        session = data.upload_session ?? session;
 
         const batchResults: ImageFile[] = currentBatch.map((orig, idx) => ({
           name: orig.name,
-          url: data.images[idx] ? (data.images[idx].startsWith('data:') ? data.images[idx] : `data:image/jpeg;base64,${data.images[idx]}`) : orig.url,
+          url: data.preview_urls?.[idx] ? `${API_ORIGIN}${data.preview_urls[idx]}` : data.images?.[idx] ? (data.images[idx].startsWith('data:') ? data.images[idx] : `data:image/jpeg;base64,${data.images[idx]}`) : orig.url,
+          file: orig.file,
+          uploadId: data.upload_ids?.[idx] || undefined,
           analysis: {
             boxes: data.bounding_box?.[idx] || [],
             scores: data.scores?.[idx] || [],
@@ -228,6 +262,7 @@ export default function FolderTransformer() {
         setProcessedCount(accumulatedCount);
       }
 
+      setUploadSession(session);
       setTransformedFiles(allTransformedResults);
       setOriginalTransformedFiles(JSON.parse(JSON.stringify(allTransformedResults)));
       setShowResults(true);
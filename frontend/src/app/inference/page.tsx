@@ -2,11 +2,12 @@
 
 import { useState, ChangeEvent } from "react";
 import Image from "next/image";
-import { ApiResponse } from "@/types";
+import { ApiResponse, ExplanationJob } from "@/types";
 import DashboardSidebar from "@/components/DashBoardSidebar";
 import ResultsDisplay from "@/components/ResultDisplay";
 
-const API_URL = "http://localhost:5000/inference";
+const API_BASE = "http://localhost:5000";
+const API_URL = `${API_BASE}/inference`;
 
 export default function OrchidDashboard() {
   // --- STATE MANAGEMENT ---
@@ -83,6 +84,47 @@ export default function OrchidDashboard() {
   };
 
   // --- API CALL ---
+  const cacheResult = (data: ApiResponse, currentKey: string) => {
+    setResultCache((prev) => {
+      const newCache = { ...prev };
+      newCache[currentKey] = data;
+
+      if (cropMode === "compare") {
+        const intKey = getCacheKey(modelStrategy, "integrated", useGpu, showOcclusion, showIG);
+        newCache[intKey] = data;
+
+        const extKey = getCacheKey(modelStrategy, "external", useGpu, showOcclusion, showIG);
+        
+        // Creiamo un risultato che sembri un'analisi "External" pura
+        const syntheticExternal: ApiResponse = {
+          ...data,
+          // Sovrascriviamo i campi principali con quelli del crop
+          predicted_class: data.predicted_class_cropped || data.predicted_class,
+          confidence: data.confidence_cropped || data.confidence,
+          all_classes_probs: data.all_classes_probs_cropped || data.all_classes_probs,
+          integrated_gradients: data.integrated_gradients_cropped,
+          occlusion: data.occlusion_cropped,
+          // Importante: manteniamo il riferimento all'immagine croppata
+          image_cropped: data.image_cropped 
+        };
+        newCache[extKey] = syntheticExternal;
+      }
+      return newCache;
+    });
+  };
+
+  // Long-polling del job di spiegazione (explain_async): la classificazione è già visibile
+  const fetchExplanations = async (jobId: string): Promise<Partial<ApiResponse> | null> => {
+    for (let attempt = 0; attempt < 20; attempt++) {
+      const res = await fetch(`${API_BASE}/explanations/jobs/${jobId}?wait=15`);
+      if (!res.ok) return null;
+      const job: ExplanationJob = await res.json();
+      if (job.status === "done") return job.result ?? null;
+      if (job.status === "error") throw new Error(job.error || "Explanation failed");
+    }
+    return null;
+  };
+
   const handleAnalyze = async () => {
     if (!selectedFile) return;
     
@@ -110,6 +152,10 @@ export default function OrchidDashboard() {
     formData.append("model_strategy", modelStrategy);
     formData.append("crop_mode", cropMode);
     formData.append("explain_method", explainMethod);
+    // Heatmap compatte (mappa quantizzata), colorate e sovrapposte lato client
+    formData.append("xai_format", "raw");
+    // La classificazione torna subito, le spiegazioni arrivano dal worker XAI
+    formData.append("explain_async", "true");
 
     try {
       const res = await fetch(API_URL, { method: "POST", body: formData });
@@ -120,33 +166,18 @@ export default function OrchidDashboard() {
       setResult(data);
       setAnalyzedMode(cropMode);
       setAnalyzedStrategy(modelStrategy);
+      setLoading(false);
 
-      // Cache Logic
-      const newCache = { ...resultCache };
-      newCache[currentKey] = data;
-
-      if (cropMode === "compare") {
-        const intKey = getCacheKey(modelStrategy, "integrated", useGpu, showOcclusion, showIG);
-        newCache[intKey] = data;
-
-        const extKey = getCacheKey(modelStrategy, "external", useGpu, showOcclusion, showIG);
-        
-        // Creiamo un risultato che sembri un'analisi "External" pura
-        const syntheticExternal: ApiResponse = {
-          ...data,
-          // Sovrascriviamo i campi principali con quelli del crop
-          predicted_class: data.predicted_class_cropped || data.predicted_class,
-          confidence: data.confidence_cropped || data.confidence,
-          all_classes_probs: data.all_classes_probs_cropped || data.all_classes_probs,
-          integrated_gradients: data.integrated_gradients_cropped,
-          occlusion: data.occlusion_cropped,
-          // Importante: manteniamo il riferimento all'immagine croppata
-          image_cropped: data.image_cropped 
-        };
-        newCache[extKey] = syntheticExternal;
+      if (!data.explanation_job) {
+        cacheResult(data, currentKey);
+        return;
       }
 
-      setResultCache(newCache);
+      const explanations = await fetchExplanations(data.explanation_job.id);
+      const complete: ApiResponse = { ...data, ...explanations, explanation_job: undefined };
+      // Aggiorna solo se l'utente non ha nel frattempo caricato un'altra immagine
+      setResult((current) => (current === data ? complete : current));
+      cacheResult(complete, currentKey);
 
     } catch (err: unknown) {
       console.error(err);
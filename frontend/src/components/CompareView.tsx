@@ -2,53 +2,62 @@
 
 import { useState } from "react";
 import Image from "next/image";
-import { ApiResponse } from "@/types";
+import { ApiResponse, Explanation } from "@/types";
 import PredictionCard from "@/components/PredictionCard";
 import ProbabilityDropdown from "@/components/ProbabilityDropdown";
 import { useImageMetadata } from "@/hooks/useImageMetadata";
+import { useHeatmapSrc } from "@/hooks/useHeatmapSrc";
+import { HeatmapStyle } from "@/utils/heatmapUtils";
 
 interface CompareViewProps {
   result: ApiResponse;
   preview: string;
   analyzedMode: string | null;
   strategyName: string;
+  heatmapStyle: HeatmapStyle;
 }
 
 // --- SOTTO-COMPONENTE PER LE MINIATURE XAI ---
 function XaiDisplay({ 
   ig, 
   occ, 
+  baseSrc,
+  heatmapStyle,
   title, 
   onImageClick 
 }: { 
-  ig?: string, 
-  occ?: string, 
+  ig?: Explanation, 
+  occ?: Explanation, 
+  baseSrc?: string,
+  heatmapStyle: HeatmapStyle,
   title: string, 
   onImageClick: (src: string, label: string) => void 
 }) {
-  if (!ig && !occ) return null;
+  const igSrc = useHeatmapSrc(ig, baseSrc, heatmapStyle);
+  const occSrc = useHeatmapSrc(occ, baseSrc, heatmapStyle);
+  if (!igSrc && !occSrc) return null;
   return (
     <div className="mt-6 pt-6 border-t border-stone-100">
       <h4 className="text-[10px] font-bold text-emerald-800 uppercase mb-4 tracking-widest flex items-center gap-2">
         🧠 {title} Explanations
       </h4>
       <div className="grid grid-cols-2 gap-3">
-        {ig && (
+        {igSrc && (
           <div 
-            onClick={() => onImageClick(`data:image/jpeg;base64,${ig}`, `${title} - Integrated Gradients`)}
+            onClick={() => onImageClick(igSrc, `${title} - Integrated Gradients`)}
             className="relative h-40 bg-white rounded-lg border border-stone-200 overflow-hidden group cursor-zoom-in hover:border-emerald-500 transition-all shadow-sm"
           >
             <span className="absolute top-1 left-1 z-10 bg-black/60 text-[8px] text-white px-1.5 py-0.5 rounded font-bold uppercase backdrop-blur-sm">IG</span>
-            <Image src={`data:image/jpeg;base64,${ig}`} alt="IG" fill className="object-contain p-1" unoptimized />
+            <Image src={igSrc} alt="IG" fill className="object-contain p-1" unoptimized />
           </div>
         )}
-        {occ && (
+        {occSrc && (
           <div 
-            onClick={() => onImageClick(`data:image/jpeg;base64,${occ}`, `${title} - Occlusion Map`)}
+            onClick={() => onImageClick(occSrc, `${title} - Occlusion Map`)}
             className="relative h-40 bg-white rounded-lg border border-stone-200 overflow-hidden group cursor-zoom-in hover:border-emerald-500 transition-all shadow-sm"
           >
             <span className="absolute top-1 left-1 z-10 bg-black/60 text-[8px] text-white px-1.5 py-0.5 rounded font-bold uppercase backdrop-blur-sm">Occ</span>
-            <Image src={`data:image/jpeg;base64,${occ}`} alt="Occ" fill className="object-contain p-1" unoptimized />
+            <Image src={occSrc} alt="Occ" fill className="object-contain p-1" unoptimized />
           </div>
         )}
       </div>
@@ -67,7 +76,7 @@ function EmptyStateCard({ title }: { title: string }) {
 }
 
 // --- COMPONENTE PRINCIPALE ---
-export default function CompareView({ result, preview, analyzedMode, strategyName }: CompareViewProps) {
+export default function CompareView({ result, preview, analyzedMode, strategyName, heatmapStyle }: CompareViewProps) {
   const [showMetadata, setShowMetadata] = useState(false);
   const [fullscreenImg, setFullscreenImg] = useState<{src: string, label: string} | null>(null);
   
@@ -153,7 +162,7 @@ export default function CompareView({ result, preview, analyzedMode, strategyNam
               >
                  <Image src={preview} alt="Original" fill className="object-contain group-hover:scale-[1.02] transition-transform duration-500" unoptimized />
               </div>
-              <XaiDisplay ig={leftData.ig} occ={leftData.occ} title="Original" onImageClick={handleImageClick} />
+              <XaiDisplay ig={leftData.ig} occ={leftData.occ} baseSrc={preview} heatmapStyle={heatmapStyle} title="Original" onImageClick={handleImageClick} />
             </>
           ) : (
             <EmptyStateCard title="Integrated Results Pending" />
@@ -179,7 +188,14 @@ export default function CompareView({ result, preview, analyzedMode, strategyNam
                       <div className="h-full flex items-center justify-center text-stone-400 italic">No Crop Available</div>
                    )}
                 </div>
-                <XaiDisplay ig={rightData.ig} occ={rightData.occ} title="Cropped" onImageClick={handleImageClick} />
+                <XaiDisplay
+                  ig={rightData.ig}
+                  occ={rightData.occ}
+                  baseSrc={rightData.crop ? `data:image/jpeg;base64,${rightData.crop}` : undefined}
+                  heatmapStyle={heatmapStyle}
+                  title="Cropped"
+                  onImageClick={handleImageClick}
+                />
               </>
             ) : (
               <div className="h-full flex flex-col items-center justify-center p-8 bg-amber-50 rounded-xl border border-amber-100 min-h-[400px]">
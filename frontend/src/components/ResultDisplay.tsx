@@ -1,6 +1,38 @@
+import { useState } from "react";
 import { ApiResponse } from "@/types";
 import CompareView from "./CompareView";
 import SingleView from "./SingleView";
+import { ColormapName, DEFAULT_HEATMAP_STYLE, HeatmapStyle, isRawHeatmap } from "@/utils/heatmapUtils";
+
+// Controlli per le heatmap raw (xai_format=raw): ricolorate nel browser, senza nuova richiesta
+function HeatmapControls({ style, onChange }: { style: HeatmapStyle, onChange: (style: HeatmapStyle) => void }) {
+  return (
+    <div className="flex flex-wrap items-center justify-center gap-6 mb-6 text-xs font-bold text-stone-500 uppercase tracking-widest">
+      <label className="flex items-center gap-2">
+        Heatmap opacity
+        <input
+          type="range" min={0} max={1} step={0.05} value={style.opacity}
+          onChange={(e) => onChange({ ...style, opacity: parseFloat(e.target.value) })}
+          className="accent-emerald-600"
+        />
+      </label>
+      <label className="flex items-center gap-2">
+        Colormap
+        <select
+          value={style.colormap}
+          onChange={(e) => onChange({ ...style, colormap: e.target.value as ColormapName })}
+          className="bg-white border border-stone-200 rounded px-2 py-1 normal-case font-medium text-stone-700"
+        >
+          <option value="auto">Default</option>
+          <option value="greens">Greens</option>
+          <option value="blues">Blues</option>
+          <option value="reds">Reds</option>
+          <option value="viridis">Viridis</option>
+        </select>
+      </label>
+    </div>
+  );
+}
 
 interface ResultsDisplayProps {
   result: ApiResponse;
@@ -21,6 +53,12 @@ export default function ResultsDisplay({
   analyzedStrategy,
   useGpu 
 }: ResultsDisplayProps) {
+  const [heatmapStyle, setHeatmapStyle] = useState<HeatmapStyle>(DEFAULT_HEATMAP_STYLE);
+  const hasRawHeatmaps = [
+    result.integrated_gradients, result.occlusion,
+    result.integrated_gradients_cropped, result.occlusion_cropped,
+  ].some(isRawHeatmap);
+  const controls = hasRawHeatmaps ? <HeatmapControls style={heatmapStyle} onChange={setHeatmapStyle} /> : null;
   
   // Format Strategy Name for UI
   const getStrategyName = (strat: string | null) => {
@@ -51,12 +89,16 @@ export default function ResultsDisplay({
 
   if (currentCropMode === "compare") {
     return (
-      <CompareView 
-        result={result} 
-        preview={preview} 
-        analyzedMode={analyzedCropMode} 
-        strategyName={displayStrategyName} // <--- Pass Name
-      />
+      <>
+        {controls}
+        <CompareView 
+          result={result} 
+          preview={preview} 
+          analyzedMode={analyzedCropMode} 
+          strategyName={displayStrategyName} // <--- Pass Name
+          heatmapStyle={heatmapStyle}
+        />
+      </>
     );
   }
 
@@ -77,12 +119,16 @@ export default function ResultsDisplay({
 
   // --- LOGIC 3: Single Mode Matches ---
   return (
-    <SingleView 
-      result={result} 
-      preview={preview} 
-      mode={currentCropMode} 
-      useGpu={useGpu} 
-      strategyName={displayStrategyName} // <--- Pass Name
-    />
+    <>
+      {controls}
+      <SingleView 
+        result={result} 
+        preview={preview} 
+        mode={currentCropMode} 
+        useGpu={useGpu} 
+        strategyName={displayStrategyName} // <--- Pass Name
+        heatmapStyle={heatmapStyle}
+      />
+    </>
   );
 }
\ No newline at end of file
@@ -6,6 +6,8 @@ import { ApiResponse } from "@/types";
 import { getConfidenceColor } from "@/components/PredictionCard";
 import ProbabilityDropdown from "@/components/ProbabilityDropdown";
 import { useImageMetadata } from "@/hooks/useImageMetadata";
+import { useHeatmapSrc } from "@/hooks/useHeatmapSrc";
+import { HeatmapStyle } from "@/utils/heatmapUtils";
 
 interface SingleViewProps {
   result: ApiResponse;
@@ -13,9 +15,10 @@ interface SingleViewProps {
   mode: string; 
   useGpu: boolean;
   strategyName: string;
+  heatmapStyle: HeatmapStyle;
 }
 
-export default function SingleView({ result, preview, mode, useGpu, strategyName }: SingleViewProps) {
+export default function SingleView({ result, preview, mode, useGpu, strategyName, heatmapStyle }: SingleViewProps) {
   const [showMetadata, setShowMetadata] = useState(false);
   const [fullscreenImg, setFullscreenImg] = useState<{src: string, label: string} | null>(null);
   
@@ -25,6 +28,10 @@ export default function SingleView({ result, preview, mode, useGpu, strategyName
   const displayImageSrc = isExternal && result.image_cropped ? `data:image/jpeg;base64,${result.image_cropped}` : preview;
   const displayImageLabel = isExternal && result.image_cropped ? "Focused Crop Input" : "Original Input";
 
+  // Heatmap (rendered dal backend, oppure raw colorizzate qui sopra l'immagine analizzata)
+  const igSrc = useHeatmapSrc(result.integrated_gradients, displayImageSrc, heatmapStyle);
+  const occSrc = useHeatmapSrc(result.occlusion, displayImageSrc, heatmapStyle);
+
   // Estrazione metadati dall'immagine originale
   const { metadata, address, loading } = useImageMetadata(preview);
 
@@ -159,28 +166,28 @@ export default function SingleView({ result, preview, mode, useGpu, strategyName
         </div>
 
         {/* Visual Explanation (Heatmaps) */}
-        {useGpu && (result.integrated_gradients || result.occlusion) && (
+        {useGpu && (igSrc || occSrc) && (
           <div className="bg-stone-50 p-6 rounded-xl border border-stone-200 shadow-inner">
             <h3 className="font-bold text-emerald-900 mb-6 flex items-center gap-2">
                🧠 Visual Explanation
             </h3>
             <div className="grid grid-cols-1 md:grid-cols-2 gap-6">
-              {result.integrated_gradients && (
+              {igSrc && (
                 <div 
                     className="relative w-full h-[350px] bg-white rounded-lg overflow-hidden shadow-sm border border-stone-200 cursor-zoom-in hover:border-emerald-500 transition-colors group"
-                    onClick={() => handleImageClick(`data:image/jpeg;base64,${result.integrated_gradients}`, "Integrated Gradients")}
+                    onClick={() => handleImageClick(igSrc, "Integrated Gradients")}
                 >
                   <p className="absolute top-2 left-2 z-10 bg-stone-900/80 text-white px-3 py-1 text-[10px] rounded font-bold backdrop-blur-sm uppercase">IG Map</p>
-                  <Image src={`data:image/jpeg;base64,${result.integrated_gradients}`} alt="IG" fill className="object-contain p-2 group-hover:scale-105 transition-transform" />
+                  <Image src={igSrc} alt="IG" fill className="object-contain p-2 group-hover:scale-105 transition-transform" unoptimized />
                 </div>
               )}
-              {result.occlusion && (
+              {occSrc && (
                 <div 
                     className="relative w-full h-[350px] bg-white rounded-lg overflow-hidden shadow-sm border border-stone-200 cursor-zoom-in hover:border-emerald-500 transition-colors group"
-                    onClick={() => handleImageClick(`data:image/jpeg;base64,${result.occlusion}`, "Occlusion Map")}
+                    onClick={() => handleImageClick(occSrc, "Occlusion Map")}
                 >
                   <p className="absolute top-2 left-2 z-10 bg-stone-900/80 text-white px-3 py-1 text-[10px] rounded font-bold backdrop-blur-sm uppercase">Occlusion</p>
-                  <Image src={`data:image/jpeg;base64,${result.occlusion}`} alt="Occ" fill className="object-contain p-2 group-hover:scale-105 transition-transform" />
+                  <Image src={occSrc} alt="Occ" fill className="object-contain p-2 group-hover:scale-105 transition-transform" unoptimized />
                 </div>
               )}
             </div>
@@ -0,0 +1,34 @@
+import { useState, useEffect } from 'react';
+import { Explanation } from '@/types';
+import { HeatmapStyle, isRawHeatmap, renderRawHeatmap, renderedExplanationSrc } from '@/utils/heatmapUtils';
+
+/**
+ * Image src for an explanation: rendered JPEGs are used as they are, raw heatmaps
+ * (xai_format=raw) are colorized client-side over `baseSrc` and re-rendered when
+ * the style changes, without calling the backend again.
+ */
+export function useHeatmapSrc(value: Explanation | null | undefined, baseSrc: string | undefined, style: HeatmapStyle) {
+  const [src, setSrc] = useState<string | undefined>(renderedExplanationSrc(value));
+
+  useEffect(() => {
+    if (!isRawHeatmap(value)) {
+      setSrc(renderedExplanationSrc(value));
+      return;
+    }
+    if (!baseSrc) {
+      setSrc(undefined);
+      return;
+    }
+
+    let cancelled = false;
+    renderRawHeatmap(value, baseSrc, style)
+      .then((rendered) => { if (!cancelled) setSrc(rendered); })
+      .catch((err) => {
+        console.error("Heatmap rendering failed:", err);
+        if (!cancelled) setSrc(undefined);
+      });
+    return () => { cancelled = true; };
+  }, [value, baseSrc, style]);
+
+  return src;
+}
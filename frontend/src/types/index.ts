@@ -8,25 +8,76 @@ export interface ApiResponse {
   image_cropped?: string; // Base64 of the crop
   
   // Explainability fields (Original/Primary)
-  integrated_gradients?: string; 
-  occlusion?: string;
+  integrated_gradients?: Explanation;
+  occlusion?: Explanation;
+  gradcam?: Explanation; // explain_method "gradcam" / "gradcam++" (also in /inference/batch)
+  // Id of the stored all-class occlusion sweep (GET /explanations/occlusion/<id>/class/<k>)
+  occlusion_map_id?: string | null;
 
   // Comparison/Secondary fields (The ones causing the error)
   predicted_class_cropped?: string;
   confidence_cropped?: number;
   all_classes_probs_cropped?: number[];
-  integrated_gradients_cropped?: string;
-  occlusion_cropped?: string;
+  integrated_gradients_cropped?: Explanation;
+  gradcam_cropped?: Explanation;
+  occlusion_cropped?: Explanation;
+  occlusion_map_id_cropped?: string | null;
+
+  // explain_async=true: explanations computed in background, fetched from /explanations/jobs/<id>
+  explanation_job?: { id: string; status: string; poll: string; events: string };
+
+  // Multi-strategy mode (model_strategy = "all" or "standard,1vsall")
+  strategies?: string[];
+  views?: string[];
+  combinations?: Record<string, Record<string, StrategyViewResult>>;
 
   // Error handling
   error?: string;
   traceback?: string;
 }
 
+// Explanation as returned with xai_format=raw: the attribution map quantized to a
+// grayscale PNG at its natural resolution, colorized client-side (utils/heatmapUtils)
+export interface RawHeatmap {
+  format: "raw";
+  data: string;   // data:image/png;base64,...
+  width: number;
+  height: number;
+  min: number;    // value = min + pixel / 255 * (max - min)
+  max: number;
+  scale: number;  // normalized = clip(value / scale, -1, 1), as captum
+  sign: "positive" | "absolute_value" | "negative" | "all";
+}
+
+// Rendered JPEG (base64, default) or raw heatmap (xai_format=raw)
+export type Explanation = string | RawHeatmap;
+
+export interface ExplanationJob {
+  id: string;
+  status: "pending" | "running" | "done" | "error";
+  method: string;
+  created_at: number;
+  finished_at: number | null;
+  result: Partial<ApiResponse> | null; // explanation fields, merged into the ApiResponse
+  error: string | null;
+}
+
+export interface StrategyViewResult {
+  predicted_class: string;
+  confidence: number;
+  all_classes_probs: number[];
+  integrated_gradients?: Explanation;
+  occlusion?: Explanation;
+  occlusion_map_id?: string | null;
+  gradcam?: Explanation;
+  error?: string | null;
+}
+
 export interface ImageFile {
   name: string;
   url: string;      
   file?: File;      
+  uploadId?: string; // Original spooled by /dbinference, reused by /save_dataset
   analysis?: {
     boxes: number[][];    // Matrix Nx4
     scores: number[];     // List of N scores
@@ -41,8 +92,11 @@ export interface ImageFile {
 }
 
 export interface BackendResponse {
-  images: string[];   
+  images?: string[];          // preview=thumb: inline JPEG previews
+  preview_urls?: string[];    // preview=url: paths of the cached previews
   bounding_box: number[][][]; 
   scores: number[][];         
   bb_count: number;           
+  upload_session?: string;    // Upload spool session, sent back with the next batches and on save
+  upload_ids?: string[];      // One per image, "" if the original was not spooled
 }
\ No newline at end of file
@@ -0,0 +1,126 @@
+// src/utils/heatmapUtils.ts
+import { Explanation, RawHeatmap } from "@/types";
+
+// --- TYPES ---
+export type ColormapName = "auto" | "greens" | "blues" | "reds" | "viridis";
+
+export interface HeatmapStyle {
+  opacity: number;       // 0..1, peso della heatmap sopra l'immagine (0.5 come captum)
+  colormap: ColormapName; // "auto" = colormap scelta da captum per il sign
+}
+
+export const DEFAULT_HEATMAP_STYLE: HeatmapStyle = { opacity: 0.5, colormap: "auto" };
+
+// Stops of the matplotlib colormaps captum uses (ColorBrewer 9-class) + viridis
+const COLORMAPS: Record<Exclude<ColormapName, "auto">, string[]> = {
+  greens: ["#f7fcf5", "#e5f5e0", "#c7e9c0", "#a1d99b", "#74c476", "#41ab5d", "#238b45", "#006d2c", "#00441b"],
+  blues: ["#f7fbff", "#deebf7", "#c6dbef", "#9ecae1", "#6baed6", "#4292c6", "#2171b5", "#08519c", "#08306b"],
+  reds: ["#fff5f0", "#fee0d2", "#fcbba1", "#fc9272", "#fb6a4a", "#ef3b2c", "#cb181d", "#a50f15", "#67000d"],
+  viridis: ["#440154", "#482878", "#3e4989", "#31688e", "#26828e", "#1f9e89", "#35b779", "#6ece58", "#b5de2b", "#fde725"],
+};
+const RED_WHITE_GREEN = ["#ff0000", "#ffffff", "#008000"];
+
+const SIGN_COLORMAP: Record<RawHeatmap["sign"], string[]> = {
+  positive: COLORMAPS.greens,
+  absolute_value: COLORMAPS.blues,
+  negative: COLORMAPS.reds,
+  all: RED_WHITE_GREEN,
+};
+
+// --- HELPER FUNCTIONS ---
+
+export const isRawHeatmap = (value: Explanation | null | undefined): value is RawHeatmap =>
+  typeof value === "object" && value !== null && value.format === "raw";
+
+/** Image src for an explanation already rendered by the backend (plain base64 JPEG). */
+export const renderedExplanationSrc = (value: Explanation | null | undefined) =>
+  typeof value === "string" ? `data:image/jpeg;base64,${value}` : undefined;
+
+const hexToRgb = (hex: string) => [1, 3, 5].map((i) => parseInt(hex.slice(i, i + 2), 16));
+
+/** 256-entry RGB lookup table, linear between the colormap stops. */
+const buildLut = (stops: string[]) => {
+  const rgb = stops.map(hexToRgb);
+  const lut = new Uint8ClampedArray(256 * 3);
+  for (let i = 0; i < 256; i++) {
+    const pos = (i / 255) * (rgb.length - 1);
+    const lo = Math.floor(pos);
+    const hi = Math.min(lo + 1, rgb.length - 1);
+    const t = pos - lo;
+    for (let c = 0; c < 3; c++) lut[i * 3 + c] = rgb[lo][c] + (rgb[hi][c] - rgb[lo][c]) * t;
+  }
+  return lut;
+};
+
+const lutCache = new Map<string, Uint8ClampedArray>();
+const getLut = (stops: string[]) => {
+  const key = stops.join(",");
+  if (!lutCache.has(key)) lutCache.set(key, buildLut(stops));
+  return lutCache.get(key)!;
+};
+
+const loadImage = (src: string) =>
+  new Promise<HTMLImageElement>((resolve, reject) => {
+    const img = new window.Image();
+    img.onload = () => resolve(img);
+    img.onerror = () => reject(new Error("Failed to load image"));
+    img.src = src;
+  });
+
+const MAX_RENDER_SIDE = 1024;
+
+/**
+ * Colorizes a raw heatmap and blends it over the grayscale base image, like captum's
+ * blended_heat_map: value = min + q/255*(max-min), normalized with clip(value/scale, -1, 1).
+ * The map is stretched to the base image, as the model input is a plain resize of it.
+ */
+export async function renderRawHeatmap(raw: RawHeatmap, baseSrc: string, style: HeatmapStyle): Promise<string> {
+  const [base, map] = await Promise.all([loadImage(baseSrc), loadImage(raw.data)]);
+
+  const ratio = Math.min(1, MAX_RENDER_SIDE / Math.max(base.naturalWidth, base.naturalHeight));
+  const width = Math.round(base.naturalWidth * ratio);
+  const height = Math.round(base.naturalHeight * ratio);
+
+  const canvas = document.createElement("canvas");
+  canvas.width = width;
+  canvas.height = height;
+  const ctx = canvas.getContext("2d")!;
+
+  ctx.drawImage(base, 0, 0, width, height);
+  const basePixels = ctx.getImageData(0, 0, width, height);
+
+  ctx.imageSmoothingEnabled = true;
+  ctx.imageSmoothingQuality = "high";
+  ctx.clearRect(0, 0, width, height);
+  ctx.drawImage(map, 0, 0, width, height);
+  const mapPixels = ctx.getImageData(0, 0, width, height).data;
+
+  // Grayscale base, autoscaled to its own range (imshow cmap="gray")
+  const px = basePixels.data;
+  const gray = new Float32Array(width * height);
+  let gMin = 255, gMax = 0;
+  for (let i = 0; i < gray.length; i++) {
+    const g = (px[i * 4] + px[i * 4 + 1] + px[i * 4 + 2]) / 3;
+    gray[i] = g;
+    if (g < gMin) gMin = g;
+    if (g > gMax) gMax = g;
+  }
+  const gSpan = gMax > gMin ? gMax - gMin : 1;
+
+  const lut = getLut(style.colormap === "auto" ? SIGN_COLORMAP[raw.sign] : COLORMAPS[style.colormap]);
+  const alpha = style.opacity;
+  const span = raw.max - raw.min;
+  for (let i = 0; i < gray.length; i++) {
+    const value = raw.min + (mapPixels[i * 4] / 255) * span;
+    const norm = raw.scale !== 0 ? Math.max(-1, Math.min(1, value / raw.scale)) : 0;
+    const t = raw.sign === "all" ? (norm + 1) / 2 : Math.max(0, norm);
+    const idx = Math.min(255, Math.floor(t * 256)) * 3;
+    const g = ((gray[i] - gMin) / gSpan) * 255;
+    px[i * 4] = (1 - alpha) * g + alpha * lut[idx];
+    px[i * 4 + 1] = (1 - alpha) * g + alpha * lut[idx + 1];
+    px[i * 4 + 2] = (1 - alpha) * g + alpha * lut[idx + 2];
+    px[i * 4 + 3] = 255;
+  }
+  ctx.putImageData(basePixels, 0, 0);
+  return canvas.toDataURL("image/jpeg", 0.9);
+}
@@ -120,7 +120,7 @@ def process_folder(folder_path, folder_name):
         print(f"Sending batch {current_batch_idx}/{total_batches} ({num_images_in_batch} images)...")
 
         try:
-            response = requests.post(API_URL, files=files_to_upload)
+            response = requests.post(API_URL, files=files_to_upload, data={'preview': 'none'})
             response.raise_for_status()
             data = response.json()
 
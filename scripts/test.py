@@ -129,7 +129,7 @@ def run_inference(image_path: Path) -> Optional[Dict]:
             resp = requests.post(
                 INFERENCE_API,
                 files={'image': f},
-                data={'model_strategy': 'standard', 'crop_mode': 'integrated'},
+                data={'model_strategy': 'standard', 'crop_mode': 'integrated', 'fields': 'probs'},
                 timeout=60
             )
         